@@ -1,22 +1,74 @@
-from flask import Flask, render_template, request, send_file
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, g, jsonify, render_template, request, send_file, url_for
+import io
+import logging
 import os
+import zipfile
 
-# Import the format_docx functions from both formatting styles
-from format_style_1 import format_docx as format_docx_style_1
-from format_style_2 import format_docx as format_docx_style_2
-from format_style_3 import format_docx as format_docx_style_3
-from format_style_4 import format_docx as format_docx_style_4
-from format_style_5 import format_docx as format_docx_style_5
-from format_style_6 import format_docx as format_docx_style_6
-
+from batch_format import BatchTooLarge, check_zip
+from formatters import FORMATTERS, DOCX_MIMETYPE, choose_formatter, output_version
+from instrumentation import METRICS, make_profiler, save_profile, trace_document
+from jobs import BATCH, BATCH_OUTPUT_FILENAME, DONE, FAILED, JobQueue, JobQueueFull
+from result_cache import ResultCache, cache_key
+from structured_logging import configure_logging, get_request_id, reset_request_id, set_request_id
+from upload_archive import archive_upload, maybe_cleanup_uploads
 
 app = Flask(__name__)
 
-# Configure upload folder
-UPLOAD_FOLDER = 'uploads'
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Configure upload folder; uploads are only kept on disk when archiving is enabled
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+app.config['ARCHIVE_UPLOADS'] = os.environ.get('ARCHIVE_UPLOADS', '0') == '1'
+app.config['UPLOAD_RETENTION_HOURS'] = float(os.environ.get('UPLOAD_RETENTION_HOURS', '24'))
+
+# Configure the cache of formatted results (RESULT_CACHE_MAX_MB=0 disables it)
+app.config['RESULT_CACHE_FOLDER'] = os.environ.get('RESULT_CACHE_FOLDER', 'cache')
+app.config['RESULT_CACHE_MAX_MB'] = float(os.environ.get('RESULT_CACHE_MAX_MB', '512'))
+result_cache = None
+if app.config['RESULT_CACHE_MAX_MB'] > 0:
+    result_cache = ResultCache(app.config['RESULT_CACHE_FOLDER'], int(app.config['RESULT_CACHE_MAX_MB'] * 1024 * 1024))
+
+# Configure background jobs for documents too large to format within a request
+app.config['JOB_FOLDER'] = os.environ.get('JOB_FOLDER', 'jobs')
+# Every gunicorn worker has its own job pool, so the server runs up to
+# (gunicorn workers) x JOB_WORKERS jobs at once; JOB_MAX_PENDING counts the jobs of all of them
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', '2'))
+app.config['JOB_MAX_PENDING'] = int(os.environ.get('JOB_MAX_PENDING', '100'))
+app.config['JOB_RETENTION_HOURS'] = float(os.environ.get('JOB_RETENTION_HOURS', '24'))
+# Jobs still queued or running this long after submission are failed and stop counting as pending
+app.config['JOB_TIMEOUT_MINUTES'] = float(os.environ.get('JOB_TIMEOUT_MINUTES', '60'))
+job_queue = JobQueue(app.config['JOB_FOLDER'], app.config['JOB_WORKERS'], app.config['JOB_MAX_PENDING'])
+
+# Configure profiling: PROFILE_REQUESTS=1 honours an "X-Profile: cprofile|pyinstrument" request
+# header, PROFILE_ALL=cprofile|pyinstrument profiles every formatted document
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+app.config['PROFILE_ALL'] = os.environ.get('PROFILE_ALL', '')
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', 'profiles')
+
+def requested_profiler():
+    """The profiler to run for this request, if any; raises ValueError for an unknown one."""
+    kind = app.config['PROFILE_ALL']
+    if app.config['PROFILE_REQUESTS'] and request.headers.get('X-Profile'):
+        kind = request.headers['X-Profile'].strip().lower()
+    return make_profiler(kind) if kind else None
+
+# Tag every log record of a request with its id, taken from X-Request-ID when the proxy sets one
+@app.before_request
+def bind_request_id():
+    g.request_id_token = set_request_id(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
+@app.teardown_request
+def unbind_request_id(exc=None):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        reset_request_id(token)
 
 # Define route to render the index.html page
 @app.route('/')
@@ -39,38 +91,160 @@ def process():
 
     formatting_style = request.form.get('formatting_style')
 
-    # Save uploaded file
-    docx_filename = secure_filename(docx_file.filename)
-    docx_path = os.path.join(app.config['UPLOAD_FOLDER'], docx_filename)
-    docx_file.save(docx_path)
-
-    formatted_file = None
-
-    if formatting_style == 'style_1':
-        # Handle format style 1
-        formatted_file = format_docx_style_1(docx_path)
-
-    elif formatting_style == 'style_2':
-        # Handle format style 2
-        formatted_file = format_docx_style_2(docx_path)
-    elif formatting_style == 'style_3':
-        # Handle format style 3
-        formatted_file = format_docx_style_3(docx_path)
-    elif formatting_style == 'style_4':
-        # Handle format style 4
-        formatted_file = format_docx_style_4(docx_path)
-    elif formatting_style == 'style_5':
-        # Handle format style 5
-        formatted_file = format_docx_style_5(docx_path)
-    elif formatting_style == 'style_6':
-        # Handle format style 6
-        formatted_file = format_docx_style_6(docx_path)
-
-    else:
+    if formatting_style not in FORMATTERS:
         return "Invalid formatting style selected"
+    download_name = FORMATTERS[formatting_style][1]
+
+    # Read the upload into memory; it is only written to disk when archiving is enabled
+    upload_data = docx_file.read()
+    if app.config['ARCHIVE_UPLOADS']:
+        archive_upload(upload_data, docx_file.filename, app.config['UPLOAD_FOLDER'])
+        maybe_cleanup_uploads(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_RETENTION_HOURS'] * 3600)
+
+    # Serve repeat uploads straight from the result cache
+    etag = cache_key(upload_data, formatting_style, output_version(formatting_style))
+    cached_file = result_cache.get(etag) if result_cache else None
+    if cached_file:
+        logger.info("Served %s from the result cache", formatting_style, extra={'style': formatting_style, 'cache': 'hit'})
+        return send_file(cached_file, as_attachment=True, download_name=download_name,
+                         mimetype=DOCX_MIMETYPE, etag=etag)
+
+    try:
+        profiler = requested_profiler()
+    except ValueError as e:
+        return str(e), 400
+
+    # Format into memory so concurrent requests never share an output file
+    formatted_file = io.BytesIO()
+    format_docx = choose_formatter(formatting_style, len(upload_data))
+    trace = None  # Stays None if tracing fails to start (e.g. the profiler cannot start)
+    try:
+        with trace_document(formatting_style, profiler) as trace:
+            format_docx(io.BytesIO(upload_data), formatted_file)
+    finally:
+        if trace is not None:
+            METRICS.observe(trace.summary())
+    logger.info("Formatted %s (%d bytes) in %.3fs", formatting_style, len(upload_data), trace.seconds,
+                extra={'style': formatting_style, 'seconds': round(trace.seconds, 4), 'cache': 'miss'})
+    if result_cache:
+        result_cache.put(etag, formatted_file.getvalue())
+    formatted_file.seek(0)
 
     # Serve the formatted file for download
-    return send_file(formatted_file, as_attachment=True)
+    response = send_file(formatted_file, as_attachment=True, download_name=download_name,
+                         mimetype=DOCX_MIMETYPE, etag=etag)
+    response.headers['Server-Timing'] = trace.server_timing()
+    if profiler:
+        response.headers['X-Profile'] = save_profile(trace, app.config['PROFILE_FOLDER'])
+    return response
+
+# Queue a document for background formatting
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    docx_file = request.files.get('docx_file')
+    if docx_file is None or docx_file.filename == '':
+        return jsonify(error="No file selected"), 400
+
+    formatting_style = request.form.get('formatting_style')
+    if formatting_style not in FORMATTERS:
+        return jsonify(error="Invalid formatting style selected"), 400
+
+    job_queue.store.sweep(app.config['JOB_TIMEOUT_MINUTES'] * 60)
+    job_queue.store.cleanup(app.config['JOB_RETENTION_HOURS'] * 3600)
+    try:
+        job_id = job_queue.submit(formatting_style, docx_file.filename, docx_file.read())
+    except JobQueueFull as e:
+        return jsonify(error=str(e)), 503
+
+    response = jsonify(job_status(job_queue.store.get(job_id)))
+    response.headers['Location'] = url_for('get_job', job_id=job_id)
+    return response, 202
+
+def job_status(job):
+    status = {
+        'id': job['id'],
+        'kind': job['kind'],
+        'style': job['style'],
+        'filename': job['filename'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'status_url': url_for('get_job', job_id=job['id']),
+    }
+    if job['status'] == DONE:
+        status['result_url'] = url_for('get_job_result', job_id=job['id'])
+        if job['kind'] == BATCH:
+            report = job_queue.store.report(job['id']) or {}
+            status['succeeded'] = report.get('succeeded')
+            status['failed'] = report.get('failed')
+    elif job['status'] == FAILED:
+        status['error'] = job['error']
+    return status
+
+# Report the status of a background job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job_status(job))
+
+# Download the result of a finished background job
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    if job['status'] != DONE:
+        return jsonify(job_status(job)), 409
+
+    output_path = job_queue.store.output_path(job_id, job['style'], job['kind'])
+    if job['kind'] == BATCH:
+        response = send_file(output_path, as_attachment=True, download_name=BATCH_OUTPUT_FILENAME,
+                             mimetype='application/zip')
+        report = job_queue.store.report(job_id) or {}
+        response.headers['X-Batch-Succeeded'] = str(report.get('succeeded'))
+        response.headers['X-Batch-Failed'] = str(report.get('failed'))
+        return response
+    download_name = FORMATTERS[job['style']][1]
+    return send_file(output_path, as_attachment=True, download_name=download_name, mimetype=DOCX_MIMETYPE)
+
+# Queue every document in an uploaded ZIP archive for formatting; the result is a ZIP of
+# the formatted documents and their report, downloaded like that of any other job
+@app.route('/batch', methods=['POST'])
+def batch():
+    zip_file = request.files.get('zip_file')
+    if zip_file is None or zip_file.filename == '':
+        return jsonify(error="No file selected"), 400
+
+    formatting_style = request.form.get('formatting_style')
+    if formatting_style not in FORMATTERS:
+        return jsonify(error="Invalid formatting style selected"), 400
+
+    zip_data = zip_file.read()
+    try:
+        check_zip(io.BytesIO(zip_data))
+    except zipfile.BadZipFile:
+        return jsonify(error="Uploaded file is not a ZIP archive"), 400
+    except BatchTooLarge as e:
+        return jsonify(error=str(e)), 413
+
+    job_queue.store.sweep(app.config['JOB_TIMEOUT_MINUTES'] * 60)
+    job_queue.store.cleanup(app.config['JOB_RETENTION_HOURS'] * 3600)
+    try:
+        job_id = job_queue.submit(formatting_style, zip_file.filename, zip_data, BATCH)
+    except JobQueueFull as e:
+        return jsonify(error=str(e)), 503
+
+    response = jsonify(job_status(job_queue.store.get(job_id)))
+    response.headers['Location'] = url_for('get_job', job_id=job_id)
+    return response, 202
+
+# Expose formatting metrics of this process in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 # if __name__ == '__main__':
 #     app.run(debug=True)
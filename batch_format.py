@@ -0,0 +1,250 @@
+"""Format many documents at once, from a directory or a ZIP archive.
+
+Documents are fanned out across a process pool (one worker per core by
+default; batch jobs of the web app use a single worker, see ``jobs``) and
+every file gets a report entry with its status and timing.  A document that
+takes its worker process down fails on its own: the documents the broken
+pool was holding are formatted again one at a time.
+
+Archives are checked against MAX_BATCH_FILES and MAX_BATCH_BYTES (the total
+uncompressed size of the documents) before anything is decompressed.
+
+Usage:
+    python -m batch_format INPUT_DIR --style style_5 --output OUTPUT_DIR
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from formatters import FORMATTERS, choose_formatter
+from instrumentation import METRICS, trace_document
+from structured_logging import configure_logging, get_request_id, request_context
+
+REPORT_FILENAME = 'report.json'
+
+# Limits on the documents in an archive (BATCH_MAX_FILES and BATCH_MAX_MB in the environment)
+MAX_BATCH_FILES = int(os.environ.get('BATCH_MAX_FILES', '50'))
+MAX_BATCH_BYTES = int(float(os.environ.get('BATCH_MAX_MB', '200')) * 1024 * 1024)
+
+
+class BatchTooLarge(ValueError):
+    """Raised when an archive holds more documents, or more bytes, than allowed."""
+
+
+# Function to format a single document; runs in a pool process
+def format_one(style, name, source, output=None, request_id=None):
+    """Formats ``source`` (a path or bytes) and returns a report entry.
+
+    The formatted document is written to ``output`` when given, otherwise its
+    bytes are returned in the entry under ``"data"``.  Log records are tagged
+    with ``request_id``, the id of the batch.
+    """
+    with request_context(request_id):
+        return _format_one(style, name, source, output)
+
+
+def _format_one(style, name, source, output):
+    if isinstance(source, bytes):
+        format_docx = choose_formatter(style, len(source))
+        source = io.BytesIO(source)
+    else:
+        format_docx = choose_formatter(style, os.path.getsize(source))
+    target = io.BytesIO() if output is None else output
+
+    start = time.perf_counter()
+    trace = None
+    try:
+        with trace_document(style) as trace:
+            format_docx(source, target)
+    except Exception as e:
+        return {
+            'name': name,
+            'ok': False,
+            'error': '%s: %s' % (type(e).__name__, e),
+            'traceback': traceback.format_exc(limit=5),
+            'seconds': round(time.perf_counter() - start, 4),
+            'stages': round_stages(trace.stages) if trace is not None else {},
+        }
+    entry = {'name': name, 'ok': True, 'seconds': round(time.perf_counter() - start, 4),
+             'stages': round_stages(trace.stages)}
+    if output is None:
+        entry['data'] = target.getvalue()
+    return entry
+
+
+# Function to format (name, source, output) items in parallel
+def format_batch(style, items, max_workers=None):
+    """Returns the report entries in the same order as ``items``."""
+    if style not in FORMATTERS:
+        raise ValueError("Invalid formatting style: %s" % style)
+    items = list(items)
+    if not items:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(items))
+    request_id = get_request_id()
+    results = [None] * len(items)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(format_one, style, name, source, output, request_id)
+                   for name, source, output in items]
+        for i, future in enumerate(futures):
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                pass
+    # A worker that died broke the whole pool; find the document responsible
+    broken = [i for i, result in enumerate(results) if result is None]
+    if broken:
+        format_isolated(style, items, broken, results, request_id)
+    # The documents were traced in the pool processes; record them here
+    for result in results:
+        METRICS.observe({'style': style, 'ok': result['ok'], 'seconds': result['seconds'], 'stages': result['stages']})
+    return results
+
+
+def format_isolated(style, items, indices, results, request_id=None):
+    """Formats ``items[i]`` for each of ``indices`` one at a time into ``results[i]``.
+
+    A document whose worker process dies gets a failed entry and the next
+    document starts a new worker.
+    """
+    executor = None
+    try:
+        for i in indices:
+            name, source, output = items[i]
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=1)
+            start = time.perf_counter()
+            try:
+                results[i] = executor.submit(format_one, style, name, source, output, request_id).result()
+            except BrokenProcessPool:
+                executor.shutdown(wait=False)
+                executor = None
+                results[i] = {
+                    'name': name,
+                    'ok': False,
+                    'error': "BrokenProcessPool: the worker process exited while formatting this document",
+                    'seconds': round(time.perf_counter() - start, 4),
+                    'stages': {},
+                }
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def round_stages(stages):
+    return {stage: round(seconds, 4) for stage, seconds in stages.items()}
+
+
+def summarize(style, results, seconds):
+    return {
+        'style': style,
+        'total': len(results),
+        'succeeded': sum(1 for r in results if r['ok']),
+        'failed': sum(1 for r in results if not r['ok']),
+        'seconds': round(seconds, 4),
+        'files': [{k: v for k, v in r.items() if k != 'data'} for r in results],
+    }
+
+
+def is_docx_member(info):
+    name = info.filename
+    return (not info.is_dir() and name.lower().endswith('.docx')
+            and not name.startswith('__MACOSX/') and not os.path.basename(name).startswith('~$'))
+
+
+# Function to list the documents of an archive, within the batch limits
+def batch_members(zin, max_files=None, max_bytes=None):
+    """The .docx members of ``zin``; raises BatchTooLarge before any of them is read.
+
+    The sizes come from the archive's directory; zipfile never decompresses
+    a member past its recorded size, so a member cannot exceed them.
+    """
+    max_files = MAX_BATCH_FILES if max_files is None else max_files
+    max_bytes = MAX_BATCH_BYTES if max_bytes is None else max_bytes
+    members = [info for info in zin.infolist() if is_docx_member(info)]
+    if len(members) > max_files:
+        raise BatchTooLarge("The archive holds %d documents; at most %d are allowed" % (len(members), max_files))
+    total = sum(info.file_size for info in members)
+    if total > max_bytes:
+        raise BatchTooLarge("The documents in the archive add up to %.1f MB; at most %.1f MB are allowed" % (
+            total / (1024 * 1024), max_bytes / (1024 * 1024)))
+    return members
+
+
+# Function to check an uploaded archive without formatting it
+def check_zip(zip_source, max_files=None, max_bytes=None):
+    """Raises zipfile.BadZipFile or BatchTooLarge; returns the number of documents."""
+    with zipfile.ZipFile(zip_source) as zin:
+        return len(batch_members(zin, max_files, max_bytes))
+
+
+# Function to format every .docx inside a ZIP archive
+def format_zip(zip_source, style, max_workers=None, max_files=None, max_bytes=None):
+    """Returns (zip bytes of the formatted documents plus report.json, report)."""
+    start = time.perf_counter()
+    with zipfile.ZipFile(zip_source) as zin:
+        items = [(info.filename, zin.read(info), None) for info in batch_members(zin, max_files, max_bytes)]
+    results = format_batch(style, items, max_workers)
+    report = summarize(style, results, time.perf_counter() - start)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for result in results:
+            if result['ok']:
+                zout.writestr(result['name'], result['data'])
+        zout.writestr(REPORT_FILENAME, json.dumps(report, indent=2))
+    return buffer.getvalue(), report
+
+
+# Function to format every .docx under a directory into another directory
+def format_directory(input_dir, output_dir, style, max_workers=None):
+    start = time.perf_counter()
+    items = []
+    for root, _, files in os.walk(input_dir):
+        for filename in sorted(files):
+            if not filename.lower().endswith('.docx') or filename.startswith('~$'):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, input_dir)
+            output = os.path.join(output_dir, name)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            items.append((name, path, output))
+    results = format_batch(style, items, max_workers)
+    report = summarize(style, results, time.perf_counter() - start)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, REPORT_FILENAME), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Format every .docx file in a directory.")
+    parser.add_argument('input_dir', help="directory containing .docx files (searched recursively)")
+    parser.add_argument('--style', required=True, choices=sorted(FORMATTERS), help="formatting style")
+    parser.add_argument('-o', '--output', default='formatted', help="output directory (default: formatted)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    report = format_directory(args.input_dir, args.output, args.style, args.workers)
+    for entry in report['files']:
+        status = 'ok' if entry['ok'] else 'FAILED'
+        line = "%-6s %8.2fs  %s" % (status, entry['seconds'], entry['name'])
+        if not entry['ok']:
+            line += "  (%s)" % entry['error']
+        print(line)
+    print("%d succeeded, %d failed in %.2fs; report written to %s" % (
+        report['succeeded'], report['failed'], report['seconds'], os.path.join(args.output, REPORT_FILENAME)))
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
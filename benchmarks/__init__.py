@@ -0,0 +1,7 @@
+"""Benchmarks for the formatting styles.
+
+``benchmarks.synthetic`` builds manuscripts of any size and ``benchmarks.run``
+formats them with every style, writing the timings to a JSON report:
+
+    python -m benchmarks.run --sizes 10,100,1000,10000 --output benchmark.json
+"""
@@ -0,0 +1,245 @@
+"""Check that restyle mode formats documents the way direct mode does.
+
+Each style that supports restyling (see ``formatters.RESTYLE_STYLES``)
+formats the same document with and without ``restyle``, and the effective
+format of every run is compared: alignment, font, size, colour, bold, italic
+and underline, as Word resolves them from direct formatting, character
+styles, paragraph styles, the table style (including the header row) and
+the document defaults.  The body, tables, text boxes and headers are all
+checked.  Without inputs the check runs on a synthetic manuscript with a
+table, a text box, a header, a hyperlink and character styles added to it.
+
+Usage:
+    python -m benchmarks.restyle_check [--styles style_3,style_4] [INPUT.docx ...]
+
+The exit status is 1 when any paragraph differs.
+"""
+import argparse
+import io
+import os
+import sys
+import zipfile
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from lxml import etree
+
+from benchmarks.synthetic import manuscript_spec, make_manuscript
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEXT_BOX = ('<w:r %s xmlns:v="urn:schemas-microsoft-com:vml"><w:pict><v:shape style="width:200pt;height:60pt"><v:textbox><w:txbxContent>'
+            '<w:p><w:r><w:t>Text box paragraph in Normal</w:t></w:r></w:p>'
+            '<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>Text box heading</w:t></w:r></w:p>'
+            '</w:txbxContent></v:textbox></v:shape></w:pict></w:r>' % nsdecls('w'))
+HYPERLINK = ('<w:hyperlink %s w:anchor="top"><w:r><w:rPr><w:rStyle w:val="Emphasis"/></w:rPr>'
+             '<w:t>a link</w:t></w:r></w:hyperlink>' % nsdecls('w'))
+
+# Run properties compared, by tag
+_RUN_PROPERTIES = ('ascii', 'hAnsi', 'sz', 'color', 'b', 'i', 'u')
+_TOGGLES = ('b', 'i')
+# What Word uses when nothing sets a property
+_DEFAULTS = {
+    'jc': (('val', 'left'),),
+    'sz': (('val', '20'),),
+    'color': (('val', 'auto'),),
+    'u': (('val', 'none'),),
+}
+
+
+# Function to build the document the check runs on by default
+def make_check_document():
+    doc = make_manuscript(manuscript_spec(30, heading_every=8, table_every=0, image_every=0, references=3))
+    doc.sections[0].header.paragraphs[0].text = "Running header in the Header style"
+    doc.sections[0].header.add_paragraph("Header paragraph in Normal", style="Normal")
+
+    body = doc.paragraphs[8]
+    body.add_run(" and ")
+    body.add_run("strong words", style="Strong")
+    body._p.append(parse_xml(HYPERLINK))
+
+    for style in ("Table Grid", "Light Grid Accent 1"):
+        table = doc.add_table(rows=3, cols=3)
+        table.style = style
+        for r, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = "Column %d" % (c + 1) if not r else "Value %d.%d" % (r, c)
+        table.cell(1, 0).paragraphs[0].style = "Heading 1"
+        table.cell(2, 1).paragraphs[0].add_run(" emphasised", style="Emphasis")
+
+    holder = doc.add_paragraph("Paragraph holding a text box: ")
+    holder._p.append(parse_xml(TEXT_BOX))
+    doc.add_paragraph("A closing paragraph after the tables and the text box.")
+    return doc
+
+
+class EffectiveFormat:
+    """Resolves the effective format of the runs of one part, given the package's styles part."""
+
+    def __init__(self, styles_xml):
+        root = etree.fromstring(styles_xml)
+        self.styles = {style.get(qn('w:styleId')): style for style in root.iter(qn('w:style'))}
+        self.defaults = {}
+        for style in root.iter(qn('w:style')):
+            if style.get(qn('w:default')) in ('1', 'true'):
+                self.defaults[style.get(qn('w:type'))] = style.get(qn('w:styleId'))
+        self.doc_defaults = root.find(qn('w:docDefaults'))
+
+    def chain(self, style_id, style_type):
+        if style_id not in self.styles or self.styles[style_id].get(qn('w:type')) != style_type:
+            style_id = self.defaults.get(style_type)
+        chain = []
+        while style_id in self.styles and self.styles[style_id] not in chain:
+            style = self.styles[style_id]
+            chain.append(style)
+            based_on = style.find(qn('w:basedOn'))
+            style_id = based_on.get(qn('w:val')) if based_on is not None else None
+        return chain
+
+    def paragraph_levels(self, p, kind):
+        """The ``kind`` (w:pPr or w:rPr) elements a paragraph inherits from, nearest first."""
+        style = p.find('%s/%s' % (qn('w:pPr'), qn('w:pStyle')))
+        levels = [s.find(kind) for s in self.chain(style.get(qn('w:val')) if style is not None else None,
+                                                   'paragraph')]
+        for ancestor in p.iterancestors(qn('w:tbl'), qn('w:txbxContent')):
+            if ancestor.tag == qn('w:tbl'):
+                table_style = ancestor.find('%s/%s' % (qn('w:tblPr'), qn('w:tblStyle')))
+                table_chain = self.chain(table_style.get(qn('w:val')) if table_style is not None else None, 'table')
+                if p.getparent().getparent() is ancestor.find(qn('w:tr')):
+                    levels += [c.find(kind) for s in table_chain for c in s.iter(qn('w:tblStylePr'))
+                               if c.get(qn('w:type')) == 'firstRow']
+                levels += [s.find(kind) for s in table_chain]
+            break
+        if self.doc_defaults is not None:
+            levels.append(self.doc_defaults.find('%s/%s' % (qn('w:%sDefault' % kind[kind.index('}') + 1:]), kind)))
+        return [level for level in levels if level is not None]
+
+    def run(self, r, paragraph_levels):
+        rPr = r.find(qn('w:rPr'))
+        style = rPr.find(qn('w:rStyle')) if rPr is not None else None
+        character = [s.find(qn('w:rPr')) for s in self.chain(style.get(qn('w:val')), 'character')] \
+            if style is not None else []
+        character = [level for level in character if level is not None]
+        values = []
+        for tag in _RUN_PROPERTIES:
+            direct = _value(rPr, tag)
+            if direct is not None:
+                values.append(direct)
+                continue
+            inherited = _first(paragraph_levels, tag)
+            own = _first(character, tag)
+            if tag in _TOGGLES:
+                values.append(('val', str((inherited == _ON) != (own == _ON))))
+            else:
+                values.append(own or inherited or _DEFAULTS.get(tag))
+        return ''.join(t.text or '' for t in r.iter(qn('w:t'))), tuple(values)
+
+    def paragraph(self, p):
+        pPr = p.find(qn('w:pPr'))
+        jc = _value(pPr, 'jc') or _first(self.paragraph_levels(p, qn('w:pPr')), 'jc') or _DEFAULTS['jc']
+        levels = self.paragraph_levels(p, qn('w:rPr'))
+        runs = [self.run(r, levels) for r in p.iter(qn('w:r')) if next(r.iterancestors(qn('w:p'))) is p]
+        return jc, runs
+
+
+_ON = ('val', 'True')
+
+
+def _value(properties, tag):
+    """The value of ``tag`` set in a w:rPr or w:pPr element; the ascii and hAnsi fonts are read from w:rFonts."""
+    if tag in ('ascii', 'hAnsi'):
+        element = properties.find(qn('w:rFonts')) if properties is not None else None
+        if element is None:
+            return None
+        # A theme font takes precedence over the font named next to it
+        if element.get(qn('w:%sTheme' % tag)):
+            return 'theme', element.get(qn('w:%sTheme' % tag))
+        if element.get(qn('w:' + tag)):
+            return 'font', element.get(qn('w:' + tag))
+        return None
+    element = properties.find(qn('w:' + tag)) if properties is not None else None
+    if element is None:
+        return None
+    if tag in _TOGGLES:
+        return 'val', str(element.get(qn('w:val'), 'true') not in ('0', 'false', 'off'))
+    return tuple(sorted((etree.QName(name).localname, value) for name, value in element.attrib.items()))
+
+
+def _first(levels, tag):
+    return next((value for value in (_value(level, tag) for level in levels) if value is not None), None)
+
+
+def effective_formats(docx_bytes):
+    """{part name: [effective format of each paragraph]} for the document and its headers."""
+    package = zipfile.ZipFile(io.BytesIO(docx_bytes))
+    resolver = EffectiveFormat(package.read('word/styles.xml'))
+    parts = {}
+    for name in sorted(package.namelist()):
+        if name == 'word/document.xml' or (name.startswith('word/header') and name.endswith('.xml')):
+            root = etree.fromstring(package.read(name))
+            parts[name] = [resolver.paragraph(p) for p in root.iter(qn('w:p'))]
+    return parts
+
+
+def compare(style, source):
+    """Returns (paragraphs compared, [(part, index, direct, restyled)]) for ``style`` on ``source``."""
+    from formatters import FORMATTERS
+
+    format_docx = FORMATTERS[style][0]
+    outputs = []
+    for restyle in (False, True):
+        source.seek(0)
+        output = io.BytesIO()
+        format_docx(source, output, restyle=restyle)
+        outputs.append(effective_formats(output.getvalue()))
+    direct, restyled = outputs
+    mismatches = []
+    compared = 0
+    for part, paragraphs in direct.items():
+        compared += len(paragraphs)
+        other = restyled.get(part, [])
+        for index, paragraph in enumerate(paragraphs):
+            if index >= len(other) or other[index] != paragraph:
+                mismatches.append((part, index, paragraph, other[index] if index < len(other) else None))
+    return compared, mismatches
+
+
+def parse_list(value):
+    return [v for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare restyle mode with direct formatting.")
+    parser.add_argument('inputs', nargs='*', help=".docx files to check (default: a synthetic manuscript)")
+    parser.add_argument('--styles', type=parse_list, default=None,
+                        help="comma-separated styles (default: every style that supports restyling)")
+    args = parser.parse_args(argv)
+
+    # The formatters load their header images relative to the working directory
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    from formatters import RESTYLE_STYLES
+
+    sources = []
+    for path in args.inputs:
+        with open(path, 'rb') as f:
+            sources.append((path, io.BytesIO(f.read())))
+    if not sources:
+        source = io.BytesIO()
+        make_check_document().save(source)
+        sources.append(('synthetic manuscript', source))
+
+    failed = False
+    for name, source in sources:
+        for style in args.styles or sorted(RESTYLE_STYLES):
+            compared, mismatches = compare(style, source)
+            print("%-8s %-30s %5d paragraphs  %s" % (
+                style, name[-30:], compared, "%d differ" % len(mismatches) if mismatches else "ok"))
+            for part, index, direct, restyled in mismatches[:5]:
+                print("    %s paragraph %d\n      direct:  %s\n      restyle: %s" % (part, index, direct, restyled))
+            failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""Time every formatting style on synthetic manuscripts of increasing size.
+
+Each (style, size, repeat) run happens in a fresh process, so its peak RSS is
+not inflated by earlier runs.  Besides wall time the report records the
+formatter's own stage spans (see ``instrumentation``) and, for every
+module-level function of the style's module, how long it took in total and how
+often it was called (nested calls count towards both the caller and callee).
+
+Usage:
+    python -m benchmarks.run [--styles style_1,style_5] [--sizes 10,100,1000,10000]
+                             [--repeat 3] [--output benchmark.json]
+                             [--baseline previous.json --tolerance 0.25]
+
+With ``--baseline`` the exit status is 1 when any style/size median is more
+than ``tolerance`` slower than in the baseline report.
+"""
+import argparse
+import functools
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.synthetic import manuscript_spec, write_manuscript
+
+# The formatters load their header images relative to the working directory
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_STYLES = ['style_1', 'style_2', 'style_3', 'style_4', 'style_5', 'style_6']
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+class FunctionTimer:
+    """Accumulates wall time and call counts for wrapped functions."""
+
+    def __init__(self):
+        self.functions = {}
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                entry = self.functions.setdefault(name, [0.0, 0])
+                entry[0] += time.perf_counter() - start
+                entry[1] += 1
+        return timed
+
+    def report(self):
+        return {name: {'seconds': round(seconds, 6), 'calls': calls}
+                for name, (seconds, calls) in sorted(self.functions.items(), key=lambda item: -item[1][0])}
+
+
+# Function to time the module-level functions of a style module
+def instrument(module, timer):
+    import docx
+    import docx.document
+    import package_writer
+
+    for name, obj in list(vars(module).items()):
+        if name == 'format_docx':
+            continue
+        if obj is docx.Document:
+            setattr(module, name, timer.wrap('open', obj))
+        elif obj is package_writer.save_document:
+            setattr(module, name, timer.wrap('save', obj))
+        elif inspect.isfunction(obj) and obj.__module__ == module.__name__:
+            setattr(module, name, timer.wrap(name, obj))
+    docx.Document = timer.wrap('open', docx.Document)
+    docx.document.Document.save = timer.wrap('save', docx.document.Document.save)
+
+
+# Function to run one benchmark; runs in its own process
+def run_once(style, path):
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    from formatters import FORMATTERS
+    from instrumentation import trace_document
+
+    format_docx, _ = FORMATTERS[style]
+    timer = FunctionTimer()
+    instrument(sys.modules[format_docx.__module__], timer)
+
+    output = io.BytesIO()
+    start = time.perf_counter()
+    try:
+        with trace_document(style) as trace:
+            format_docx(path, output)
+    except Exception as e:
+        return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e),
+                'seconds': round(time.perf_counter() - start, 6)}
+    seconds = time.perf_counter() - start
+    return {
+        'ok': True,
+        'seconds': round(seconds, 6),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # KiB on Linux
+        'output_bytes': output.tell(),
+        'stages': {name: round(seconds, 6) for name, seconds in trace.stages.items()},
+        'functions': timer.report(),
+    }
+
+
+def run_benchmarks(styles, sizes, repeat=1, spec_options=None, log=print):
+    """Returns the report entries, one per (style, size) with ``repeat`` runs each."""
+    spec_options = spec_options or {}
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory(prefix='docx-bench-') as workdir:
+        for size in sizes:
+            spec = manuscript_spec(size, **spec_options)
+            path = os.path.join(workdir, 'manuscript-%d.docx' % size)
+            write_manuscript(path, spec)
+            for style in styles:
+                runs = []
+                for _ in range(repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        runs.append(executor.submit(run_once, style, path).result())
+                timings = [run['seconds'] for run in runs if run['ok']]
+                entry = {
+                    'style': style,
+                    'paragraphs': size,
+                    'input_bytes': os.path.getsize(path),
+                    'ok': len(timings) == len(runs),
+                    'median_seconds': round(statistics.median(timings), 6) if timings else None,
+                    'runs': runs,
+                }
+                results.append(entry)
+                if log:
+                    if entry['ok']:
+                        log("%-8s %6d paragraphs  %9.3fs  %8.1f MiB" % (
+                            style, size, entry['median_seconds'], max(r['peak_rss_kb'] for r in runs) / 1024))
+                    else:
+                        log("%-8s %6d paragraphs  FAILED (%s)" % (
+                            style, size, next(r['error'] for r in runs if not r['ok'])))
+    return results
+
+
+# Function to compare a report with a baseline report
+def find_regressions(results, baseline, tolerance):
+    """Returns (style, paragraphs, baseline seconds, seconds) for runs slower than the baseline allows."""
+    previous = {(e['style'], e['paragraphs']): e['median_seconds'] for e in baseline['results'] if e['ok']}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry['style'], entry['paragraphs']))
+        if before and entry['ok'] and entry['median_seconds'] > before * (1 + tolerance):
+            regressions.append((entry['style'], entry['paragraphs'], before, entry['median_seconds']))
+    return regressions
+
+
+def parse_list(value, item=str):
+    return [item(v) for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the formatting styles on synthetic manuscripts.")
+    parser.add_argument('--styles', type=parse_list, default=DEFAULT_STYLES, help="comma-separated styles (default: all)")
+    parser.add_argument('--sizes', type=lambda v: parse_list(v, int), default=DEFAULT_SIZES,
+                        help="comma-separated body paragraph counts (default: 10,100,1000,10000)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per style and size (default: 1)")
+    parser.add_argument('--heading-every', type=int, default=12)
+    parser.add_argument('--table-every', type=int, default=40)
+    parser.add_argument('--image-every', type=int, default=50)
+    parser.add_argument('--no-title-style', action='store_true',
+                        help="leave the title unstyled, so styles 1, 3 and 6 run title detection")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON report (default: benchmark.json)")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown against the baseline, as a fraction (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, REPO_ROOT)
+    from formatters import FORMATTER_VERSION
+
+    spec_options = {
+        'heading_every': args.heading_every,
+        'table_every': args.table_every,
+        'image_every': args.image_every,
+        'title_style': not args.no_title_style,
+    }
+    results = run_benchmarks(args.styles, args.sizes, args.repeat, spec_options)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'formatter_version': FORMATTER_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'manuscript': spec_options,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Report written to %s" % args.output)
+
+    failed = [e for e in results if not e['ok']]
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for style, size, before, after in regressions:
+            print("REGRESSION %-8s %6d paragraphs  %.3fs -> %.3fs (%+.0f%%)" % (
+                style, size, before, after, (after / before - 1) * 100))
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
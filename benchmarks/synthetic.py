@@ -0,0 +1,136 @@
+"""Synthetic manuscripts of tunable size for benchmarking.
+
+A manuscript has the usual front matter (title, authors, abstract, keywords)
+followed by ``paragraphs`` body paragraphs broken up by headings, tables and
+paragraphs with inline images, and a reference list at the end.  The text is
+drawn from a fixed word list with a seeded generator, so the same spec always
+produces the same document.
+
+Usage:
+    python -m benchmarks.synthetic OUTPUT.docx --paragraphs 1000
+"""
+import argparse
+import io
+import random
+import struct
+import sys
+import zlib
+from collections import namedtuple
+
+from docx import Document
+from docx.shared import Cm
+
+ManuscriptSpec = namedtuple(
+    "ManuscriptSpec",
+    "paragraphs heading_every table_every image_every references title_style seed",
+)
+
+
+def manuscript_spec(paragraphs, heading_every=12, table_every=40, image_every=50, references=None,
+                    title_style=True, seed=0):
+    """A ManuscriptSpec with the default mix; ``references`` defaults to one per 20 paragraphs."""
+    if references is None:
+        references = max(3, paragraphs // 20)
+    return ManuscriptSpec(paragraphs, heading_every, table_every, image_every, references, title_style, seed)
+
+
+WORDS = (
+    "model material stress strain finite element analysis boundary condition mesh "
+    "simulation numerical method result convergence load displacement thermal "
+    "composite structure parameter optimization network training accuracy data "
+    "proposed approach experiment validation error performance framework the of "
+    "and in to with for is are on by that this we our which from as"
+).split()
+
+
+# Function to build a tiny solid-colour PNG for the inline images
+def make_png(width=64, height=48, rgb=(40, 90, 160)):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b""))
+
+
+def sentence(rng, words=18):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+# Function to build a manuscript Document from a ManuscriptSpec
+def make_manuscript(spec):
+    rng = random.Random(spec.seed)
+    png = make_png()
+    doc = Document()
+
+    title = "A Synthetic Study of " + sentence(rng, 8).rstrip(".")
+    if spec.title_style:
+        doc.add_paragraph(title, style="Title")
+    else:
+        doc.add_paragraph(title)
+    doc.add_paragraph("Jane Doe1, John Smith2 and Alex Lee1,*")
+    doc.add_paragraph("1Department of Engineering, Example University, City, 10000, Country")
+    doc.add_paragraph("Abstract: " + " ".join(sentence(rng) for _ in range(6)))
+    doc.add_paragraph("Keywords: finite element; simulation; composite; optimization")
+
+    section = 0
+    for i in range(spec.paragraphs):
+        if spec.heading_every and i % spec.heading_every == 0:
+            section += 1
+            if section % 3 == 0:
+                doc.add_heading("%d.%d %s" % (section // 3, section % 3 + 1, sentence(rng, 4).rstrip(".")), level=2)
+            else:
+                doc.add_heading("%d %s" % (section, sentence(rng, 3).rstrip(".")), level=1)
+
+        para = doc.add_paragraph(" ".join(sentence(rng, rng.randint(10, 30)) for _ in range(rng.randint(2, 5))))
+        if spec.image_every and i % spec.image_every == spec.image_every - 1:
+            para.add_run().add_picture(io.BytesIO(png), width=Cm(4))
+            doc.add_paragraph("Figure %d: %s" % (i // spec.image_every + 1, sentence(rng, 8)), style="Caption")
+
+        if spec.table_every and i % spec.table_every == spec.table_every - 1:
+            doc.add_paragraph("Table %d: %s" % (i // spec.table_every + 1, sentence(rng, 8)), style="Caption")
+            table = doc.add_table(rows=4, cols=4)
+            table.style = "Table Grid"
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    cell.text = "Value %d.%d" % (r, c) if r else "Column %d" % (c + 1)
+
+    doc.add_heading("References", level=1)
+    for i in range(spec.references):
+        doc.add_paragraph("%s, %s. %s Journal of Examples. 2024;%d(%d):%d-%d." % (
+            rng.choice(["Doe J", "Smith J", "Lee A", "Wang L"]), rng.choice(["Roe R", "Kim H", "Chen Y"]),
+            sentence(rng, 10), rng.randint(1, 60), rng.randint(1, 12), i + 1, i + 12), style="List Number")
+    return doc
+
+
+# Function to write a manuscript to a path or file-like object
+def write_manuscript(output, spec):
+    make_manuscript(spec).save(output)
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic .docx manuscript.")
+    parser.add_argument('output', help="path of the .docx file to write")
+    parser.add_argument('-n', '--paragraphs', type=int, default=100, help="body paragraphs (default: 100)")
+    parser.add_argument('--heading-every', type=int, default=12, help="paragraphs per heading (0 for none)")
+    parser.add_argument('--table-every', type=int, default=40, help="paragraphs per table (0 for none)")
+    parser.add_argument('--image-every', type=int, default=50, help="paragraphs per inline image (0 for none)")
+    parser.add_argument('--references', type=int, default=None, help="reference entries (default: paragraphs / 20)")
+    parser.add_argument('--no-title-style', action='store_true',
+                        help="leave the title in Normal style, so styles 1, 3 and 6 run title detection")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    spec = manuscript_spec(args.paragraphs, args.heading_every, args.table_every, args.image_every,
+                           args.references, not args.no_title_style, args.seed)
+    write_manuscript(args.output, spec)
+    print("Wrote %s (%d body paragraphs)" % (args.output, spec.paragraphs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
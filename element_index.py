@@ -0,0 +1,98 @@
+"""Every paragraph of a document, with the kind of container it sits in.
+
+``doc.paragraphs`` only returns the top-level body paragraphs, so text in
+tables, text boxes, headers, footers and notes is never formatted.
+``ElementIndex`` walks each story of the document once when it is opened —
+the body, then every header and footer part, then the footnotes and
+endnotes — and records each paragraph together with its innermost container
+(a table cell or text box, or else the story itself).  Nested tables and text
+boxes are found at any depth.  ``iter_entries`` indexes a single element the
+same way, which the streaming engine uses one body element at a time.
+"""
+from collections import namedtuple
+
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.part import PartFactory, XmlPart
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+
+BODY = "body"
+TABLE = "table"
+TEXTBOX = "textbox"
+HEADER = "header"
+FOOTER = "footer"
+FOOTNOTE = "footnote"
+ENDNOTE = "endnote"
+
+# Stories other than the body, by relationship type from the main document part
+STORY_RELS = {
+    RT.HEADER: HEADER,
+    RT.FOOTER: FOOTER,
+    RT.FOOTNOTES: FOOTNOTE,
+    RT.ENDNOTES: ENDNOTE,
+}
+
+# python-docx keeps footnotes and endnotes as opaque blobs; load them as XML so edits are saved
+PartFactory.part_type_for.setdefault(CT.WML_FOOTNOTES, XmlPart)
+PartFactory.part_type_for.setdefault(CT.WML_ENDNOTES, XmlPart)
+
+_P = qn('w:p')
+_CONTAINERS = {qn('w:tc'): TABLE, qn('w:txbxContent'): TEXTBOX}
+
+IndexedParagraph = namedtuple("IndexedParagraph", "paragraph container")
+
+
+class _Story:
+    """The parent of paragraphs outside the body; python-docx only needs its part."""
+
+    def __init__(self, part):
+        self.part = part
+
+
+def container_of(p, story):
+    """The innermost table cell or text box holding ``p``, else ``story``."""
+    element = p.getparent()
+    while element is not None:
+        container = _CONTAINERS.get(element.tag)
+        if container is not None:
+            return container
+        element = element.getparent()
+    return story
+
+
+def iter_entries(element, story, parent=None):
+    """Yields an IndexedParagraph for ``element`` (if it is a paragraph) and every paragraph inside it."""
+    for p in element.iter(_P):
+        yield IndexedParagraph(Paragraph(p, parent), container_of(p, story))
+
+
+def story_parts(document_part):
+    """(story, part) for every header, footer and notes part of the document, each once."""
+    seen = set()
+    for rel in document_part.rels.values():
+        story = STORY_RELS.get(rel.reltype)
+        if story is None or rel.is_external or rel.target_part in seen:
+            continue
+        seen.add(rel.target_part)
+        yield story, rel.target_part
+
+
+class ElementIndex:
+    """The paragraphs of every story of ``doc``, in document order, built once."""
+
+    def __init__(self, doc):
+        body = doc.element.body
+        self.entries = list(iter_entries(body, BODY, doc._body))
+        for story, part in story_parts(doc.part):
+            self.entries.extend(iter_entries(part.element, story, _Story(part)))
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def paragraphs(self, *containers):
+        """The paragraphs in any of ``containers`` (all of them if none are given)."""
+        return [entry.paragraph for entry in self.entries if not containers or entry.container in containers]
@@ -1,59 +1,87 @@
 import docx
-from docx.shared import RGBColor, Pt, Inches
+from docx.shared import RGBColor, Inches
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
 import re
-from transformers import BertTokenizer, BertForSequenceClassification
-import torch
-
-# Load BERT model for title detection
-tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-model = BertForSequenceClassification.from_pretrained("bert-base-uncased", num_labels=2)
+import title_classifier
+import title_heuristics
+from element_index import ElementIndex
+from fragment_cache import Fragments
+from instrumentation import span
+from package_writer import save_document
+from run_coalescing import coalesce_document
+from run_templates import KEEP_ON, run_template
+from style_rules import DocumentStyles, Rule, StyleRules, format_document
+from itertools import islice
+
+# Default output file when format_docx is not given an output target
+OUTPUT_FILENAME = "formatted_document_with_textbox.docx"
 
 # Function to apply formatting
 def apply_formatting(paragraph, font_size=12, is_heading=False, bold=False, italic=False, no_indent=False):
-    for run in paragraph.runs:
-        font = run.font
-        font.name = 'Palatino Linotype'
-        font.size = Pt(font_size)
-        font.color.rgb = RGBColor(0, 0, 0)
-        if run.bold:
-            font.bold = True
-        else:
-            font.bold = bold
-        font.italic = italic
+    # Runs that are bold in the input stay bold; headings are bold throughout
+    template = run_template('Palatino Linotype', font_size, bold=True if bold or is_heading else KEEP_ON,
+                            italic=italic, color=RGBColor(0, 0, 0))
+    template.apply_to_paragraph(paragraph)
 
     paragraph.paragraph_format.left_indent = None if no_indent else Inches(2.0)
     paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.JUSTIFY
 
-    if is_heading:
-        for run in paragraph.runs:
-            run.font.bold = True
-
 # Function to detect decimal-based headings
 def is_decimal_heading(text):
     return re.match(r'^\d+(\.\d+)+$', text.strip()) is not None
 
 # Function to identify title from style
-def identify_title_from_style(doc):
+def identify_title_from_style(doc, styles):
     for para in doc.paragraphs:
-        if "title" in para.style.name.lower():
+        if "title" in styles.lower_name(para):
             return para.text.strip()
     return None
 
+# Function to identify title from its layout (size, emphasis and position)
+def identify_title_from_layout(doc):
+    return title_heuristics.identify_title(title_heuristics.leading_paragraphs(doc.paragraphs), doc.styles.element)
+
 # Function to identify title using BERT
 def identify_title_with_bert(doc):
-    text_data = [para.text.strip() for para in doc.paragraphs if para.text.strip()]
-    inputs = tokenizer(text_data, padding=True, truncation=True, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model(**inputs).logits
-    predicted_label = torch.argmax(outputs, dim=1).tolist()
-    
-    for i, label in enumerate(predicted_label):
-        if label == 1:
-            return text_data[i]
-    return None
+    texts = (para.text.strip() for para in doc.paragraphs)
+    text_data = list(islice((text for text in texts if text), title_classifier.MAX_PARAGRAPHS))
+    return title_classifier.identify_title(text_data)
+
+# Section types by style name, checked in order after the detected title
+SECTION_RULES = StyleRules([
+    Rule("author", contains=["author"]),
+    Rule("subtitle", contains=["subtitle", "article"]),
+    Rule("heading1", prefixes=["Heading 1"]),
+    Rule("heading2", prefixes=["Heading 2"]),
+])
+
+# Formatting applied to each section type
+SECTION_FORMATS = {
+    "title": dict(font_size=18, bold=True, no_indent=True),
+    "author": dict(font_size=10, bold=True, no_indent=True),
+    "subtitle": dict(font_size=10, italic=True, no_indent=True),
+    "heading1": dict(font_size=12, is_heading=True),
+    "heading2": dict(font_size=12, is_heading=True),
+    "body": dict(font_size=10),
+}
+
+# Font for paragraphs in tables, text boxes, headers, footers and notes
+CONTAINER_FONT = dict(font_name="Palatino Linotype", font_size=10)
+
+# Formatted paragraphs reused from earlier revisions of the same paper
+FRAGMENTS = Fragments("style_1")
+
+# Function to identify section types (``title`` is the text of the detected title)
+def identify_section(paragraph, styles, title):
+    text = paragraph.text.strip()
+    if text == title:
+        return "title"
+    section_type = styles.section(paragraph)
+    if section_type == "body" and is_decimal_heading(text):
+        return "heading2"
+    return section_type
 
 # Function to format references section
 def format_references_section(doc):
@@ -67,54 +95,54 @@ def format_references_section(doc):
             apply_formatting(para, font_size=10, bold=True)
 
 # Function to format reference items
-def format_reference_items(doc):
+def format_reference_items(doc, styles):
     for para in doc.paragraphs:
-        if "referenceitem" in para.style.name.lower():
+        if "referenceitem" in styles.lower_name(para):
             apply_formatting(para, font_size=10, italic=False, bold=False)
 
 # Function to format DOCX file
-def format_docx(file_path):
-    doc = docx.Document(file_path)
+def format_docx(file_path, output=None):
+    with span("open"):
+        doc = docx.Document(file_path)
+    with span("coalesce_runs"):
+        coalesce_document(doc)
+    styles = DocumentStyles(doc.styles, SECTION_RULES)
+    index = ElementIndex(doc)
 
     # Step 1: Identify title
-    global detected_title
-    detected_title = identify_title_from_style(doc)
-    if not detected_title:
-        detected_title = identify_title_with_bert(doc)
-
-    for para in doc.paragraphs:
-        text = para.text.strip()
-
-        if text == detected_title:
-            apply_formatting(para, font_size=18, bold=True, no_indent=True)
-        elif 'author' in para.style.name.lower():
-            apply_formatting(para, font_size=10, bold=True, no_indent=True)
-        elif 'subtitle' in para.style.name.lower() or 'article' in para.style.name.lower():
-            apply_formatting(para, font_size=10, italic=True, no_indent=True)
-        elif para.style.name.startswith('Heading 1'):
-            apply_formatting(para, font_size=12, is_heading=True)
-        elif para.style.name.startswith('Heading 2') or is_decimal_heading(text):
-            apply_formatting(para, font_size=12, is_heading=True)
-        else:
-            apply_formatting(para, font_size=10)
-
-    format_references_section(doc)
-    format_reference_items(doc)
-
-    for section in doc.sections:
-        section.different_first_page_header_footer = True
-        section.header.is_linked_to_previous = False
-
-        # Remove header content (no image upload)
-        first_page_header = section.first_page_header
-        for para in first_page_header.paragraphs:
-            first_page_header._element.remove(para._element)  # Remove any existing text in header
-
-        # Ensure only the footer is retained
-        standard_header = section.header
-        for para in standard_header.paragraphs:
-            standard_header._element.remove(para._element)
-
-    output_filename = "formatted_document_with_textbox.docx"
-    doc.save(output_filename)
-    return output_filename
+    with span("title_detection"):
+        title = identify_title_from_style(doc, styles)
+        if not title:
+            title = identify_title_from_layout(doc)
+        if not title:
+            title = identify_title_with_bert(doc)
+
+    # Step 2: Apply formatting rules
+    with span("format_paragraphs"):
+        format_document(index, lambda para: identify_section(para, styles, title), SECTION_FORMATS,
+                        apply_formatting, container_font=CONTAINER_FONT, fragments=FRAGMENTS)
+
+    with span("format_references"):
+        format_references_section(doc)
+        format_reference_items(doc, styles)
+
+    with span("header_footer"):
+        for section in doc.sections:
+            section.different_first_page_header_footer = True
+            section.header.is_linked_to_previous = False
+
+            # Remove header content (no image upload)
+            first_page_header = section.first_page_header
+            for para in first_page_header.paragraphs:
+                first_page_header._element.remove(para._element)  # Remove any existing text in header
+
+            # Ensure only the footer is retained
+            standard_header = section.header
+            for para in standard_header.paragraphs:
+                standard_header._element.remove(para._element)
+
+    if output is None:
+        output = OUTPUT_FILENAME
+    with span("save"):
+        save_document(doc, output, file_path)
+    return output
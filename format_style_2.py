@@ -1,9 +1,19 @@
 import docx
-from docx.shared import Pt, Inches, RGBColor
+from docx.shared import Inches, RGBColor
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.section import WD_SECTION_START
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from element_index import ElementIndex
+from fragment_cache import Fragments
+from instrumentation import span
+from package_writer import save_document
+from run_coalescing import coalesce_document
+from run_templates import KEEP, run_template
+from style_rules import DocumentStyles, Rule, StyleRules, format_document
+
+# Default output file when format_docx is not given an output target
+OUTPUT_FILENAME = "formatted_document.docx"
 
 # Function to add a border line below the text (no top border for the header)
 def add_borders(paragraph, add_top_border=False):
@@ -33,13 +43,9 @@ def add_borders(paragraph, add_top_border=False):
 # Function to apply formatting to text
 def apply_formatting(paragraph, font_size, bold=False, alignment=None, no_indent=False):
     """Applies formatting to the paragraph."""
-    for run in paragraph.runs:
-        font = run.font
-        font.name = "Palatino Linotype"
-        font.size = Pt(font_size)
-        font.color.rgb = RGBColor(0, 0, 0)  # Black color for headings, title, etc
-        if bold or run.bold:
-            font.bold = True
+    # Black for headings, title, etc; runs that are bold in the input stay bold
+    template = run_template("Palatino Linotype", font_size, bold=True if bold else KEEP, color=RGBColor(0, 0, 0))
+    template.apply_to_paragraph(paragraph)
     paragraph.alignment = alignment if alignment else WD_PARAGRAPH_ALIGNMENT.JUSTIFY
 
     if no_indent:
@@ -47,6 +53,36 @@ def apply_formatting(paragraph, font_size, bold=False, alignment=None, no_indent
     else:
         paragraph.paragraph_format.left_indent = Inches(0.5)
 
+# Section types by style name, checked in order
+SECTION_RULES = StyleRules([
+    Rule("title", contains=["title"]),
+    Rule("author", contains=["author"]),
+    Rule("heading", prefixes=["Heading"]),
+])
+
+# Formatting applied to each section type
+SECTION_FORMATS = {
+    "title": dict(font_size=18, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER, no_indent=False),
+    "author": dict(font_size=10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT, no_indent=False),
+    "heading": dict(font_size=12, bold=True),
+    "body": dict(font_size=10, bold=False),
+}
+
+# Font for paragraphs in tables, text boxes, headers, footers and notes
+CONTAINER_FONT = dict(font_name="Palatino Linotype", font_size=10)
+
+# Formatted paragraphs reused from earlier revisions of the same paper
+FRAGMENTS = Fragments("style_2")
+
+# Add borders only to title (including bottom and optional top border)
+SECTION_HOOKS = {
+    "title": lambda paragraph: add_borders(paragraph, add_top_border=True),
+}
+
+# Function to identify sections based on style
+def identify_section(paragraph, styles):
+    return styles.section(paragraph)
+
 # Function to adjust images based on width
 def adjust_image(image, column_width=3.4, small_dims=(3, 2.1), large_dims=(6.5, 3)):
     if image.width > Inches(column_width):
@@ -69,81 +105,78 @@ def adjust_table(table, column_width=3.4):
     table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER  # Center align the table
 
 # Function to format the document
-def format_docx(file_path):
-    doc = docx.Document(file_path)
+def format_docx(file_path, output=None):
+    with span("open"):
+        doc = docx.Document(file_path)
+    with span("coalesce_runs"):
+        coalesce_document(doc)
+    styles = DocumentStyles(doc.styles, SECTION_RULES)
+    index = ElementIndex(doc)
     
     # Set up sections and columns
-    for section in doc.sections:
-        section.different_first_page_header_footer = True
+    written = set()  # the header and footer paragraphs written here, which keep their own format
+    with span("section_setup"):
+        for section in doc.sections:
+            section.different_first_page_header_footer = True
         
-        # Set two equal columns
-        section.start_type = WD_SECTION_START.NEW_PAGE
-        section.left_margin = Inches(0.5)
-        section.right_margin = Inches(0.5)
-        section.top_margin = Inches(1)
-        section.bottom_margin = Inches(1)
+            # Set two equal columns
+            section.start_type = WD_SECTION_START.NEW_PAGE
+            section.left_margin = Inches(0.5)
+            section.right_margin = Inches(0.5)
+            section.top_margin = Inches(1)
+            section.bottom_margin = Inches(1)
         
-        # Add two equal columns
-        columns = section._sectPr.xpath('./w:cols')[0]
-        columns.set(qn('w:num'), '2')
-        columns.set(qn('w:space'), '120')
-
-        # First page: blank header
-        first_page_header = section.first_page_header
-        first_page_header.paragraphs.clear()
+            # Add two equal columns
+            columns = section._sectPr.xpath('./w:cols')[0]
+            columns.set(qn('w:num'), '2')
+            columns.set(qn('w:space'), '120')
+
+            # First page: blank header
+            first_page_header = section.first_page_header
+            first_page_header.paragraphs.clear()
         
-        # Subsequent pages: add header and footer
-        if section.header.is_linked_to_previous:
-            section.header.is_linked_to_previous = False
-
-        # Add SmartCity to header
-        header = section.header
-        header_para = header.paragraphs[0] if header.paragraphs else header.add_paragraph()
-        header_para.text = "SmartCity"
-        apply_formatting(header_para, font_size=12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        # Do not add border to header
-        add_borders(header_para, add_top_border=False)
-
-        # Add footer with centered page numbers
-        footer = section.footer
-        footer_para = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
-        footer_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-        fldSimple = OxmlElement('w:fldSimple')
-        fldSimple.set(qn('w:instr'), "PAGE")
-        footer_para._element.append(fldSimple)
+            # Subsequent pages: add header and footer
+            if section.header.is_linked_to_previous:
+                section.header.is_linked_to_previous = False
+
+            # Add SmartCity to header
+            header = section.header
+            header_para = header.paragraphs[0] if header.paragraphs else header.add_paragraph()
+            header_para.text = "SmartCity"
+            apply_formatting(header_para, font_size=12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
+            # Do not add border to header
+            add_borders(header_para, add_top_border=False)
+            written.add(header_para._p)
+
+            # Add footer with centered page numbers
+            footer = section.footer
+            footer_para = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
+            footer_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+            fldSimple = OxmlElement('w:fldSimple')
+            fldSimple.set(qn('w:instr'), "PAGE")
+            footer_para._element.append(fldSimple)
+            written.add(footer_para._p)
 
     # Format content
-    for para in doc.paragraphs:
-        text = para.text.strip().lower()
-        
-        # Title formatting
-        if "title" in para.style.name.lower():
-            apply_formatting(para, font_size=18, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER, no_indent=False)
-            # Add borders only to title (including bottom and optional top border)
-            add_borders(para, add_top_border=True)
-        
-        # Author formatting
-        elif "author" in para.style.name.lower():
-            apply_formatting(para, font_size=10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT, no_indent=False)
-        
-        # Headings formatting
-        elif para.style.name.startswith("Heading"):
-            apply_formatting(para, font_size=12, bold=True)
-
-        # Content formatting
-        else:
-            apply_formatting(para, font_size=10, bold=False)
+    with span("format_paragraphs"):
+        entries = [entry for entry in index if entry.paragraph._p not in written]
+        format_document(entries, lambda para: identify_section(para, styles), SECTION_FORMATS,
+                        apply_formatting, SECTION_HOOKS, CONTAINER_FONT, FRAGMENTS)
 
     # Adjust images
-    for shape in doc.inline_shapes:
-        adjust_image(shape)
+    with span("adjust_images"):
+        for shape in doc.inline_shapes:
+            adjust_image(shape)
 
     # Adjust tables
-    for table in doc.tables:
-        adjust_table(table)
+    with span("adjust_tables"):
+        for table in doc.tables:
+            adjust_table(table)
 
     # Save the formatted document
-    output_filename = "formatted_document.docx"
-    doc.save(output_filename)
-    return output_filename
+    if output is None:
+        output = OUTPUT_FILENAME
+    with span("save"):
+        save_document(doc, output, file_path)
+    return output
 
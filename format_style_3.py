@@ -1,132 +1,165 @@
 import docx
-from docx.shared import Pt, RGBColor
+from docx.shared import RGBColor
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.section import WD_SECTION_START
-from transformers import BertTokenizer, BertForSequenceClassification
-import torch
+import title_classifier
+import title_heuristics
+from itertools import islice
+from element_index import ElementIndex
+from fragment_cache import Fragments
+from instrumentation import span
+from package_writer import save_document
+from run_coalescing import coalesce_document
+from run_templates import run_template
+from restyle import restyle_document
+from streaming_docx import StreamingDocument
+from style_rules import DocumentStyles, Rule, StyleRules, format_document, format_entry
 from docx.oxml.ns import qn
 
-# Load BERT model for title identification
-tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-model = BertForSequenceClassification.from_pretrained("bert-base-uncased", num_labels=2)
+# Default output file when format_docx is not given an output target
+OUTPUT_FILENAME = "formatted_document.docx"
 
 # Function to check if paragraph contains title
-def identify_title_from_style(doc):
+def identify_title_from_style(doc, styles):
     for para in doc.paragraphs:
-        if "title" in para.style.name.lower():
+        if "title" in styles.lower_name(para):
             return para.text.strip()
     return None  # Return None if no title found
 
+# Function to identify title from its layout (size, emphasis and position)
+def identify_title_from_layout(doc):
+    return title_heuristics.identify_title(title_heuristics.leading_paragraphs(doc.paragraphs), doc.styles.element)
+
 # Function to identify title using BERT
 def identify_title_with_bert(doc):
-    text_data = [para.text.strip() for para in doc.paragraphs if para.text.strip()]
-    inputs = tokenizer(text_data, padding=True, truncation=True, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model(**inputs).logits
-    predicted_label = torch.argmax(outputs, dim=1).tolist()
-    
-    # Assume the first predicted "title" is correct
-    for i, label in enumerate(predicted_label):
-        if label == 1:  # Title detected by BERT
-            return text_data[i]
-    return None  # No title detected
+    texts = (para.text.strip() for para in doc.paragraphs)
+    text_data = list(islice((text for text in texts if text), title_classifier.MAX_PARAGRAPHS))
+    return title_classifier.identify_title(text_data)
 
 # Function to format text
 def apply_formatting(paragraph, font_name, font_size, bold=False, italic=False, alignment=None):
-    for run in paragraph.runs:
-        font = run.font
-        font.name = font_name
-        font.size = Pt(font_size)
-        font.bold = bold
-        font.italic = italic
-        font.color.rgb = RGBColor(0, 0, 0)
+    run_template(font_name, font_size, bold=bold, italic=italic, color=RGBColor(0, 0, 0)).apply_to_paragraph(paragraph)
 
     if alignment:
         paragraph.alignment = alignment
 
-# Function to identify section types
-def identify_section(paragraph):
-    text = paragraph.text.strip()
-    style_name = paragraph.style.name.lower()
-
-    if text == detected_title:
-        return "title"
-    elif "author" in style_name:
-        return "author"
-    elif "address" in style_name:
-        return "address"
-    elif "email" in style_name:
-        return "email"
-    elif "heading 1" in style_name:
-        return "heading1"
-    elif "heading 2" in style_name:
-        return "heading2"
-    elif "heading 3" in style_name:
-        return "heading3"
-    elif "heading 4" in style_name:
-        return "heading4"
-    elif "abstract" in style_name:
-        return "abstract"
-    elif "referenceitem" in style_name:
-        return "referenceitem"
-    elif "reference" in style_name or "Reference" in style_name:
-        return "reference"
-    return "body"
+# Section types by style name, checked in order after the detected title
+SECTION_RULES = StyleRules([
+    Rule("author", contains=["author"]),
+    Rule("address", contains=["address"]),
+    Rule("email", contains=["email"]),
+    Rule("heading1", contains=["heading 1"]),
+    Rule("heading2", contains=["heading 2"]),
+    Rule("heading3", contains=["heading 3"]),
+    Rule("heading4", contains=["heading 4"]),
+    Rule("abstract", contains=["abstract"]),
+    Rule("referenceitem", contains=["referenceitem"]),
+    Rule("reference", contains=["reference"]),
+])
 
-# Function to format the DOCX file
-def format_docx(file_path):
-    doc = docx.Document(file_path)
+# Formatting applied to each section type
+SECTION_FORMATS = {
+    "title": dict(font_name="Times New Roman", font_size=19, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "author": dict(font_name="Times New Roman", font_size=11, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "address": dict(font_name="Times New Roman", font_size=9, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "email": dict(font_name="Courier", font_size=9, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "heading1": dict(font_name="Times New Roman", font_size=12, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading2": dict(font_name="Times New Roman", font_size=10, bold=False, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading3": dict(font_name="Times New Roman", font_size=10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading4": dict(font_name="Times New Roman", font_size=10, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "abstract": dict(font_name="Times New Roman", font_size=9, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY),
+    "referenceitem": dict(font_name="Times New Roman", font_size=10, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "reference": dict(font_name="Times New Roman", font_size=10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "body": dict(font_name="Times New Roman", font_size=10, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY),
+}
 
-    # Step 1: Try to identify title from style
-    global detected_title
-    detected_title = identify_title_from_style(doc)
+# Font for paragraphs in tables, text boxes, headers, footers and notes
+CONTAINER_FONT = dict(font_name="Times New Roman", font_size=10)
 
-    # Step 2: If no title found, use BERT model
-    if not detected_title:
-        detected_title = identify_title_with_bert(doc)
+# Formatted paragraphs reused from earlier revisions of the same paper
+FRAGMENTS = Fragments("style_3")
 
-    # Step 3: Apply formatting rules
-    for para in doc.paragraphs:
-        section_type = identify_section(para)
-
-        if section_type == "title":
-            apply_formatting(para, "Times New Roman", 19, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "author":
-            apply_formatting(para, "Times New Roman", 11, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "address":
-            apply_formatting(para, "Times New Roman", 9, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "email":
-            apply_formatting(para, "Courier", 9, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "heading1":
-            apply_formatting(para, "Times New Roman", 12, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading2":
-            apply_formatting(para, "Times New Roman", 10, bold=False, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading3":
-            apply_formatting(para, "Times New Roman", 10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading4":
-            apply_formatting(para, "Times New Roman", 10, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "abstract":
-            apply_formatting(para, "Times New Roman", 9, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
-        elif section_type == "referenceitem":
-            apply_formatting(para, "Times New Roman", 10, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "reference":
-            apply_formatting(para, "Times New Roman", 10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        else:
-            apply_formatting(para, "Times New Roman", 10, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
+# Function to identify section types (``title`` is the text of the detected title)
+def identify_section(paragraph, styles, title):
+    if paragraph.text.strip() == title:
+        return "title"
+    return styles.section(paragraph)
 
-    # Set the document layout to two columns with increased space between them
-    section = doc.sections[0]
+# Function to set the document layout to two columns with increased space between them
+def set_page_layout(section):
     section.left_margin = docx.shared.Inches(0.5)
     section.right_margin = docx.shared.Inches(0.5)
     section.top_margin = docx.shared.Inches(1)
     section.bottom_margin = docx.shared.Inches(1)
-    
+
     # Set two equal columns with more space
     columns = section._sectPr.xpath('./w:cols')[0]
     columns.set(qn('w:num'), '2')  # Two columns
     columns.set(qn('w:space'), '200')  # Increased space between columns
 
+# Function to format the DOCX file
+def format_docx(file_path, output=None, restyle=False):
+    """With ``restyle``, body paragraphs are formatted through their paragraph styles (see restyle.py)."""
+    with span("open"):
+        doc = docx.Document(file_path)
+    with span("coalesce_runs"):
+        coalesce_document(doc)
+    styles = DocumentStyles(doc.styles, SECTION_RULES)
+    index = ElementIndex(doc)
+
+    # Step 1: Try to identify title from style
+    with span("title_detection"):
+        title = identify_title_from_style(doc, styles)
+
+        # Step 2: If no title found, try the layout of the leading paragraphs, then the BERT model
+        if not title:
+            title = identify_title_from_layout(doc)
+        if not title:
+            title = identify_title_with_bert(doc)
+
+    # Step 3: Apply formatting rules
+    with span("format_paragraphs"):
+        if restyle:
+            restyle_document(doc, index, styles, lambda para: identify_section(para, styles, title),
+                             SECTION_FORMATS, apply_formatting, CONTAINER_FONT)
+        else:
+            format_document(index, lambda para: identify_section(para, styles, title), SECTION_FORMATS,
+                            apply_formatting, container_font=CONTAINER_FONT, fragments=FRAGMENTS)
+
+    # Set the document layout to two columns with increased space between them
+    with span("page_layout"):
+        set_page_layout(doc.sections[0])
+
     # Save the formatted document
-    output_filename = "formatted_document.docx"
-    doc.save(output_filename)
-    return output_filename
+    if output is None:
+        output = OUTPUT_FILENAME
+    with span("save"):
+        save_document(doc, output, file_path)
+    return output
+
+# Function to format the DOCX file without loading it whole (for very large documents)
+def format_docx_streaming(file_path, output=None):
+    """Same result as format_docx, streaming the document body through StreamingDocument."""
+    if output is None:
+        output = OUTPUT_FILENAME
+    with StreamingDocument(file_path, SECTION_RULES) as source:
+        styles = source.styles
+        with span("title_detection"):
+            title, leading = source.find_title(title_classifier.MAX_PARAGRAPHS)
+            if not title:
+                title = title_heuristics.identify_title(leading, source.styles_element)
+            if not title:
+                title = title_classifier.identify_title([para.text.strip() for para in leading])
+
+        def format_section(section, index):
+            if index == 0:
+                set_page_layout(section)
+
+        with span("stream_rewrite"):
+            source.rewrite(
+                output,
+                lambda entry: format_entry(entry, lambda p: identify_section(p, styles, title), SECTION_FORMATS,
+                                           apply_formatting, container_font=CONTAINER_FONT, fragments=FRAGMENTS),
+                format_section,
+            )
+    return output
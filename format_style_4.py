@@ -1,91 +1,124 @@
 import docx
-from docx.shared import Pt, RGBColor, Inches
+from docx.shared import RGBColor, Inches
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.section import WD_SECTION_START
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from element_index import ElementIndex
+from fragment_cache import Fragments
+from instrumentation import span
+from package_writer import save_document
+from run_coalescing import coalesce_document
+from run_templates import run_template
+from restyle import restyle_document
+from streaming_docx import StreamingDocument
+from style_rules import DocumentStyles, Rule, StyleRules, format_document, format_entry
+
+# Default output file when format_docx is not given an output target
+OUTPUT_FILENAME = "formatted_document.docx"
 
 # Function to apply formatting
 def apply_formatting(paragraph, font_name, font_size, bold=False, italic=False, alignment=None):
     """Applies formatting to the paragraph."""
-    for run in paragraph.runs:
-        font = run.font
-        font.name = font_name
-        font.size = Pt(font_size)
-        font.bold = bold
-        font.italic = italic
-        font.color.rgb = RGBColor(0, 0, 0)  # Black text
-
-        # If the run itself is bold (from the input), we should preserve it
-        if run.bold:
-            font.bold = True
+    # Black text
+    run_template(font_name, font_size, bold=bold, italic=italic, color=RGBColor(0, 0, 0)).apply_to_paragraph(paragraph)
 
     if alignment:
         paragraph.alignment = alignment
 
+# Section types by style name from the input DOCX, checked in order
+SECTION_RULES = StyleRules([
+    Rule("title", contains=["title"]),
+    Rule("author", contains=["author"]),
+    Rule("heading", contains=["heading 1"]),
+    Rule("subheading", contains=["heading 2", "heading 3", "heading 4", "heading 5"]),
+    Rule("affiliation", contains=["affiliation"]),
+    Rule("history", contains=["history"]),
+])
+
+# Formatting applied to each section type
+SECTION_FORMATS = {
+    "title": dict(font_name="Times New Roman", font_size=18, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "author": dict(font_name="Times New Roman", font_size=10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "heading": dict(font_name="Times New Roman", font_size=12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "subheading": dict(font_name="Times New Roman", font_size=12, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "affiliation": dict(font_name="Times New Roman", font_size=8, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    # Check if bold is applied in the input, and preserve it
+    "history": lambda para: dict(font_name="Times New Roman", font_size=8, bold=any(run.bold for run in para.runs),
+                                 alignment=WD_PARAGRAPH_ALIGNMENT.CENTER),
+    "body": dict(font_name="Times New Roman", font_size=10, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY),
+}
+
+# Font for paragraphs in tables, text boxes, headers, footers and notes
+CONTAINER_FONT = dict(font_name="Times New Roman", font_size=10)
+
+# Formatted paragraphs reused from earlier revisions of the same paper
+FRAGMENTS = Fragments("style_4")
+
 # Function to identify sections based on style from input DOCX
-def identify_section(paragraph):
+def identify_section(paragraph, styles):
     """Identifies the section type based on the style name from the input document."""
-    style_name = paragraph.style.name.lower()
+    return styles.section(paragraph)
+
+# Function to set up a two-column layout (except for the first page)
+def set_page_layout(section, index=None):
+    section.start_type = WD_SECTION_START.NEW_PAGE
+    section.left_margin = Inches(0.5)
+    section.right_margin = Inches(0.5)
+    section.top_margin = Inches(1)
+    section.bottom_margin = Inches(1)
 
-    if "title" in style_name:
-        return "title"
-    elif "author" in style_name:
-        return "author"
-    elif "heading 1" in style_name:
-        return "heading"
-    elif "heading 2" in style_name or "heading 3" in style_name or "heading 4" in style_name or "heading 5" in style_name:
-        return "subheading"
-    elif "affiliation" in style_name:
-        return "affiliation"
-    elif "history" in style_name:
-        return "history"
-    return "body"
+    # Set two equal columns (excluding the title page)
+    sectPr = section._sectPr
+    cols = OxmlElement('w:cols')
+    cols.set(qn('w:num'), '2')
+    cols.set(qn('w:space'), '720')  # Adjust spacing between columns
+    sectPr.append(cols)
 
 # Function to format the document
-def format_docx(file_path):
-    doc = docx.Document(file_path)
+def format_docx(file_path, output=None, restyle=False):
+    """With ``restyle``, body paragraphs are formatted through their paragraph styles (see restyle.py)."""
+    with span("open"):
+        doc = docx.Document(file_path)
+    with span("coalesce_runs"):
+        coalesce_document(doc)
+    styles = DocumentStyles(doc.styles, SECTION_RULES)
+    index = ElementIndex(doc)
     
     # Set up two-column layout (except for the first page)
-    for section in doc.sections:
-        section.start_type = WD_SECTION_START.NEW_PAGE
-        section.left_margin = Inches(0.5)
-        section.right_margin = Inches(0.5)
-        section.top_margin = Inches(1)
-        section.bottom_margin = Inches(1)
-        
-        # Set two equal columns (excluding the title page)
-        sectPr = section._sectPr
-        cols = OxmlElement('w:cols')
-        cols.set(qn('w:num'), '2')
-        cols.set(qn('w:space'), '720')  # Adjust spacing between columns
-        sectPr.append(cols)
+    with span("page_layout"):
+        for section in doc.sections:
+            set_page_layout(section)
     
     # Format content dynamically based on styles
-    for para in doc.paragraphs:
-        section_type = identify_section(para)
-        
-        if section_type == "title":
-            apply_formatting(para, "Times New Roman", 18, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "author":
-            apply_formatting(para, "Times New Roman", 10, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "heading":
-            apply_formatting(para, "Times New Roman", 12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "subheading":
-            apply_formatting(para, "Times New Roman", 12, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "affiliation":
-            # # Check if bold is applied in the input, and preserve it
-            # is_bold = any(run.bold for run in para.runs)
-            apply_formatting(para, "Times New Roman", 8, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
-        elif section_type == "history":
-            # Check if bold is applied in the input, and preserve it
-            is_bold = any(run.bold for run in para.runs)
-            apply_formatting(para, "Times New Roman", 8, bold=is_bold, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER)
+    with span("format_paragraphs"):
+        if restyle:
+            restyle_document(doc, index, styles, lambda para: identify_section(para, styles), SECTION_FORMATS,
+                             apply_formatting, CONTAINER_FONT)
         else:
-            apply_formatting(para, "Times New Roman", 10, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
-    
+            format_document(index, lambda para: identify_section(para, styles), SECTION_FORMATS, apply_formatting,
+                            container_font=CONTAINER_FONT, fragments=FRAGMENTS)
+
     # Save formatted document
-    output_filename = "formatted_document.docx"
-    doc.save(output_filename)
-    return output_filename
+    if output is None:
+        output = OUTPUT_FILENAME
+    with span("save"):
+        save_document(doc, output, file_path)
+    return output
+
 
+# Function to format the document without loading it whole (for very large documents)
+def format_docx_streaming(file_path, output=None):
+    """Same result as format_docx, streaming the document body through StreamingDocument."""
+    if output is None:
+        output = OUTPUT_FILENAME
+    with StreamingDocument(file_path, SECTION_RULES) as source:
+        styles = source.styles
+        with span("stream_rewrite"):
+            source.rewrite(
+                output,
+                lambda entry: format_entry(entry, lambda p: identify_section(p, styles), SECTION_FORMATS, apply_formatting,
+                                           container_font=CONTAINER_FONT, fragments=FRAGMENTS),
+                set_page_layout,
+            )
+    return output
@@ -6,8 +6,30 @@ from docx.oxml.ns import qn, nsdecls
 from docx.oxml import parse_xml
 from lxml import etree
 from docx.oxml import OxmlElement
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from docx.table import Table
+from docx.oxml.table import CT_Tbl
 from docx.enum.text import WD_TAB_ALIGNMENT
+import functools
+import logging
 import re
+from collections import namedtuple
+from copy import deepcopy
+from paragraph_walker import ParagraphWalker
+from element_index import BODY, ElementIndex
+from instrumentation import span
+from package_writer import save_document
+from run_coalescing import coalesce_document
+from run_templates import KEEP, run_template
+from style_rules import DocumentStyles, Rule, StyleRules, apply_container_font
+from image_assets import add_picture, load_image
+from structured_logging import excerpt
+
+logger = logging.getLogger(__name__)
+
+# Default output file when format_docx is not given an output target
+OUTPUT_FILENAME = "formated.docx"
 
 # Function to apply formatting
 def apply_formatting(paragraph, font_name, font_size, bold=False, italic=False, underline=False, alignment=None):
@@ -29,15 +51,10 @@ def apply_formatting(paragraph, font_name, font_size, bold=False, italic=False,
     if alignment is not None:
         paragraph.alignment = alignment
 
-    # Apply run formatting
-    for run in paragraph.runs:
-        font = run.font
-        font.name = font_name
-        font.size = Pt(font_size)
-        font.bold = bold if bold else run.bold  # Preserve existing bold if not overridden
-        font.italic = italic
-        font.underline = underline
-        font.color.rgb = RGBColor(0, 0, 0)  # Black text
+    # Apply run formatting in black, preserving existing bold if not overridden
+    template = run_template(font_name, font_size, bold=True if bold else KEEP, italic=italic, underline=underline,
+                            color=RGBColor(0, 0, 0))
+    template.apply_to_paragraph(paragraph)
 
 # Function to set page margins and size
 def set_page_layout(doc):
@@ -76,8 +93,77 @@ def clear_header(header):
     header.paragraphs.clear()
     header.tables.clear()
 
-def add_header_footer(doc):
+# Header and footer contents of a journal; image paths are relative to the repository
+class Journal(namedtuple("Journal", "left_image right_image footer_image name year volume issue copyright")):
+    __slots__ = ()
+
+    @property
+    def running_head(self):
+        return "%s %s;%s(%s)" % (self.name, self.year, self.volume, self.issue)
+
+JOURNALS = {
+    "cmc": Journal(
+        left_image="images/left_image.jpg",
+        right_image="images/right_image.jpg",
+        footer_image="images/footer_image.jpg",
+        name="Comput Mater Contin.",
+        year="2025",
+        volume="volume",
+        issue="issue",
+        copyright=(
+            "Copyright © 2025 The Author(s). Published by Tech Science Press. "
+            "This work is licensed under a Creative Commons Attribution 4.0 International License."
+        ),
+    ),
+}
+DEFAULT_JOURNAL = "cmc"
+
+def add_page_field(run):
+    """Appends a PAGE field to a run."""
+    fld_char_begin = OxmlElement('w:fldChar')
+    fld_char_begin.set(qn('w:fldCharType'), 'begin')
+    run._r.append(fld_char_begin)
+    instr_text = OxmlElement('w:instrText')
+    instr_text.text = ' PAGE '
+    instr_text.set(qn('xml:space'), 'preserve')
+    run._r.append(instr_text)
+    fld_char_end = OxmlElement('w:fldChar')
+    fld_char_end.set(qn('w:fldCharType'), 'end')
+    run._r.append(fld_char_end)
+
+# Function to build a running header table: the page number on one side, the journal on the other
+def build_running_header(journal, page_number_left):
+    table = Table(CT_Tbl.new_tbl(1, 2, Cm(16.50)), None)
+    table.autofit = False
+    table.columns[0].width = Cm(10.795)
+    table.columns[1].width = Cm(10.795)
+    page_cell, journal_cell = table.cell(0, 0), table.cell(0, 1)
+    if not page_number_left:
+        page_cell, journal_cell = journal_cell, page_cell
+    page_paragraph = page_cell.paragraphs[0]
+    add_page_field(page_paragraph.add_run())
+    journal_paragraph = journal_cell.paragraphs[0]
+    journal_run = journal_paragraph.add_run(journal.running_head)
+    journal_run.font.size = Cm(0.35)  # Match your original size
+    table.cell(0, 0).paragraphs[0].alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+    table.cell(0, 1).paragraphs[0].alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    return table._tbl
+
+@functools.lru_cache(maxsize=None)
+def running_header_templates(journal):
+    """The (even page, odd page) header tables of a journal, built once and cloned per section."""
+    return build_running_header(journal, True), build_running_header(journal, False)
+
+# Function to load a journal's header/footer images and templates once per process
+def preload_journal(journal=None):
+    journal = JOURNALS[journal or DEFAULT_JOURNAL]
+    for path in (journal.left_image, journal.right_image, journal.footer_image):
+        load_image(path)
+    running_header_templates(journal)
+
+def add_header_footer(doc, journal=None):
     """Applies headers: images on page 1, even/odd headers with continuous numbering from page 2 onward."""
+    journal = JOURNALS[journal or DEFAULT_JOURNAL]
     # Ensure at least two pages for testing (unchanged from original)
     if len(doc.paragraphs) < 2:
         doc.add_page_break()
@@ -110,12 +196,12 @@ def add_header_footer(doc):
             left_cell = table.cell(0, 0)
             left_paragraph = left_cell.paragraphs[0]
             left_run = left_paragraph.add_run()
-            left_run.add_picture("images/left_image.jpg", width=Cm(3))
+            add_picture(left_run, load_image(journal.left_image), width=Cm(3))
             left_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
             right_cell = table.cell(0, 1)
             right_paragraph = right_cell.paragraphs[0]
             right_run = right_paragraph.add_run()
-            right_run.add_picture("images/right_image.jpg", width=Cm(3))
+            add_picture(right_run, load_image(journal.right_image), width=Cm(3))
             right_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
 
             # Footer (unchanged)
@@ -128,14 +214,11 @@ def add_header_footer(doc):
             left_cell = table.cell(0, 0)
             left_paragraph = left_cell.paragraphs[0]
             left_run = left_paragraph.add_run()
-            left_run.add_picture("images/footer_image.jpg", width=Cm(3))
+            add_picture(left_run, load_image(journal.footer_image), width=Cm(3))
             left_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
             right_cell = table.cell(0, 1)
             right_paragraph = right_cell.paragraphs[0]
-            right_paragraph.text = (
-                "Copyright © 2025 The Author(s). Published by Tech Science Press. "
-                "This work is licensed under a Creative Commons Attribution 4.0 International License."
-            )
+            right_paragraph.text = journal.copyright
             right_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
             table.allow_autofit = False
 
@@ -145,59 +228,15 @@ def add_header_footer(doc):
             evenOdd = OxmlElement('w:evenAndOddHeaders')
             sectPr.append(evenOdd)
 
-        # Even page header (Page number left, Journal right)
+        # Even page header (Page number left, Journal right) and odd page header (Journal left,
+        # Page number right), cloned from the journal's templates
+        even_template, odd_template = running_header_templates(journal)
         even_header = section.even_page_header
         even_header.is_linked_to_previous = False
-        table = even_header.add_table(rows=1, cols=2, width=Cm(16.50))
-        table.autofit = False
-        table.columns[0].width = Cm(10.795)
-        table.columns[1].width = Cm(10.795)
-        left_cell = table.cell(0, 0)
-        left_paragraph = left_cell.paragraphs[0]
-        run = left_paragraph.add_run()
-        fld_char_begin = OxmlElement('w:fldChar')
-        fld_char_begin.set(qn('w:fldCharType'), 'begin')
-        run._r.append(fld_char_begin)
-        instr_text = OxmlElement('w:instrText')
-        instr_text.text = ' PAGE '
-        instr_text.set(qn('xml:space'), 'preserve')
-        run._r.append(instr_text)
-        fld_char_end = OxmlElement('w:fldChar')
-        fld_char_end.set(qn('w:fldCharType'), 'end')
-        run._r.append(fld_char_end)
-        left_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        right_cell = table.cell(0, 1)
-        right_paragraph = right_cell.paragraphs[0]
-        right_run = right_paragraph.add_run("Comput Mater Contin. 2025;volume(issue)")
-        right_run.font.size = Cm(0.35)  # Match your original size
-        right_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-
-        # Odd page header (Journal left, Page number right)
+        even_header._element._insert_tbl(deepcopy(even_template))
         odd_header = section.header
         odd_header.is_linked_to_previous = False
-        table = odd_header.add_table(rows=1, cols=2, width=Cm(16.50))
-        table.autofit = False
-        table.columns[0].width = Cm(10.795)
-        table.columns[1].width = Cm(10.795)
-        left_cell = table.cell(0, 0)
-        left_paragraph = left_cell.paragraphs[0]
-        left_run = left_paragraph.add_run("Comput Mater Contin. 2025;volume(issue)")
-        left_run.font.size = Cm(0.35)  # Match your original size
-        left_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        right_cell = table.cell(0, 1)
-        right_paragraph = right_cell.paragraphs[0]
-        run = right_paragraph.add_run()
-        fld_char_begin = OxmlElement('w:fldChar')
-        fld_char_begin.set(qn('w:fldCharType'), 'begin')
-        run._r.append(fld_char_begin)
-        instr_text = OxmlElement('w:instrText')
-        instr_text.text = ' PAGE '
-        instr_text.set(qn('xml:space'), 'preserve')
-        run._r.append(instr_text)
-        fld_char_end = OxmlElement('w:fldChar')
-        fld_char_end.set(qn('w:fldCharType'), 'end')
-        run._r.append(fld_char_end)
-        right_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        odd_header._element._insert_tbl(deepcopy(odd_template))
 
         # Step 3: Ensure continuous page numbering
         pgNumType = sectPr.find(qn('w:pgNumType'))
@@ -209,45 +248,69 @@ def add_header_footer(doc):
         # For subsequent sections, omit w:start to continue numbering
         sectPr.append(pgNumType)
 
+# Words capitalized and emboldened by capitalize_and_bold_abstract_keyword
+TARGET_WORDS = ["abstract", "keyword", "keywords"]
+# Any occurrence of a target word is capitalized ...
+TARGET_PATTERN = re.compile(r"abstract|keywords?", re.IGNORECASE)
+# ... but only whole words are emboldened
+BOLD_PATTERN = re.compile(r"(?<!\w)(?:ABSTRACT|KEYWORDS?)(?!\w)")
+
 # Function to capitalize and bold "Abstract" and "Keyword"
 def capitalize_and_bold_abstract_keyword(doc):
-    # Define the target words to capitalize and bold
-    target_words = ["abstract", "keyword", "keywords"]
     # Iterate through each paragraph
     for paragraph in doc.paragraphs:
         # Check if any target word exists in the paragraph (case-insensitive)
-        if any(word in paragraph.text.lower() for word in target_words):
-            print(f"Processing paragraph: {paragraph.text}")
-
-            # Clear the paragraph and rebuild it with formatted runs
-            new_runs = []
-            for run in paragraph.runs:
-                text = run.text
-                # Capitalize and bold the target words
-                for word in target_words:
-                    # Use regex to replace all occurrences (case-insensitive)
-                    text = re.sub(
-                        re.compile(re.escape(word), re.IGNORECASE),
-                        word.upper(),  # Capitalize the word
-                        text
-                    )
-                # Add the modified text to new_runs
-                new_runs.append((text, run.bold, run.font.size, run.font.name))
-
-            # Clear the paragraph and recreate it with formatted runs
-            paragraph.clear()
-            for text, orig_bold, orig_size, orig_font in new_runs:
-                # Split text into parts (words and separators) using regex
-                parts = re.split(r'(\W+)', text)  # Split by non-word characters
-                for part in parts:
-                    run = paragraph.add_run(part)
-                    run.font.name = orig_font or "Minion Pro"
-                    run.font.size = orig_size or Pt(10)
-                    # Bold only the target words
-                    if part.upper() in [word.upper() for word in target_words]:
-                        run.bold = True
-                    else:
-                        run.bold = orig_bold if orig_bold is not None else False
+        if has_target_word(paragraph.text):
+            capitalize_and_bold_paragraph(paragraph)
+
+def has_target_word(text):
+    return TARGET_PATTERN.search(text) is not None
+
+def capitalize_and_bold_paragraph(paragraph):
+    """Capitalizes and bolds the target words in one paragraph.
+
+    Runs keep their own properties; a run is only split where a target word
+    that needs emboldening occurs inside it.
+    """
+    logger.debug("Capitalizing Abstract/Keyword in paragraph: %s", excerpt(paragraph))
+
+    for run in paragraph.runs:
+        # Unset fonts and bold fall back to the CMC defaults, not the paragraph style
+        if run.font.name is None:
+            run.font.name = "Minion Pro"
+        if run.font.size is None:
+            run.font.size = Pt(10)
+        if run.bold is None:
+            run.bold = False
+
+        text = run.text
+        if not TARGET_PATTERN.search(text):
+            continue
+        text = TARGET_PATTERN.sub(lambda match: match.group().upper(), text)
+        if run.bold:
+            run.text = text
+            continue
+
+        # Split the run around each target word and embolden the word
+        pieces = []
+        position = 0
+        for match in BOLD_PATTERN.finditer(text):
+            if match.start() > position:
+                pieces.append((text[position:match.start()], False))
+            pieces.append((match.group(), True))
+            position = match.end()
+        if position < len(text):
+            pieces.append((text[position:], False))
+
+        run.text, run.bold = pieces[0]
+        previous = run._r
+        for piece_text, bold in pieces[1:]:
+            new_r = deepcopy(run._r)
+            previous.addnext(new_r)
+            new_run = Run(new_r, paragraph)
+            new_run.text = piece_text
+            new_run.bold = bold
+            previous = new_r
 
 
 # Function to set a single-column layout
@@ -268,94 +331,102 @@ def indent_first_line(paragraph, indent_size=Cm(0.5)):
     """Adds first-line indentation to the paragraph."""
     paragraph.paragraph_format.first_line_indent = indent_size
 
+# Section types by style name from the input document, checked in order
+SECTION_RULES = StyleRules([
+    Rule("title", contains=["title"]),
+    Rule("author", contains=["author"]),
+    Rule("heading_1", contains=["heading 1"]),
+    Rule("affiliation", contains=["affiliation"]),
+    Rule("abstract", contains=["abstract"]),
+    Rule("keyword", contains=["keyword"]),
+    Rule("articletype", contains=["articletype"]),
+    Rule("doinum", contains=["doinum"]),
+    Rule("BackMatter", contains=["backmatter"]),
+    Rule("heading_2", contains=["heading 2"]),
+    Rule("heading_3", contains=["heading 3"]),
+    Rule("heading_4", contains=["heading 4"]),
+])
+
+HEADING_SECTIONS = ("heading_1", "heading_2", "heading_3", "heading_4")
+
+# Formatting applied to each section type by the main loop; other non-blank paragraphs get BODY_FORMAT
+SECTION_FORMATS = {
+    "affiliation": dict(font_name="Minion Pro", font_size=9, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "abstract": dict(font_name="Minion Pro", font_size=10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "keyword": dict(font_name="Minion Pro", font_size=10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "BackMatter": dict(font_name="Minion Pro", font_size=10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading_1": dict(font_name="Minion Pro", font_size=11, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading_2": dict(font_name="Minion Pro", font_size=11, bold=True, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading_3": dict(font_name="Minion Pro", font_size=11, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+    "heading_4": dict(font_name="Minion Pro", font_size=11, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT),
+}
+BODY_FORMAT = dict(font_name="Minion Pro", font_size=11, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
+# Font for paragraphs in tables, text boxes, headers, footers and notes
+CONTAINER_FONT = dict(font_name="Minion Pro", font_size=11)
+
+# Formatting of the front matter located by position rather than style
+DOI_FORMAT = dict(font_name="Minion Pro", font_size=7, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
+PAPER_TYPE_FORMAT = dict(font_name="Minion Pro", font_size=9, bold=True, underline=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
+TITLE_FORMAT = dict(font_name="Minion Pro", font_size=14, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
+AUTHORS_FORMAT = dict(font_name="Minion Pro", font_size=12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
+
 # Function to identify section based on style
-def identify_section(paragraph):
+def identify_section(paragraph, styles):
     """Identifies the section type based on the style name from the input document."""
-    style_name = paragraph.style.name.lower()
-
-    if "title" in style_name:
-        return "title"
-    elif "author" in style_name:
-        return "author"
-    elif "heading 1" in style_name:
-        return "heading_1"
-    elif "affiliation" in style_name:
-        return "affiliation"
-    elif "abstract" in style_name:
-        return "abstract"
-    elif "keyword" in style_name:
-        return "keyword"
-    elif "articletype" in style_name:
-        return "articletype"
-    elif "doinum" in style_name:
-        return "doinum"
-    elif "BackMatter" in style_name:
-        return "BackMatter"
-    elif "heading 2" in style_name:
-        return "heading_2"
-    elif "heading 3" in style_name:
-        return "heading_3"
-    elif "heading 4" in style_name:
-        return "heading_4"
-    return "body"
+    return styles.section(paragraph)
+
+# Images keep this fraction of their original size when split into their own paragraph
+IMAGE_SCALE = 0.85
+
+# Runs holding a DrawingML (inline or anchored) or VML image, found with one query per paragraph
+IMAGE_RUNS = etree.XPath(
+    "./w:r[w:drawing or w:pict or mc:AlternateContent]",
+    namespaces={
+        'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+        'mc': 'http://schemas.openxmlformats.org/markup-compatibility/2006',
+    },
+)
+VML_NAMESPACE = 'urn:schemas-microsoft-com:vml'
+VML_SIZE = re.compile(r'(?<![\w-])(width|height)(\s*:\s*)([\d.]+)')
 
 def split_and_center_align_images(doc):
     """Splits images into their own paragraphs and center-aligns/resizes them."""
-    # Define the namespaces used in the document
-    namespaces = {
-        'wp': 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing',
-        'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
-        'pic': 'http://schemas.openxmlformats.org/drawingml/2006/picture',
-    }
-
     # Iterate through all paragraphs in the document
     for paragraph in list(doc.paragraphs):  # Use list() to avoid skipping paragraphs
-        # Check if the paragraph contains both text and images
-        has_text = any(run.text.strip() for run in paragraph.runs)
-        has_image = any(run.element.xpath('.//w:drawing') for run in paragraph.runs)
-
-        if has_text and has_image:
-            # Create a new paragraph for the image
-            new_paragraph = doc.add_paragraph()
-            new_paragraph.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-            # Move the image to the new paragraph
-            for run in paragraph.runs:
-                if run.element.xpath('.//w:drawing'):
-                    new_run = new_paragraph.add_run()
-                    new_run._r.append(run.element)
-
-            # Remove the image from the original paragraph
-            for run in list(paragraph.runs):  # Use list() to avoid skipping runs
-                if run.element.xpath('.//w:drawing'):
-                    paragraph._element.remove(run._element)
-
-            # Resize the image in the new paragraph
-            for run in new_paragraph.runs:
-                if run.element.xpath('.//w:drawing'):
-                    # Convert the drawing element to an lxml element
-                    drawing_xml = run.element.xml
-                    drawing = etree.fromstring(drawing_xml)
-
-                    # Resize the image (reduce size to 50% of original)
-                    for extent in drawing.xpath('.//wp:extent', namespaces=namespaces):
-                        cx = int(int(extent.get('cx')) * 0.85)  # Reduce width by 85%
-                        cy = int(int(extent.get('cy')) * 0.85)  # Reduce height by 85%
-                        extent.set('cx', str(int(cx)))  # Set new width
-                        extent.set('cy', str(int(cy)))  # Set new height
-
-                    # Convert the modified XML back to a string
-                    updated_xml = etree.tostring(drawing, encoding='unicode')
-
-                    # Parse the updated XML back into an element
-                    updated_element = etree.fromstring(updated_xml)
-
-                    # Update the run's XML with the modified drawing
-                    run._r.clear()
-                    run._r.append(updated_element)
-
-            # Insert the new paragraph (with the image) immediately after the original paragraph
-            paragraph._p.addnext(new_paragraph._element)
+        split_paragraph_images(paragraph)
+
+def split_paragraph_images(paragraph):
+    """Moves the images of a paragraph with text into a new centered paragraph after it.
+
+    The image runs are moved and resized in place; nothing is re-serialized.
+    """
+    image_runs = IMAGE_RUNS(paragraph._p)
+    if not image_runs:
+        return
+    # Only paragraphs that also contain text are split
+    if not any(run.text.strip() for run in paragraph.runs if run._r not in image_runs):
+        return
+
+    # Create a new paragraph for the images and insert it immediately after the original paragraph
+    new_paragraph = Paragraph(OxmlElement('w:p'), paragraph._parent)
+    new_paragraph.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    paragraph._p.addnext(new_paragraph._p)
+
+    # Move the image runs to the new paragraph (append() moves the element) and resize them
+    for r in image_runs:
+        new_paragraph._p.append(r)
+        resize_image_run(r, IMAGE_SCALE)
+
+def resize_image_run(r, scale):
+    """Scales the DrawingML extents and VML shape sizes inside a run."""
+    for extent in r.iter(qn('wp:extent')):
+        extent.set('cx', str(int(int(extent.get('cx')) * scale)))
+        extent.set('cy', str(int(int(extent.get('cy')) * scale)))
+    for shape in r.iter('{%s}*' % VML_NAMESPACE):
+        style = shape.get('style')
+        if style:
+            shape.set('style', VML_SIZE.sub(
+                lambda m: '%s%s%s' % (m.group(1), m.group(2), round(float(m.group(3)) * scale, 2)), style))
 
 def indent_first_line(paragraph, indent_size=Cm(0.5)):
     """Adds first-line indentation to a paragraph."""
@@ -397,26 +468,32 @@ def adjust_table_widths(doc):
 def normalize_inline_spacing(doc):
     """Normalizes excessive spaces in all text runs, including headings, preserving images and structure."""
     for para in doc.paragraphs:
-        if para._element.findall(qn('w:tbl')) or para._element.xpath('.//w:drawing|.//w:pict'):
-            continue
-        full_text = ''.join(run.text for run in para.runs if run.text)
-        if full_text:
-            normalized_text = re.sub(r'\s+', ' ', full_text).strip()
-            if normalized_text != full_text:
-                para.clear()
-                para.add_run(normalized_text)
+        normalize_paragraph_spacing(para)
+
+def normalize_paragraph_spacing(para):
+    """Normalizes excessive spaces in one paragraph; returns the new text if it was rewritten."""
+    if para._element.findall(qn('w:tbl')) or para._element.xpath('.//w:drawing|.//w:pict'):
+        return None
+    full_text = ''.join(run.text for run in para.runs if run.text)
+    if full_text:
+        normalized_text = re.sub(r'\s+', ' ', full_text).strip()
+        if normalized_text != full_text:
+            para.clear()
+            para.add_run(normalized_text)
+            return normalized_text
+    return None
 
 # Function to detect title, authors, and abstract index
 def identify_sections(doc):
     """Identifies title, authors, and abstract index with robust content-based logic."""
-    all_paragraphs = [para for para in doc.paragraphs]  # Include empty paragraphs for accurate indexing
-    paragraphs = [para.text.strip() for para in all_paragraphs if para.text.strip()]
+    return find_front_matter([para.text.strip() for para in doc.paragraphs])  # Include empty paragraphs for accurate indexing
 
+def find_front_matter(texts):
+    """Like identify_sections, from the stripped text of every body paragraph."""
     # Title: First paragraph that isn’t DOI, Paper Type, or Abstract
     title = ""
     title_index = None
-    for i, para in enumerate(all_paragraphs):
-        text = para.text.strip()
+    for i, text in enumerate(texts):
         if text and not any(text.lower().startswith(x) for x in ["doi", "paper type", "articletype", "abstract"]):
             title = text
             title_index = i
@@ -426,178 +503,206 @@ def identify_sections(doc):
     authors = ""
     authors_index = None
     if title_index is not None:
-        for i in range(title_index + 1, len(all_paragraphs)):
-            text = all_paragraphs[i].text.strip()
+        for i in range(title_index + 1, len(texts)):
+            text = texts[i]
             if text and not any(text.lower().startswith(x) for x in ["abstract", "doi", "paper type", "articletype"]):
                 authors = text
                 authors_index = i
                 break
 
     # Abstract index
-    abstract_index = next((i for i, para in enumerate(all_paragraphs) if para.text.strip().lower().startswith("abstract")), None)
+    abstract_index = next((i for i, text in enumerate(texts) if text.lower().startswith("abstract")), None)
 
     return title, authors, title_index, authors_index, abstract_index
 
-def format_docx(file_path):
-    """Formats the document and returns the path to the saved file."""
-    doc = Document(file_path)
+def format_docx(file_path, output=None):
+    """Formats the document and saves it to ``output`` (a path or file-like object, default OUTPUT_FILENAME).
+
+    The front matter is placed first; every other body paragraph is then
+    formatted, normalized, split and capitalized in one pass with a
+    ``ParagraphWalker`` before the section-level layout is applied.
+    """
+    with span("open"):
+        doc = Document(file_path)
+    with span("coalesce_runs"):
+        coalesce_document(doc)
+    styles = DocumentStyles(doc.styles, SECTION_RULES)
+    index = ElementIndex(doc)
 
     # Ensure document has at least one paragraph
     if not doc.paragraphs:
         doc.add_paragraph("")
 
     # Step 1: Handle DOI, Paper Type, and spacing before title
-    all_paras = [para for para in doc.paragraphs]
-    paragraphs = [para.text.strip() for para in all_paras if para.text.strip()]
-    # Stricter DOI detection: must start with "doi:" or "DOI:"
-    has_doi = any(p.lower().startswith("doi:") for p in paragraphs if p and len(p) > 4)
-    print(f"Has DOI: {has_doi}, Paragraphs checked: {paragraphs}")
-
-    # Insert DOI if absent
-    if not has_doi:
-        print("Inserting DOI because it’s absent")
-        doi_para = doc.add_paragraph("DOI: _________________")
-        # Move to top by inserting at the beginning
-        if all_paras:  # If there are existing paragraphs
+    # Body paragraphs and their stripped text, kept in step as paragraphs are inserted
+    all_paras = doc.paragraphs
+    texts = [para.text.strip() for para in all_paras]
+
+    def insert_para(index, para):
+        all_paras.insert(index, para)
+        texts.insert(index, para.text.strip())
+
+    with span("front_matter"):
+        paragraphs = [text for text in texts if text]
+        # Stricter DOI detection: must start with "doi:" or "DOI:"
+        has_doi = any(p.lower().startswith("doi:") for p in paragraphs if p and len(p) > 4)
+        logger.debug("Has DOI: %s (%d non-empty paragraphs checked)", has_doi, len(paragraphs))
+
+        # Insert DOI if absent
+        if not has_doi:
+            logger.debug("Inserting DOI because it is absent")
+            doi_para = doc.add_paragraph("DOI: _________________")
+            # Move to top by inserting at the beginning
             all_paras[0]._p.addprevious(doi_para._p)
-            all_paras.insert(0, doi_para)
-        else:  # If document was empty
-            all_paras = [doi_para]
-        apply_formatting(doi_para, "Minion Pro", 7, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        blank_para = doc.add_paragraph("")
-        blank_para.paragraph_format.space_after = Pt(6)
-        doi_para._p.addnext(blank_para._p)
-        all_paras.insert(1, blank_para)
-    else:
-        print("DOI already present, formatting only")
-        for i, para in enumerate(all_paras):
-            if para.text.strip().lower().startswith("doi:"):
-                apply_formatting(para, "Minion Pro", 7, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-                break
-
-    # Insert Paper Type if absent
-    has_paper_type = any(p.lower().startswith(("paper type", "articletype")) for p in paragraphs if p)
-    print(f"Has Paper Type: {has_paper_type}")
-    doi_index = next((i for i, para in enumerate(all_paras) if para.text.strip().lower().startswith("doi:")), -1)
-    if not has_paper_type:
-        print("Inserting Paper Type because it’s absent")
-        paper_type_para = doc.add_paragraph("Paper Type (_________________)")
-        insert_after = doi_index + 1 if doi_index >= 0 else 0
-        if insert_after < len(all_paras) and not all_paras[insert_after].text.strip():
-            insert_after += 1  # Skip blank line after DOI
-        if insert_after < len(all_paras):
-            all_paras[insert_after]._p.addprevious(paper_type_para._p)
-            all_paras.insert(insert_after, paper_type_para)
+            insert_para(0, doi_para)
+            apply_formatting(doi_para, **DOI_FORMAT)
+            blank_para = doc.add_paragraph("")
+            blank_para.paragraph_format.space_after = Pt(6)
+            doi_para._p.addnext(blank_para._p)
+            insert_para(1, blank_para)
         else:
-            doc._body._element.append(paper_type_para._p)
-            all_paras.append(paper_type_para)
-        apply_formatting(paper_type_para, "Minion Pro", 9, bold=True, underline=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        blank_para = doc.add_paragraph("")
-        blank_para.paragraph_format.space_after = Pt(6)
-        paper_type_para._p.addnext(blank_para._p)
-        all_paras.insert(all_paras.index(paper_type_para) + 1, blank_para)
-    else:
-        print("Paper Type already present, formatting only")
-        for i, para in enumerate(all_paras):
-            if para.text.strip().lower().startswith(("paper type", "articletype")):
-                apply_formatting(para, "Minion Pro", 9, bold=True, underline=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-                break
-
-    # Identify title and add spacing before it
-    title, authors, title_index, authors_index, abstract_index = identify_sections(doc)
-    print(f"Title Index: {title_index}, Title: {title}")
-    print(f"Authors Index: {authors_index}, Authors: {authors}")
-    print(f"Abstract Index: {abstract_index}")
-
-    if title_index is not None and title_index < len(all_paras):
-        # Add blank line before title if not already present
-        if title_index > 0 and all_paras[title_index - 1].text.strip():
+            logger.debug("DOI already present, formatting only")
+            for i, text in enumerate(texts):
+                if text.lower().startswith("doi:"):
+                    apply_formatting(all_paras[i], **DOI_FORMAT)
+                    break
+
+        # Insert Paper Type if absent
+        has_paper_type = any(p.lower().startswith(("paper type", "articletype")) for p in paragraphs if p)
+        logger.debug("Has Paper Type: %s", has_paper_type)
+        doi_index = next((i for i, text in enumerate(texts) if text.lower().startswith("doi:")), -1)
+        if not has_paper_type:
+            logger.debug("Inserting Paper Type because it is absent")
+            paper_type_para = doc.add_paragraph("Paper Type (_________________)")
+            insert_after = doi_index + 1 if doi_index >= 0 else 0
+            if insert_after < len(all_paras) and not texts[insert_after]:
+                insert_after += 1  # Skip blank line after DOI
+            if insert_after < len(all_paras):
+                all_paras[insert_after]._p.addprevious(paper_type_para._p)
+                insert_para(insert_after, paper_type_para)
+            else:
+                doc._body._element.append(paper_type_para._p)
+                insert_para(len(all_paras), paper_type_para)
+            apply_formatting(paper_type_para, **PAPER_TYPE_FORMAT)
             blank_para = doc.add_paragraph("")
             blank_para.paragraph_format.space_after = Pt(6)
-            all_paras[title_index]._p.addprevious(blank_para._p)
-            all_paras.insert(title_index, blank_para)
-            title_index += 1
-            authors_index = authors_index + 1 if authors_index is not None else None
-            abstract_index = abstract_index + 1 if abstract_index is not None else None
-        elif title_index > 0:
-            all_paras[title_index - 1].paragraph_format.space_after = Pt(6)
-
-    # Step 2: Apply title and authors formatting
-    if title_index is not None and title_index < len(all_paras):
-        apply_formatting(all_paras[title_index], "Minion Pro", 14, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        print(f"Applied title formatting to: {all_paras[title_index].text}")
-    if authors_index is not None and authors_index < len(all_paras):
-        apply_formatting(all_paras[authors_index], "Minion Pro", 12, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        print(f"Applied authors formatting to: {all_paras[authors_index].text}")
-    else:
-        print("Authors index not found or invalid!")
+            paper_type_para._p.addnext(blank_para._p)
+            insert_para(insert_after + 1, blank_para)
+        else:
+            logger.debug("Paper Type already present, formatting only")
+            for i, text in enumerate(texts):
+                if text.lower().startswith(("paper type", "articletype")):
+                    apply_formatting(all_paras[i], **PAPER_TYPE_FORMAT)
+                    break
+
+        # Identify title and add spacing before it
+        title, authors, title_index, authors_index, abstract_index = find_front_matter(texts)
+        logger.debug("Title index: %s, title: %s", title_index, excerpt(title))
+        logger.debug("Authors index: %s, authors: %s", authors_index, excerpt(authors))
+        logger.debug("Abstract index: %s", abstract_index)
+
+        if title_index is not None and title_index < len(all_paras):
+            # Add blank line before title if not already present
+            if title_index > 0 and texts[title_index - 1]:
+                blank_para = doc.add_paragraph("")
+                blank_para.paragraph_format.space_after = Pt(6)
+                all_paras[title_index]._p.addprevious(blank_para._p)
+                insert_para(title_index, blank_para)
+                title_index += 1
+                authors_index = authors_index + 1 if authors_index is not None else None
+                abstract_index = abstract_index + 1 if abstract_index is not None else None
+            elif title_index > 0:
+                all_paras[title_index - 1].paragraph_format.space_after = Pt(6)
+
+        # Step 2: Apply title and authors formatting
+        if title_index is not None and title_index < len(all_paras):
+            apply_formatting(all_paras[title_index], **TITLE_FORMAT)
+            logger.debug("Applied title formatting to: %s", excerpt(all_paras[title_index]))
+        if authors_index is not None and authors_index < len(all_paras):
+            apply_formatting(all_paras[authors_index], **AUTHORS_FORMAT)
+            logger.debug("Applied authors formatting to: %s", excerpt(all_paras[authors_index]))
+        else:
+            logger.info("Authors paragraph not found")
 
     # Ensure single-column layout
-    set_single_column(doc)
+    with span("set_single_column"):
+        set_single_column(doc)
 
-    # Flags
+    # Step 3: Format, normalize, split and capitalize the body in a single pass
+    walker = ParagraphWalker()
     in_references_section = False
-    before_abstract = True
 
-    # Step 3: Format remaining paragraphs, preserving input spacing
-    for i, para in enumerate(all_paras):
-        text = para.text.strip()
+    # Format remaining paragraphs, preserving input spacing
+    def format_paragraph(visit):
+        nonlocal in_references_section
+        i, para, text = visit.index, visit.paragraph, visit.text
+        visit.section_type = section_type = identify_section(para, styles)
 
         # Skip title and authors since they’re already formatted
         if i == title_index or i == authors_index:
-            continue
-
-        if abstract_index is not None and i >= abstract_index:
-            before_abstract = False
+            return
 
         # Format DOI
         if text.lower().startswith("doi:") and i <= 1:
-            apply_formatting(para, "Minion Pro", 7, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-            continue
+            apply_formatting(para, **DOI_FORMAT)
+            return
         # Format Paper Type
         elif text.lower().startswith(("paper type", "articletype")) and i <= 3:
-            apply_formatting(para, "Minion Pro", 9, bold=True, underline=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-            continue
+            apply_formatting(para, **PAPER_TYPE_FORMAT)
+            return
 
-        section_type = identify_section(para)
-        if section_type == "affiliation":
-            apply_formatting(para, "Minion Pro", 9, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "abstract" or section_type == "keyword":
-            apply_formatting(para, "Minion Pro", 10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "BackMatter":
-            apply_formatting(para, "Minion Pro", 10, bold=False, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading_1":
-            apply_formatting(para, "Minion Pro", 11, bold=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading_2":
-            apply_formatting(para, "Minion Pro", 11, bold=True, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
-        elif section_type == "heading_3" or section_type == "heading_4":
-            apply_formatting(para, "Minion Pro", 11, italic=True, alignment=WD_PARAGRAPH_ALIGNMENT.LEFT)
+        if section_type in SECTION_FORMATS:
+            apply_formatting(para, **SECTION_FORMATS[section_type])
         elif not text:  # Preserve blank lines from input without modification
-            continue
+            return
         else:
-            apply_formatting(para, "Minion Pro", 11, alignment=WD_PARAGRAPH_ALIGNMENT.JUSTIFY)
+            apply_formatting(para, **BODY_FORMAT)
 
         if text.lower().startswith("references"):
             in_references_section = True
-            continue
-        if not in_references_section and i > 0:
-            previous_para = all_paras[i - 1]
-            previous_section_type = identify_section(previous_para)
-            current_section_type = identify_section(para)
-            if previous_section_type in ["heading_1", "heading_2", "heading_3", "heading_4"] and \
-               current_section_type not in ["heading_1", "heading_2", "heading_3", "heading_4"]:
+            return
+        if not in_references_section and visit.previous:
+            previous_section_type = visit.previous[-1].section_type
+            if previous_section_type in HEADING_SECTIONS and section_type not in HEADING_SECTIONS:
                 if re.match(r'^[A-Za-z]', text) and not re.match(r'^\d', text) and not re.match(r'^[A-Z]\s', text):
                     if not all(run.bold for run in para.runs if run.text.strip()):
                         indent_first_line(para, Cm(0.5))
 
-    normalize_inline_spacing(doc)
-    split_and_center_align_images(doc)
-    set_page_layout(doc)
-    add_numbering(doc)
-    add_header_footer(doc)
-    capitalize_and_bold_abstract_keyword(doc)
-    adjust_table_widths(doc)
-
-    output_filename = "formated.docx"
-    doc.save(output_filename)
-    return output_filename
+    def normalize_spacing(visit):
+        normalized_text = normalize_paragraph_spacing(visit.paragraph)
+        if normalized_text is not None:
+            visit.text = normalized_text
+
+    def split_images(visit):
+        split_paragraph_images(visit.paragraph)
+
+    def capitalize_abstract_keyword(visit):
+        if has_target_word(visit.text):
+            capitalize_and_bold_paragraph(visit.paragraph)
+
+    walker.register("format", format_paragraph)
+    walker.register("normalize_inline_spacing", normalize_spacing)
+    walker.register("split_and_center_align_images", split_images)
+    walker.register("capitalize_and_bold_abstract_keyword", capitalize_abstract_keyword)
+    walker.walk(all_paras, texts)
+
+    # The walker covers the top-level body; give everything else the journal font
+    with span("format_containers"):
+        for entry in index:
+            if entry.container != BODY:
+                apply_container_font(entry.paragraph, **CONTAINER_FONT)
+
+    with span("set_page_layout"):
+        set_page_layout(doc)
+    with span("add_numbering"):
+        add_numbering(doc)
+    with span("add_header_footer"):
+        add_header_footer(doc)
+    with span("adjust_table_widths"):
+        adjust_table_widths(doc)
+
+    if output is None:
+        output = OUTPUT_FILENAME
+    with span("save"):
+        save_document(doc, output, file_path)
+    return output
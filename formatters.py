@@ -0,0 +1,59 @@
+"""Registry of the available formatting styles."""
+import functools
+import os
+
+# Import the format_docx functions from all formatting styles
+from format_style_1 import format_docx as format_docx_style_1, OUTPUT_FILENAME as output_filename_style_1
+from format_style_2 import format_docx as format_docx_style_2, OUTPUT_FILENAME as output_filename_style_2
+from format_style_3 import format_docx as format_docx_style_3, format_docx_streaming as format_docx_streaming_style_3, OUTPUT_FILENAME as output_filename_style_3
+from format_style_4 import format_docx as format_docx_style_4, format_docx_streaming as format_docx_streaming_style_4, OUTPUT_FILENAME as output_filename_style_4
+from format_style_5 import format_docx as format_docx_style_5, OUTPUT_FILENAME as output_filename_style_5
+from format_style_6 import format_docx as format_docx_style_6, format_docx_streaming as format_docx_streaming_style_6, OUTPUT_FILENAME as output_filename_style_6
+
+# Map each formatting style to its formatter and download filename
+FORMATTERS = {
+    'style_1': (format_docx_style_1, output_filename_style_1),
+    'style_2': (format_docx_style_2, output_filename_style_2),
+    'style_3': (format_docx_style_3, output_filename_style_3),
+    'style_4': (format_docx_style_4, output_filename_style_4),
+    'style_5': (format_docx_style_5, output_filename_style_5),
+    'style_6': (format_docx_style_6, output_filename_style_6),
+}
+
+# Styles that can stream the document body instead of loading it whole; they
+# are used for inputs of at least STREAMING_MIN_BYTES (STREAMING_MIN_MB in the environment)
+STREAMING_FORMATTERS = {
+    'style_3': format_docx_streaming_style_3,
+    'style_4': format_docx_streaming_style_4,
+    'style_6': format_docx_streaming_style_6,
+}
+STREAMING_MIN_BYTES = int(float(os.environ.get('STREAMING_MIN_MB', '20')) * 1024 * 1024)
+
+
+# "direct" formats every run; "restyle" rewrites the paragraph styles instead,
+# for the styles that support it (their format_docx takes ``restyle``)
+FORMAT_MODE = os.environ.get('FORMAT_MODE', 'direct')
+RESTYLE_STYLES = {'style_3', 'style_4', 'style_6'}
+
+
+# Function to pick the formatter for a document of ``size`` bytes
+def choose_formatter(style, size):
+    if size >= STREAMING_MIN_BYTES and style in STREAMING_FORMATTERS:
+        return STREAMING_FORMATTERS[style]
+    if FORMAT_MODE == 'restyle' and style in RESTYLE_STYLES:
+        return functools.partial(FORMATTERS[style][0], restyle=True)
+    return FORMATTERS[style][0]
+
+
+# Bump whenever a change alters the formatted output, so cached results are not reused
+FORMATTER_VERSION = '9'
+
+
+# Function to get the version of the output a style produces in this process (for cache keys)
+def output_version(style):
+    if FORMAT_MODE == 'restyle' and style in RESTYLE_STYLES:
+        return '%s-%s' % (FORMATTER_VERSION, FORMAT_MODE)
+    return FORMATTER_VERSION
+
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
@@ -0,0 +1,116 @@
+"""Formatted paragraphs remembered across documents.
+
+Authors upload revision after revision of the same paper, and most of its
+paragraphs come back unchanged.  ``FragmentCache`` keeps the formatted XML of
+recently formatted paragraphs, keyed on a digest of the formatting style,
+the paragraph's section type (or container) and its XML as it was before
+formatting.  When a later document has a paragraph with the same key, the
+cached result is copied into it instead of formatting it again, so a
+revision costs roughly in proportion to what was edited.
+
+The XML is hashed after ``run_coalescing`` has stripped the revision ids,
+so a paragraph that was not edited hashes the same in every revision.
+Paragraphs containing other paragraphs (text boxes) are formatted in
+several steps and are never cached.  The cache is per process and bounded
+by the size of the XML it holds (FRAGMENT_CACHE_MB in the environment); the
+least recently used paragraphs are dropped first.
+
+Every document pays for hashing its paragraphs and copying them in and out
+of the cache, which only pays off on servers that see many revisions of the
+same papers, so the cache is off unless FRAGMENT_CACHE_MB is set.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+
+from docx.oxml.ns import qn
+from lxml import etree
+
+_P = qn('w:p')
+
+
+class FragmentCache:
+    """Size-bounded LRU map of paragraph keys to formatted ``w:p`` elements."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (element, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, namespace, label, p):
+        """The key of paragraph element ``p`` formatted as ``label`` by ``namespace``, or None if it can't be cached."""
+        if self.max_bytes <= 0 or next(p.iterdescendants(_P), None) is not None:
+            return None
+        xml = etree.tostring(p)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(namespace.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(label.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(xml)
+        return digest.digest(), len(xml)
+
+    def splice(self, key, p):
+        """Gives ``p`` the cached result for ``key``; returns False on a miss."""
+        with self._lock:
+            entry = self._entries.get(key[0])
+            if entry is None:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key[0])
+            self.hits += 1
+        formatted = deepcopy(entry[0])
+        # Keep the element itself, which callers (e.g. the streaming engine) still hold on to
+        p.attrib.clear()
+        p.attrib.update(formatted.attrib)
+        p[:] = list(formatted)
+        return True
+
+    def store(self, key, p):
+        """Remembers the formatted paragraph ``p`` under ``key``."""
+        digest, size = key
+        if size > self.max_bytes:
+            return
+        formatted = deepcopy(p)
+        with self._lock:
+            previous = self._entries.pop(digest, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[digest] = (formatted, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._size -= dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class Fragments:
+    """The part of a FragmentCache used by one formatting style."""
+
+    def __init__(self, namespace, cache=None):
+        self.namespace = namespace
+        self.cache = cache if cache is not None else FRAGMENT_CACHE
+
+    def key(self, label, p):
+        return self.cache.key(self.namespace, label, p)
+
+    def splice(self, key, p):
+        return self.cache.splice(key, p)
+
+    def store(self, key, p):
+        self.cache.store(key, p)
+
+
+FRAGMENT_CACHE = FragmentCache(int(float(os.environ.get('FRAGMENT_CACHE_MB', '0')) * 1024 * 1024))
@@ -0,0 +1,18 @@
+import os
+
+# Import the app in the master so forked workers share its memory copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    # Load the journal header/footer images and templates once, before the workers fork
+    import format_style_5
+
+    format_style_5.preload_journal()
+
+    # Optionally load the BERT title classifier before the workers fork
+    if os.environ.get("PRELOAD_TITLE_MODEL", "0") == "1":
+        import title_classifier
+
+        title_classifier.preload()
+        server.log.info("Preloaded title classifier %s", title_classifier.MODEL_NAME)
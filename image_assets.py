@@ -0,0 +1,48 @@
+"""Images that the formatters add to every document, loaded once per process.
+
+``run.add_picture(path)`` reads the file, hashes it and parses its header on
+every call.  ``load_image`` does that once per path and keeps the parsed
+image; ``add_picture`` then adds it to a document, creating its image part on
+first use in that document and reusing it (and its relationship) after that.
+"""
+import functools
+import os
+
+from docx.image.image import Image
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml.shape import CT_Inline
+from docx.shape import InlineShape
+
+# Relative asset paths are resolved against the repository, not the working directory
+ASSET_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+@functools.lru_cache(maxsize=None)
+def load_image(path):
+    """The parsed image at ``path`` (relative paths are resolved against ASSET_ROOT)."""
+    return Image.from_file(os.path.join(ASSET_ROOT, path))
+
+
+def image_part_for(package, image):
+    """The document's image part holding ``image``, added if the document has none yet."""
+    image_parts = package.image_parts
+    for image_part in image_parts:
+        if image_part._image is image:
+            return image_part
+    # An identical image may already be in the document; only same-sized blobs need hashing
+    size = len(image.blob)
+    for image_part in image_parts:
+        if len(image_part.blob) == size and image_part.sha1 == image.sha1:
+            return image_part
+    return image_parts._add_image_part(image)
+
+
+# Function to add a preloaded image to the end of a run, like run.add_picture()
+def add_picture(run, image, width=None, height=None):
+    part = run.part
+    image_part = image_part_for(part.package, image)
+    rId = part.relate_to(image_part, RT.IMAGE)
+    cx, cy = image.scaled_dimensions(width, height)
+    inline = CT_Inline.new_pic_inline(part.next_id, rId, image_part.filename, cx, cy)
+    run._r.add_drawing(inline)
+    return InlineShape(inline)
@@ -0,0 +1,236 @@
+"""Per-stage timing, profiling and metrics for the formatters.
+
+The formatters wrap each stage in ``span(name)``.  Spans only cost anything
+while a document is being traced with ``trace_document``; the resulting
+``Trace`` holds the time spent in each stage and can be summarized into a
+plain dict, so traces taken in pool processes can be sent back and recorded
+in the parent's ``METRICS``.  ``METRICS.render()`` returns the Prometheus
+text exposition served at ``/metrics``.
+
+A trace can also capture a profile of the whole document with cProfile or,
+when it is installed, pyinstrument.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# Histogram buckets in seconds
+STYLE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """Stage timings (and optionally a profile) of one formatted document."""
+
+    def __init__(self, style):
+        self.style = style
+        self.stages = {}  # stage name -> seconds, in the order first entered
+        self.seconds = None
+        self.ok = None
+        self.profiler = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def summary(self):
+        return {
+            'style': self.style,
+            'ok': self.ok,
+            'seconds': self.seconds,
+            'stages': dict(self.stages),
+        }
+
+    def server_timing(self):
+        """The stages as a Server-Timing header value."""
+        return ', '.join('%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in self.stages.items())
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as stage ``name`` of the document being traced."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def record(name, seconds):
+    """Adds time measured elsewhere (e.g. summed over paragraphs) to stage ``name``."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def is_tracing():
+    return _current.get() is not None
+
+
+class CProfileProfiler:
+    suffix = '.prof'
+
+    def __init__(self):
+        import cProfile
+
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def save(self, path):
+        self._profile.dump_stats(path)  # Open with pstats or snakeviz
+
+
+class PyinstrumentProfiler:
+    suffix = '.html'
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ValueError("pyinstrument is not installed")
+        self._profiler = Profiler()
+
+    def start(self):
+        self._profiler.start()
+
+    def stop(self):
+        self._profiler.stop()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self._profiler.output_html())
+
+
+def make_profiler(kind):
+    if kind == 'cprofile':
+        return CProfileProfiler()
+    if kind == 'pyinstrument':
+        return PyinstrumentProfiler()
+    raise ValueError("Unknown profiler: %s (expected one of %s)" % (kind, ', '.join(PROFILERS)))
+
+
+# Function to trace the formatting of one document
+@contextmanager
+def trace_document(style, profiler=None):
+    """Collects the spans of the enclosed formatting into a new Trace.
+
+    ``profiler`` (see ``make_profiler``) is run for the duration and kept as
+    ``trace.profiler``.
+    """
+    trace = Trace(style)
+    trace.profiler = profiler
+    start = time.perf_counter()
+    if trace.profiler:
+        trace.profiler.start()  # Before tracing starts, so a profiler that fails to start leaves nothing to undo
+    token = _current.set(trace)
+    try:
+        yield trace
+        trace.ok = True
+    except BaseException:
+        trace.ok = False
+        raise
+    finally:
+        if trace.profiler:
+            trace.profiler.stop()
+        trace.seconds = time.perf_counter() - start
+        _current.reset(token)
+
+
+# Function to write a trace's profile into a folder
+def save_profile(trace, folder):
+    """Returns the file name of the saved profile."""
+    os.makedirs(folder, exist_ok=True)
+    filename = '%s-%s-%d%s' % (time.strftime('%Y%m%d-%H%M%S'), trace.style, os.getpid(), trace.profiler.suffix)
+    trace.profiler.save(os.path.join(folder, filename))
+    return filename
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels.items())
+
+
+class Metrics:
+    """Documents-processed counters and latency histograms per style and stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = {}  # (style, status) -> count
+        self.durations = {}  # style -> Histogram
+        self.stage_durations = {}  # (style, stage) -> Histogram
+
+    def observe(self, summary):
+        """Records a Trace summary (see ``Trace.summary``)."""
+        style = summary['style']
+        status = 'ok' if summary['ok'] else 'error'
+        with self._lock:
+            self.documents[style, status] = self.documents.get((style, status), 0) + 1
+            if summary['seconds'] is not None:
+                self.durations.setdefault(style, Histogram(STYLE_BUCKETS)).observe(summary['seconds'])
+            for stage, seconds in summary['stages'].items():
+                self.stage_durations.setdefault((style, stage), Histogram(STAGE_BUCKETS)).observe(seconds)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP formatter_documents_total Documents formatted, by style and status.',
+            '# TYPE formatter_documents_total counter',
+        ]
+        with self._lock:
+            for (style, status), count in sorted(self.documents.items()):
+                lines.append('formatter_documents_total%s %d' % (_labels(style=style, status=status), count))
+            lines += [
+                '# HELP formatter_duration_seconds Time to format one document, by style.',
+                '# TYPE formatter_duration_seconds histogram',
+            ]
+            for style, histogram in sorted(self.durations.items()):
+                lines += _render_histogram('formatter_duration_seconds', histogram, style=style)
+            lines += [
+                '# HELP formatter_stage_duration_seconds Time spent in each formatting stage, by style and stage.',
+                '# TYPE formatter_stage_duration_seconds histogram',
+            ]
+            for (style, stage), histogram in sorted(self.stage_durations.items()):
+                lines += _render_histogram('formatter_stage_duration_seconds', histogram, style=style, stage=stage)
+        return '\n'.join(lines) + '\n'
+
+
+def _render_histogram(name, histogram, **labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket%s %d' % (name, _labels(**labels, le=le), cumulative))
+    lines.append('%s_sum%s %r' % (name, _labels(**labels), histogram.sum))
+    lines.append('%s_count%s %d' % (name, _labels(**labels), cumulative))
+    return lines
+
+
+# Metrics of this process
+METRICS = Metrics()
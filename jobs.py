@@ -0,0 +1,370 @@
+"""Background formatting jobs.
+
+Jobs are recorded in a local SQLite database and executed on a bounded
+process pool around the existing ``format_docx`` functions.  Each job keeps
+its input and output under ``<job folder>/<job id>/``.  A job formats either
+one document or, for a batch, every document of a ZIP archive (see
+``batch_format.format_zip``), whose report is kept next to the result.
+
+A job records the process that queued it and the pool process running it.
+If a pool process dies (killed for memory, crashed), its job and the jobs
+still queued on the broken pool are marked failed and the next job starts a
+new pool.  ``JobStore.sweep`` fails the queued and running jobs whose
+process is gone or that have been pending for too long, e.g. after a
+restart, so they no longer count towards the pending limit.
+"""
+import functools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from batch_format import REPORT_FILENAME, format_zip
+from formatters import FORMATTERS, choose_formatter
+from instrumentation import METRICS, trace_document
+from structured_logging import request_context
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Kinds of job
+DOCUMENT = 'document'
+BATCH = 'batch'
+
+INPUT_FILENAME = 'input.docx'
+BATCH_INPUT_FILENAME = 'input.zip'
+BATCH_OUTPUT_FILENAME = 'formatted_documents.zip'
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    style TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    owner_pid INTEGER,
+    worker_pid INTEGER,
+    kind TEXT NOT NULL DEFAULT 'document'
+)
+"""
+# Columns added since the first version of the schema, for existing databases
+ADDED_COLUMNS = {
+    'owner_pid': 'INTEGER',
+    'worker_pid': 'INTEGER',
+    'kind': "TEXT NOT NULL DEFAULT 'document'",
+}
+
+WORKER_DIED = "The worker process formatting this job exited unexpectedly"
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting to run."""
+
+
+class JobStore:
+    """SQLite-backed record of job state, shared by the web and pool processes."""
+
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        self.db_path = os.path.join(folder, 'jobs.sqlite3')
+        os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for name, column_type in ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute('ALTER TABLE jobs ADD COLUMN %s %s' % (name, column_type))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.folder, job_id)
+
+    def input_path(self, job_id, kind=DOCUMENT):
+        return os.path.join(self.job_dir(job_id), BATCH_INPUT_FILENAME if kind == BATCH else INPUT_FILENAME)
+
+    def output_path(self, job_id, style, kind=DOCUMENT):
+        return os.path.join(self.job_dir(job_id), BATCH_OUTPUT_FILENAME if kind == BATCH else FORMATTERS[style][1])
+
+    def report_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), REPORT_FILENAME)
+
+    def report(self, job_id):
+        """The batch report of a finished batch job, or None."""
+        try:
+            with open(self.report_path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def create(self, style, filename, data, kind=DOCUMENT):
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id))
+        with open(self.input_path(job_id, kind), 'wb') as f:
+            f.write(data)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, style, filename, status, created_at, owner_pid, kind) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, style, filename, QUEUED, time.time(), os.getpid(), kind),
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def count(self, *statuses):
+        marks = ', '.join('?' for _ in statuses)
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM jobs WHERE status IN (%s)' % marks, statuses).fetchone()[0]
+
+    def mark_running(self, job_id):
+        """Returns False if the job is no longer queued (e.g. it was swept)."""
+        return self._update(job_id, (QUEUED,), status=RUNNING, started_at=time.time(), worker_pid=os.getpid())
+
+    def mark_done(self, job_id):
+        """Returns False if the job is no longer running (e.g. it was swept while it ran)."""
+        return self._update(job_id, (RUNNING,), status=DONE, finished_at=time.time())
+
+    def mark_failed(self, job_id, error):
+        """Fails the job unless it has already finished."""
+        self._update(job_id, (QUEUED, RUNNING), status=FAILED, error=error, finished_at=time.time())
+
+    def _update(self, job_id, statuses=None, **fields):
+        """Updates the job (only if its status is one of ``statuses``, when given); returns whether it did."""
+        assignments = ', '.join('%s = ?' % name for name in fields)
+        query = 'UPDATE jobs SET %s WHERE id = ?' % assignments
+        params = (*fields.values(), job_id)
+        if statuses:
+            query += ' AND status IN (%s)' % ', '.join('?' for _ in statuses)
+            params += tuple(statuses)
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount == 1
+
+    def sweep(self, max_age_seconds=None):
+        """Fails the queued and running jobs that will never finish; returns how many.
+
+        Those are running jobs whose pool process is gone, queued jobs whose
+        queuing process is gone (their pool went with it) and, with
+        ``max_age_seconds``, any job pending for longer than that.  Process ids
+        are only meaningful on this host, like the SQLite database itself.
+        """
+        cutoff = time.time() - max_age_seconds if max_age_seconds else None
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, status, created_at, owner_pid, worker_pid FROM jobs WHERE status IN (?, ?)',
+                (QUEUED, RUNNING),
+            ).fetchall()
+        swept = 0
+        for row in rows:
+            if cutoff is not None and row['created_at'] < cutoff:
+                error = "The job did not finish within %d seconds" % max_age_seconds
+            elif row['status'] == RUNNING and not _is_alive(row['worker_pid']):
+                error = WORKER_DIED
+            elif row['status'] == QUEUED and not _is_alive(row['owner_pid']):
+                error = "The server process that queued this job exited before it ran"
+            else:
+                continue
+            logger.warning("Job %s failed: %s", row['id'], error)
+            self.mark_failed(row['id'], error)
+            swept += 1
+        return swept
+
+    def cleanup(self, retention_seconds):
+        """Deletes finished jobs (and their files) older than the retention period."""
+        cutoff = time.time() - retention_seconds
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id FROM jobs WHERE status IN (?, ?) AND finished_at < ?', (DONE, FAILED, cutoff)
+            ).fetchall()
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(row['id'],) for row in rows])
+        for row in rows:
+            shutil.rmtree(self.job_dir(row['id']), ignore_errors=True)
+        return len(rows)
+
+
+def _is_alive(pid):
+    if not pid:
+        return True  # Recorded before process ids were; only the age limit applies
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Function executed in a pool process for each job
+def run_job(folder, job_id):
+    """Runs a job; returns the trace summaries of its documents so the parent can record metrics."""
+    with request_context(job_id):
+        return _run_job(folder, job_id)
+
+
+def _run_job(folder, job_id):
+    store = JobStore(folder)
+    job = store.get(job_id)
+    if job is None or not store.mark_running(job_id):
+        return None  # Failed (e.g. swept) before a worker got to it
+    if job['kind'] == BATCH:
+        return _run_batch(store, job)
+    trace = None
+    try:
+        with trace_document(job['style']) as trace:
+            input_path = store.input_path(job_id)
+            format_docx = choose_formatter(job['style'], os.path.getsize(input_path))
+            output_path = store.output_path(job_id, job['style'])
+            tmp_path = output_path + '.part'
+            format_docx(input_path, tmp_path)
+            os.replace(tmp_path, output_path)
+    except Exception:
+        logger.exception("Job %s failed", job_id)
+        store.mark_failed(job_id, traceback.format_exc(limit=5))
+        return [trace.summary()] if trace is not None else None
+    if not store.mark_done(job_id):
+        _discard_output(job_id, output_path)
+        return [trace.summary()]
+    logger.info("Job %s formatted with %s in %.3fs", job_id, job['style'], trace.seconds)
+    return [trace.summary()]
+
+
+def _run_batch(store, job):
+    job_id = job['id']
+    try:
+        # The job already holds one of the queue's workers; a single formatter process keeps the
+        # server within JOB_WORKERS cores while still isolating documents that crash it
+        result, report = format_zip(store.input_path(job_id, BATCH), job['style'], max_workers=1)
+        output_path = store.output_path(job_id, job['style'], BATCH)
+        with open(output_path + '.part', 'wb') as f:
+            f.write(result)
+        os.replace(output_path + '.part', output_path)
+        with open(store.report_path(job_id), 'w') as f:
+            json.dump(report, f, indent=2)
+    except Exception:
+        logger.exception("Batch job %s failed", job_id)
+        store.mark_failed(job_id, traceback.format_exc(limit=5))
+        return None
+    summaries = [{'style': job['style'], 'ok': entry['ok'], 'seconds': entry['seconds'], 'stages': entry['stages']}
+                 for entry in report['files']]
+    if not store.mark_done(job_id):
+        _discard_output(job_id, output_path, store.report_path(job_id))
+        return summaries
+    logger.info("Batch job %s formatted %d documents with %s (%d failed) in %.3fs", job_id, report['total'],
+                job['style'], report['failed'], report['seconds'])
+    return summaries
+
+
+def _discard_output(job_id, *paths):
+    """Removes the output of a job that was failed (e.g. swept for its age) while it ran."""
+    logger.warning("Job %s finished after it was failed; discarding its output", job_id)
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class JobQueue:
+    """Submits jobs to a lazily created, bounded process pool.
+
+    The pool belongs to the process that created the queue; under gunicorn
+    that is each worker, so ``max_workers`` bounds one worker's jobs.
+    """
+
+    def __init__(self, folder, max_workers=2, max_pending=100):
+        self.store = JobStore(folder)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+        # Jobs left pending by a previous run of the server will never finish
+        self.store.sweep()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _discard_executor(self, executor):
+        """Forgets a broken pool, so the next job starts a new one."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def submit(self, style, filename, data, kind=DOCUMENT):
+        if self.store.count(QUEUED, RUNNING) >= self.max_pending:
+            raise JobQueueFull("Too many jobs are waiting; try again later")
+        job_id = self.store.create(style, filename, data, kind)
+        try:
+            future, executor = self._submit(job_id)
+        except Exception:
+            logger.exception("Job %s could not be started", job_id)
+            self.store.mark_failed(job_id, "The job could not be started")
+            raise
+        future.add_done_callback(functools.partial(self._job_finished, job_id, executor))
+        return job_id
+
+    def _submit(self, job_id):
+        executor = self._get_executor()
+        try:
+            future = executor.submit(run_job, self.store.folder, job_id)
+        except BrokenProcessPool:
+            # A worker of the current pool died since the last job; start over with a new pool
+            logger.error("The job pool is broken; starting a new one")
+            self._discard_executor(executor)
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = self._get_executor()
+            future = executor.submit(run_job, self.store.folder, job_id)
+        return future, executor
+
+    def _job_finished(self, job_id, executor, future):
+        try:
+            summaries = future.result()
+        except BrokenProcessPool:
+            logger.error("Job %s failed: %s", job_id, WORKER_DIED)
+            self.store.mark_failed(job_id, WORKER_DIED)
+            self._discard_executor(executor)
+            return
+        except CancelledError:
+            self.store.mark_failed(job_id, "The server shut down before the job ran")
+            return
+        except Exception:
+            logger.exception("Job %s failed", job_id)
+            self.store.mark_failed(job_id, traceback.format_exc(limit=5))
+            return
+        for summary in summaries or ():
+            METRICS.observe(summary)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
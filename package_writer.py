@@ -0,0 +1,94 @@
+"""Saving a document without recompressing the parts it did not change.
+
+``doc.save()`` deflates every part of the package again, including the
+embedded images under ``word/media/``, whose bytes the formatters never
+touch.  ``save_document`` writes the same package but copies the compressed
+bytes of every part that is unchanged from the input archive straight into
+the output; only the parts whose content differs (in practice the XML parts
+a formatter modified) are compressed again.  ``copy_member`` does the same
+for a single archive member and is also used by the streaming engine.
+"""
+import struct
+import zipfile
+import zlib
+
+from docx.opc.packuri import PACKAGE_URI
+from docx.opc.pkgwriter import PackageWriter
+
+# Fixed part of a zip local file header; the name and extra field lengths are its last two fields
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+DATA_DESCRIPTOR_FLAG = 0x08
+ENCRYPTED_FLAG = 0x01
+
+
+def _read_compressed(zin, info):
+    """The compressed bytes of ``info`` as stored in ``zin``."""
+    fp = zin.fp
+    fp.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+    name_length, extra_length = header[-2:]
+    fp.seek(info.header_offset + LOCAL_HEADER.size + name_length + extra_length)
+    return fp.read(info.compress_size)
+
+
+# Function to copy an archive member without decompressing and recompressing it
+def copy_member(zin, info, zout, arcname=None):
+    if info.flag_bits & ENCRYPTED_FLAG:
+        zout.writestr(arcname or info.filename, zin.read(info), info.compress_type)
+        return
+    data = _read_compressed(zin, info)
+
+    target = zipfile.ZipInfo(arcname or info.filename, date_time=info.date_time)
+    target.compress_type = info.compress_type
+    target.external_attr = info.external_attr
+    target.CRC = info.CRC
+    target.compress_size = info.compress_size
+    target.file_size = info.file_size
+    # The sizes and CRC go into the local header, so no data descriptor follows the data
+    target.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    target.header_offset = zout.fp.tell()
+    zout.fp.write(target.FileHeader())
+    zout.fp.write(data)
+    zout.filelist.append(target)
+    zout.NameToInfo[target.filename] = target
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+class _ReusingPkgWriter:
+    """python-docx's zip package writer, copying unchanged parts from ``source``."""
+
+    def __init__(self, output, source):
+        self._source = zipfile.ZipFile(source)
+        self._zip = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, pack_uri, blob):
+        try:
+            info = self._source.getinfo(pack_uri.membername)
+        except KeyError:
+            info = None
+        if info is not None and info.file_size == len(blob) and info.CRC == zlib.crc32(blob):
+            copy_member(self._source, info, self._zip)
+        else:
+            self._zip.writestr(pack_uri.membername, blob)
+
+    def close(self):
+        self._zip.close()
+        self._source.close()
+
+
+# Function to save a document opened from ``source`` (a path or file-like object)
+def save_document(doc, output, source):
+    """Like ``doc.save(output)``, but parts unchanged from ``source`` are not recompressed."""
+    package = doc.part.package
+    parts = package.parts
+    for part in parts:
+        part.before_marshal()
+    writer = _ReusingPkgWriter(output, source)
+    try:
+        PackageWriter._write_content_types_stream(writer, parts)
+        writer.write(PACKAGE_URI.rels_uri, package.rels.xml)
+        PackageWriter._write_parts(writer, parts)
+    finally:
+        writer.close()
+    return output
@@ -0,0 +1,62 @@
+"""Single-pass visitor over the paragraphs of a document.
+
+Formatting stages register a handler each; ``walk`` visits every paragraph
+once and calls the handlers in registration order, so a document is
+traversed in one linear pass no matter how many stages there are.  Stages
+that need look-back read the previous visits from a small window.  While a document
+is being traced, the time spent in each handler is recorded as a stage named
+after it.
+"""
+import time
+from collections import deque
+
+import instrumentation
+
+
+class ParagraphVisit:
+    """A paragraph being visited.  Handlers may attach their own attributes."""
+
+    def __init__(self, index, paragraph, text, previous):
+        self.index = index
+        self.paragraph = paragraph
+        self.text = text  # stripped paragraph text; stages that rewrite it keep it current
+        self.previous = previous  # earlier visits, most recent last
+
+
+class ParagraphWalker:
+    """Runs registered ``handler(visit)`` stages over paragraphs in one pass."""
+
+    def __init__(self, window=1):
+        self.window = window
+        self.handlers = []
+
+    def register(self, name, handler):
+        self.handlers.append((name, handler))
+        return handler
+
+    def walk(self, paragraphs, texts=None):
+        """Visits ``paragraphs`` in order; ``texts`` optionally supplies their stripped text."""
+        if instrumentation.is_tracing():
+            self._walk_timed(paragraphs, texts)
+            return
+        previous = deque(maxlen=self.window)
+        for index, paragraph in enumerate(paragraphs):
+            text = texts[index] if texts is not None else paragraph.text.strip()
+            visit = ParagraphVisit(index, paragraph, text, previous)
+            for _, handler in self.handlers:
+                handler(visit)
+            previous.append(visit)
+
+    def _walk_timed(self, paragraphs, texts):
+        seconds = [0.0] * len(self.handlers)
+        previous = deque(maxlen=self.window)
+        for index, paragraph in enumerate(paragraphs):
+            text = texts[index] if texts is not None else paragraph.text.strip()
+            visit = ParagraphVisit(index, paragraph, text, previous)
+            for h, (_, handler) in enumerate(self.handlers):
+                start = time.perf_counter()
+                handler(visit)
+                seconds[h] += time.perf_counter() - start
+            previous.append(visit)
+        for (name, _), elapsed in zip(self.handlers, seconds):
+            instrumentation.record(name, elapsed)
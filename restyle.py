@@ -0,0 +1,408 @@
+"""Formatting through the styles part instead of direct run formatting.
+
+``apply_formatting`` sets the font, size, colour and emphasis on every run,
+so a long paper ends up with the same ``w:rPr`` children repeated tens of
+thousands of times.  ``restyle_document`` writes each section's format into
+the definition of the paragraph style that selects it, once per document,
+and then only removes the run and paragraph properties that would override
+the style.  Every paragraph looks the same as with ``format_document``:
+paragraphs that still inherit from a restyled style without being formatted
+by it (table cells, text boxes and headers in Normal, or paragraphs in
+styles based on Normal) get what restyling changed in their format set on
+them directly.  ``benchmarks.restyle_check`` compares the two modes.
+
+Paragraphs are still formatted directly when the style cannot stand in for
+them: their section was not chosen by their style (e.g. a detected title),
+the section's format is computed per paragraph, or one of their runs has a
+character style that could override the paragraph style.
+"""
+import functools
+from copy import deepcopy
+
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_UNDERLINE
+from docx.oxml.ns import qn
+from docx.oxml.parser import OxmlElement
+from docx.shared import Pt, RGBColor
+from docx.styles.style import StyleFactory
+
+from element_index import BODY
+from style_rules import format_entry
+
+# The format keyword arguments a paragraph style can express
+STYLE_KEYS = {"font_name", "font_size", "bold", "italic", "underline", "alignment"}
+
+# Emphasis elements set by apply_formatting, by format keyword
+_EMPHASIS = {
+    "bold": qn("w:b"),
+    "italic": qn("w:i"),
+    "underline": qn("w:u"),
+}
+# w:rFonts attributes that decide the font of Latin text; the theme ones take precedence
+_FONT_ATTRIBUTES = (qn("w:ascii"), qn("w:hAnsi"))
+_THEME_FONT_ATTRIBUTES = (qn("w:asciiTheme"), qn("w:hAnsiTheme"))
+
+
+def _style_chain(style):
+    """``style`` and the styles it is based on, nearest first."""
+    seen = set()
+    while style is not None and style.style_id not in seen:
+        seen.add(style.style_id)
+        yield style
+        style = style.base_style
+
+
+def _alignment(style):
+    return next((s.paragraph_format.alignment for s in _style_chain(style)
+                 if s.paragraph_format.alignment is not None), None)
+
+
+def _unless_inherited(style, name, value):
+    """``value`` for the style's font property ``name``, or None when the style would inherit it anyway."""
+    for base in list(_style_chain(style))[1:]:
+        inherited = getattr(base.font, name)
+        if inherited is not None:
+            return None if bool(inherited) == value else value
+    return value or None
+
+
+def set_style_format(style, font_name, font_size, bold=False, italic=False, underline=None, alignment=None):
+    """Gives a paragraph style the format ``apply_formatting`` would give its runs."""
+    font = style.font
+    font.name = font_name
+    rFonts = style.element.rPr.rFonts
+    for attribute in _THEME_FONT_ATTRIBUTES:
+        rFonts.attrib.pop(attribute, None)
+    font.size = Pt(font_size)
+    font.color.rgb = RGBColor(0, 0, 0)
+    # Explicit "off" values would also override table styles in every style based on this one
+    font.bold = _unless_inherited(style, "bold", bold)
+    font.italic = _unless_inherited(style, "italic", italic)
+    if underline is not None:
+        font.underline = WD_UNDERLINE.SINGLE if underline is True else underline
+    if alignment:  # like apply_formatting, which leaves LEFT (0) unset
+        style.paragraph_format.alignment = alignment
+
+
+def clear_direct_formatting(paragraph, spec):
+    """Removes the direct properties of ``paragraph`` that would override a style set with ``spec``."""
+    p = paragraph._p
+    if spec.get("alignment") and p.pPr is not None:
+        p.pPr._remove_jc()
+    # apply_formatting always sets bold and italic (off by default), underline only when given
+    emphasis = [tag for key, tag in _EMPHASIS.items() if key != "underline" or key in spec]
+    for r in p.r_lst:
+        rPr = r.rPr
+        if rPr is None:
+            continue
+        rFonts = rPr.rFonts
+        if rFonts is not None:
+            for attribute in _FONT_ATTRIBUTES + _THEME_FONT_ATTRIBUTES:
+                rFonts.attrib.pop(attribute, None)
+            if not len(rFonts.attrib):
+                rPr.remove(rFonts)
+        rPr._remove_sz()
+        rPr._remove_color()
+        for child in rPr.findall("*"):
+            if child.tag in emphasis:
+                rPr.remove(child)
+
+
+def _has_character_style(paragraph):
+    return any(r.rPr is not None and r.rPr.style is not None for r in paragraph._p.r_lst)
+
+
+def restyle_styles(styles, formats):
+    """Writes ``formats`` (style id -> format) into the paragraph styles of ``styles``.
+
+    Base styles are rewritten before the styles based on them, so inherited
+    emphasis is judged against its final value.  Every other paragraph style
+    keeps the alignment it had, even when it inherited it from a rewritten style.
+    """
+    paragraph_styles = {element.styleId: StyleFactory(element) for element in styles.element.style_lst
+                        if element.type == WD_STYLE_TYPE.PARAGRAPH}
+    alignments = {style_id: _alignment(style) for style_id, style in paragraph_styles.items()}
+    for style_id in sorted(formats, key=lambda style_id: len(list(_style_chain(paragraph_styles[style_id])))):
+        set_style_format(paragraph_styles[style_id], **formats[style_id])
+    for style_id, style in paragraph_styles.items():
+        if style_id in formats and formats[style_id].get("alignment"):
+            continue
+        if _alignment(style) != alignments[style_id]:
+            style.paragraph_format.alignment = alignments[style_id] or WD_PARAGRAPH_ALIGNMENT.LEFT
+
+
+# Run properties restyling rewrites, then the paragraph alignment
+_PROPERTIES = ("b", "i", "u", "color", "sz", "ascii", "hAnsi", "jc")
+_TOGGLES = ("b", "i")
+_VAL = qn("w:val")
+# What Word uses when nothing sets a property
+_DEFAULTS = {
+    "b": False,
+    "i": False,
+    "u": ("u", ((_VAL, "none"),)),
+    "color": ("color", ((_VAL, "auto"),)),
+    "sz": ("sz", ((_VAL, "20"),)),
+    "ascii": (qn("w:ascii"), "Times New Roman"),
+    "hAnsi": (qn("w:hAnsi"), "Times New Roman"),
+    "jc": ("jc", ((_VAL, "left"),)),
+}
+_TAGS = {name: qn("w:" + name)
+         for name in _PROPERTIES + ("rFonts", "rStyle", "pPr", "pStyle", "rPr", "tblPr", "tblStyle")}
+_FONT_SLOTS = {name: (qn("w:%sTheme" % name), qn("w:" + name)) for name in ("ascii", "hAnsi")}
+_P = qn("w:p")
+_R = qn("w:r")
+_TBL = qn("w:tbl")
+_TBL_STYLE_PR = qn("w:tblStylePr")
+_TXBX_CONTENT = qn("w:txbxContent")
+
+
+class _StyleResolver:
+    """The properties restyling can change, as paragraphs inherit them from the styles part.
+
+    A paragraph gets them from its paragraph style chain, then from the
+    (unconditional) properties of its table's style, then from the document
+    defaults; ``_DEFAULTS`` stands in where nothing sets them.
+    """
+
+    def __init__(self, styles_element):
+        self._styles = {style.styleId: style for style in styles_element.style_lst}
+        self._default_ids = {}
+        for style in styles_element.style_lst:
+            if style.default:
+                self._default_ids[style.type] = style.styleId  # the last default in document order wins
+        self._doc_defaults = {
+            "pPr": next(iter(styles_element.xpath("./w:docDefaults/w:pPrDefault/w:pPr")), None),
+            "rPr": next(iter(styles_element.xpath("./w:docDefaults/w:rPrDefault/w:rPr")), None),
+        }
+        self._resolved = {}
+        self._character = {}
+
+    def _chain(self, style_id, style_type):
+        if style_id not in self._styles or self._styles[style_id].type != style_type:
+            style_id = self._default_ids.get(style_type)
+        chain = []
+        style = self._styles.get(style_id)
+        while style is not None and style not in chain:
+            chain.append(style)
+            style = self._styles.get(style.basedOn_val)
+        return chain
+
+    def paragraph_chain(self, style_id):
+        """The ids of the paragraph style ``style_id`` and the styles it is based on, nearest first."""
+        return [style.styleId for style in self._chain(style_id, WD_STYLE_TYPE.PARAGRAPH)]
+
+    def resolve(self, key):
+        """{property: (value, set by the paragraph style chain)} for paragraphs with ``_paragraph_key`` ``key``."""
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        paragraph_chain = self._chain(key[0], WD_STYLE_TYPE.PARAGRAPH)
+        table_chain = self._chain(key[1], WD_STYLE_TYPE.TABLE) if key[1] is not False else []
+        resolved = self._resolved[key] = {}
+        for name in _PROPERTIES:
+            kind = "pPr" if name == "jc" else "rPr"
+            for index, style in enumerate(paragraph_chain + table_chain):
+                value = _property(getattr(style, kind), name)
+                if value is not None:
+                    resolved[name] = (value, index < len(paragraph_chain))
+                    break
+            else:
+                value = _property(self._doc_defaults[kind], name)
+                resolved[name] = (_DEFAULTS[name] if value is None else value, False)
+        return resolved
+
+    def conditional(self, table_style_id):
+        """The properties the conditional formats (e.g. header row) of a table style set."""
+        names = set()
+        for style in self._chain(table_style_id, WD_STYLE_TYPE.TABLE):
+            for kind in style.iterchildren(_TBL_STYLE_PR):
+                for name in _PROPERTIES:
+                    if _property(kind.find(_TAGS["pPr" if name == "jc" else "rPr"]), name) is not None:
+                        names.add(name)
+        return names
+
+    def character(self, style_id):
+        """{property: value} set by the character style ``style_id`` and the styles it is based on."""
+        try:
+            return self._character[style_id]
+        except KeyError:
+            pass
+        values = self._character[style_id] = {}
+        if style_id is not None:
+            for style in reversed(self._chain(style_id, WD_STYLE_TYPE.CHARACTER)):
+                for name in _PROPERTIES[:-1]:
+                    value = _property(style.rPr, name)
+                    if value is not None:
+                        values[name] = value
+        return values
+
+
+def _property(properties, name):
+    """The value of ``name`` set in a ``w:rPr`` or ``w:pPr`` element, or None."""
+    if properties is None:
+        return None
+    if name in _FONT_SLOTS:
+        rFonts = properties.find(_TAGS["rFonts"])
+        if rFonts is not None:
+            for attribute in _FONT_SLOTS[name]:
+                if rFonts.get(attribute) is not None:
+                    return attribute, rFonts.get(attribute)
+        return None
+    element = properties.find(_TAGS[name])
+    if element is None:
+        return None
+    if name in _TOGGLES:
+        return element.val
+    return name, tuple(sorted(element.attrib.items()))
+
+
+def _set_property(properties, name, value):
+    """Sets ``name`` to ``value`` (as returned by ``_property``) in a ``w:rPr`` or ``w:pPr`` element."""
+    if name in _FONT_SLOTS:
+        properties.get_or_add_rFonts().set(*value)
+    elif name in _TOGGLES:
+        getattr(properties, "get_or_add_" + name)().val = value
+    else:
+        getattr(properties, "_insert_" + name)(deepcopy(_element(value)))
+
+
+@functools.lru_cache(maxsize=None)
+def _element(value):
+    """A ``w:u``, ``w:color``, ``w:sz`` or ``w:jc`` element with the attributes in ``value``."""
+    element = OxmlElement("w:" + value[0])
+    for attribute, attribute_value in value[1]:
+        element.set(attribute, attribute_value)
+    return element
+
+
+def _paragraph_key(p):
+    """(style id, table style id) of paragraph element ``p``: what its inherited format depends on.
+
+    The table style id is None for the default table style and False outside tables.
+    """
+    pPr = p.find(_TAGS["pPr"])
+    pStyle = pPr.find(_TAGS["pStyle"]) if pPr is not None else None
+    style_id = pStyle.get(_VAL) if pStyle is not None else None
+    for ancestor in p.iterancestors(_TBL, _TXBX_CONTENT):
+        if ancestor.tag == _TXBX_CONTENT:
+            break
+        tblPr = ancestor.find(_TAGS["tblPr"])
+        tblStyle = tblPr.find(_TAGS["tblStyle"]) if tblPr is not None else None
+        return style_id, tblStyle.get(_VAL) if tblStyle is not None else None
+    return style_id, False
+
+
+def _runs(element, p):
+    """The runs of paragraph element ``p`` in ``element``, without those of paragraphs nested in it (text boxes)."""
+    return [r for r in element.iter(_R) if next(r.iterancestors(_P)) is p]
+
+
+def _restyled_properties(spec):
+    """The properties ``set_style_format`` may write into a style given ``spec``."""
+    names = {"b", "i", "color", "sz", "ascii", "hAnsi"}
+    if spec.get("underline") is not None:
+        names.add("u")
+    if spec.get("alignment"):
+        names.add("jc")
+    return names
+
+
+def keep_inherited_format(p, changed, runs, alignment=True, character=None):
+    """Sets directly on ``runs`` (and ``p``, with ``alignment``) the inherited format ``changed`` by restyling.
+
+    ``changed`` maps properties to the values they had before restyling.  Only
+    properties not set directly are added; runs whose character style sets a
+    property keep it, bold and italic being toggled by the character style
+    rather than replaced.  ``character`` returns the properties a character
+    style id sets (see ``_StyleResolver.character``).
+    """
+    if alignment and "jc" in changed and _property(p.find(_TAGS["pPr"]), "jc") is None:
+        _set_property(p.get_or_add_pPr(), "jc", changed["jc"])
+    run_changes = [(name, value) for name, value in changed.items() if name != "jc"]
+    for r in runs:
+        rPr = r.find(_TAGS["rPr"])
+        rStyle = rPr.find(_TAGS["rStyle"]) if rPr is not None else None
+        character_format = character(rStyle.get(_VAL)) if character is not None and rStyle is not None else {}
+        for name, value in run_changes:
+            if _property(rPr, name) is not None:
+                continue
+            if name in _TOGGLES and name in character_format:
+                value = value != character_format[name]
+            elif name in character_format:
+                continue
+            rPr = r.get_or_add_rPr()
+            _set_property(rPr, name, value)
+
+
+# Function to format an ElementIndex through the styles part
+def restyle_document(doc, entries, styles, identify_section, formats, apply_formatting, container_font=None):
+    """Formats like ``format_document`` (without hooks); ``styles`` is the document's DocumentStyles.
+
+    Paragraphs the styles don't format (other containers, paragraphs formatted
+    directly) keep the look they had through their styles: what restyling
+    changes in it is set on them directly.  A style is left alone when a
+    table paragraph based on it could get a property from a conditional
+    format of its table style (e.g. a bold header row) that restyling would
+    override.
+    """
+    styles_element = doc.styles.element
+    before = _StyleResolver(deepcopy(styles_element))  # resolved lazily, so not from the live styles
+    style_formats = {}  # style id -> the format its paragraphs get, or None if it can't be used
+
+    def style_format(paragraph):
+        style_id = styles.style_id(paragraph)
+        try:
+            return style_formats[style_id]
+        except KeyError:
+            pass
+        spec = formats[styles.section(paragraph)]
+        if style_id is None or styles_element.get_by_id(style_id) is None:
+            spec = None
+        elif callable(spec) or not STYLE_KEYS.issuperset(spec):
+            spec = None
+        style_formats[style_id] = spec
+        return spec
+
+    # Decide which body paragraphs their style can format before changing any style
+    keys = [_paragraph_key(entry.paragraph._p) for entry in entries]
+    while True:
+        plan = []
+        for entry in entries:
+            paragraph = entry.paragraph
+            spec = None
+            if entry.container == BODY and not _has_character_style(paragraph):
+                if identify_section(paragraph) == styles.section(paragraph):
+                    spec = style_format(paragraph)
+            plan.append(spec)
+        restyled = {style_id: spec for style_id, spec in style_formats.items() if spec is not None}
+        # Restyling must not override what a table paragraph gets from its table style's conditional formats
+        blocked = set()
+        for key in set(key for key, spec in zip(keys, plan) if spec is None and key[1] is not False):
+            chain = [style_id for style_id in before.paragraph_chain(key[0]) if style_id in restyled]
+            overridden = set().union(*(_restyled_properties(restyled[style_id]) for style_id in chain))
+            resolved = before.resolve(key)
+            if any(not resolved[name][1] for name in overridden & before.conditional(key[1])):
+                blocked.update(chain)
+        if not blocked:
+            break
+        style_formats.update(dict.fromkeys(blocked))
+
+    restyle_styles(doc.styles, restyled)
+    after = _StyleResolver(styles_element)
+    changes = {}
+    for key in set(keys):
+        old, new = before.resolve(key), after.resolve(key)
+        changes[key] = {name: old[name][0] for name in _PROPERTIES if old[name][0] != new[name][0]}
+    for entry, key, spec in zip(entries, keys, plan):
+        p = entry.paragraph._p
+        if spec is not None:
+            clear_direct_formatting(entry.paragraph, spec)
+            # The runs clear_direct_formatting leaves alone: those not directly in the paragraph
+            runs = [r for child in p for r in _runs(child, p) if r is not child]
+            if changes[key] and runs:
+                keep_inherited_format(p, changes[key], runs, alignment=False, character=after.character)
+        else:
+            format_entry(entry, identify_section, formats, apply_formatting, container_font=container_font)
+            if changes[key]:
+                keep_inherited_format(p, changes[key], _runs(p, p), character=after.character)
@@ -0,0 +1,83 @@
+"""Content-addressed cache of formatted documents.
+
+Results are keyed on the SHA-256 of the uploaded bytes, the formatting style
+and the formatter version, and stored as files in a local directory.  Reads
+refresh a file's modification time so eviction drops the least recently used
+entries once the directory grows beyond its size limit.  ``get`` hands out an
+open file rather than a path, so an entry evicted by a concurrent request
+stays readable until the response has been sent.
+"""
+import hashlib
+import os
+import threading
+import uuid
+
+SUFFIX = '.docx'
+
+
+# Function to compute the cache key (also used as the HTTP ETag)
+def cache_key(data, style, version):
+    digest = hashlib.sha256()
+    digest.update(data)
+    digest.update(b'\0')
+    digest.update(style.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(str(version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of formatted documents on local disk."""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + SUFFIX)
+
+    def get(self, key):
+        """Returns the cached result opened for reading (the caller closes it), or None on a miss."""
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(f.fileno())  # Mark as recently used
+        return f
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if not entry.name.endswith(SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
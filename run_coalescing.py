@@ -0,0 +1,96 @@
+"""Merging the runs Word fragments a paragraph into.
+
+Word splits text into a new ``w:r`` at every revision, spell-check mark and
+autocorrection, so one sentence is often a dozen runs with identical
+properties, each walked by every formatting pass.  ``coalesce_runs`` strips
+the revision ids (``w:rsid*`` attributes) and spell-check marks
+(``w:proofErr``), drops runs without content and merges adjacent text runs
+whose properties are equal.  The text and the formatting of every character
+are unchanged.  The formatters run it once, right after opening a document.
+"""
+from docx.oxml.ns import qn
+from lxml import etree
+
+from element_index import story_parts
+
+_R = qn('w:r')
+_T = qn('w:t')
+_RPR = qn('w:rPr')
+_PROOF_ERR = qn('w:proofErr')
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+RSID_ATTRIBUTES = frozenset(qn('w:' + name) for name in (
+    'rsidR', 'rsidRPr', 'rsidRDefault', 'rsidP', 'rsidDel', 'rsidSect', 'rsidTr'))
+
+# Keys of runs without content
+_EMPTY = object()
+
+
+def _run_key(r):
+    """The rPr of a run holding only text (as bytes), _EMPTY for a run without content, else None."""
+    rPr = None
+    has_text = False
+    for child in r:
+        if child.tag == _RPR:
+            rPr = child
+        elif child.tag == _T:
+            has_text = has_text or bool(child.text)
+        else:
+            return None
+    if not has_text:
+        return _EMPTY
+    return etree.tostring(rPr) if rPr is not None else b''
+
+
+def _merge_into(target, r):
+    """Appends the text of run ``r`` to the single w:t of ``target``."""
+    texts = target.findall(_T)
+    t = texts[0]
+    t.text = ''.join(x.text or '' for x in texts) + ''.join(x.text or '' for x in r.iter(_T))
+    for extra in texts[1:]:
+        target.remove(extra)
+    if t.text != t.text.strip():
+        t.set(_XML_SPACE, 'preserve')
+
+
+def _coalesce_children(parent):
+    removed = 0
+    previous = previous_key = None
+    for child in list(parent):
+        key = _run_key(child) if child.tag == _R else None
+        if key is _EMPTY:
+            parent.remove(child)
+            removed += 1
+        elif key is not None and key == previous_key:
+            _merge_into(previous, child)
+            parent.remove(child)
+            removed += 1
+        else:
+            previous, previous_key = (child, key) if key is not None else (None, None)
+    return removed
+
+
+# Function to normalize the runs of every paragraph under an element
+def coalesce_runs(root):
+    """Returns the number of runs removed."""
+    for proof_err in list(root.iter(_PROOF_ERR)):
+        proof_err.getparent().remove(proof_err)
+    parents = []
+    seen = set()
+    for element in root.iter():
+        if not RSID_ATTRIBUTES.isdisjoint(element.attrib):
+            for name in RSID_ATTRIBUTES.intersection(element.attrib):
+                del element.attrib[name]
+        if element.tag == _R:
+            parent = element.getparent()
+            if parent not in seen:
+                seen.add(parent)
+                parents.append(parent)
+    return sum(_coalesce_children(parent) for parent in parents)
+
+
+def coalesce_document(doc):
+    """Coalesces the runs of the body, headers, footers and notes of ``doc``."""
+    removed = coalesce_runs(doc.element.body)
+    for _, part in story_parts(doc.part):
+        removed += coalesce_runs(part.element)
+    return removed
@@ -0,0 +1,105 @@
+"""Run properties compiled once and copied onto runs.
+
+Setting ``run.font.name``, ``size``, ``bold``, ``italic`` and ``color`` goes
+through a python-docx proxy per property, and every setter looks up or
+creates its own ``w:rPr`` child.  ``run_template`` compiles a combination of
+those properties into a ``w:rPr`` element once per process, using the same
+setters on a scratch run so the XML is exactly what they would produce.
+``RunTemplate.apply`` then copies it onto a run: a single clone for a run
+without properties, otherwise one replacement per templated child.
+
+A property left at ``KEEP`` is not touched.  ``KEEP_ON`` (for bold, italic
+and underline) keeps the run's own value when it is switched on and
+switches it off otherwise, like ``font.bold = True if run.bold else False``.
+"""
+import functools
+from copy import deepcopy
+
+from docx.oxml.ns import qn
+from docx.oxml.parser import OxmlElement
+from docx.shared import Pt
+from docx.text.run import Run
+
+KEEP = object()
+KEEP_ON = object()
+
+_RPR = qn('w:rPr')
+_RFONTS = qn('w:rFonts')
+_EMPHASIS = {'bold': qn('w:b'), 'italic': qn('w:i'), 'underline': qn('w:u')}
+_VAL = qn('w:val')
+_OFF_VALUES = ('0', 'false', 'off', 'none')
+# Schema order of the w:rPr children (CT_RPr), for inserting the ones a run does not have yet
+RPR_CHILDREN = (
+    'rStyle', 'rFonts', 'b', 'bCs', 'i', 'iCs', 'caps', 'smallCaps', 'strike', 'dstrike', 'outline', 'shadow',
+    'emboss', 'imprint', 'noProof', 'snapToGrid', 'vanish', 'webHidden', 'color', 'spacing', 'w', 'kern',
+    'position', 'sz', 'szCs', 'highlight', 'u', 'effect', 'bdr', 'shd', 'fitText', 'vertAlign', 'rtl', 'cs',
+    'em', 'lang', 'eastAsianLayout', 'specVanish', 'oMath',
+)
+_ORDER = {qn('w:' + name): i for i, name in enumerate(RPR_CHILDREN)}
+
+
+def _is_on(element):
+    return element.get(_VAL) not in _OFF_VALUES
+
+
+def _insert(rPr, element):
+    position = _ORDER.get(element.tag, len(_ORDER))
+    for i, child in enumerate(rPr):
+        if _ORDER.get(child.tag, len(_ORDER)) > position:
+            rPr.insert(i, element)
+            return
+    rPr.append(element)
+
+
+class RunTemplate:
+    """A compiled ``w:rPr``; see ``run_template``."""
+
+    def __init__(self, rPr, keep_on):
+        self.rPr = rPr
+        self._children = [(child.tag, child) for child in rPr]
+        self._keep_on = frozenset(keep_on)
+
+    def apply(self, r):
+        """Gives the run element ``r`` the template's properties."""
+        rPr = r.find(_RPR)
+        if rPr is None:
+            r.insert(0, deepcopy(self.rPr))
+            return
+        existing = {child.tag: child for child in rPr}
+        for tag, template_child in self._children:
+            current = existing.get(tag)
+            if current is None:
+                _insert(rPr, deepcopy(template_child))
+            elif tag == _RFONTS:
+                current.attrib.update(template_child.attrib)  # keeps the East Asian and complex script fonts
+            elif tag in self._keep_on and _is_on(current):
+                current.attrib.pop(_VAL, None)  # as switching it on again would
+            else:
+                rPr.replace(current, deepcopy(template_child))
+
+    def apply_to_paragraph(self, paragraph):
+        """Applies the template to every run of ``paragraph`` (like ``paragraph.runs``)."""
+        for r in paragraph._p.r_lst:
+            self.apply(r)
+
+
+# Function to compile run properties into a template, once per combination
+@functools.lru_cache(maxsize=None)
+def run_template(font_name=KEEP, font_size=KEEP, bold=KEEP, italic=KEEP, underline=KEEP, color=KEEP):
+    """A RunTemplate setting the given ``Font`` properties (``font_size`` in points)."""
+    run = Run(OxmlElement('w:r'), None)
+    font = run.font
+    if font_name is not KEEP:
+        font.name = font_name
+    if font_size is not KEEP:
+        font.size = Pt(font_size)
+    keep_on = []
+    for name, value in (('bold', bold), ('italic', italic), ('underline', underline)):
+        if value is KEEP_ON:
+            keep_on.append(_EMPHASIS[name])
+            value = False
+        if value is not KEEP:
+            setattr(font, name, value)
+    if color is not KEEP:
+        font.color.rgb = color
+    return RunTemplate(run._r.get_or_add_rPr(), keep_on)
@@ -0,0 +1,235 @@
+"""Streaming formatter engine for styles that only restyle paragraphs in place.
+
+``docx.Document()`` parses the whole main document part and keeps it in
+memory alongside python-docx's proxy objects, so peak memory grows with the
+size of the manuscript.  Styles that only change run properties, paragraph
+alignment and section properties don't need the whole tree: this engine
+pulls ``word/document.xml`` through an incremental parser, hands each
+top-level body element to the style as soon as it is complete, writes it to
+the output archive and drops it.  Every other part is copied through
+without being decompressed, so memory stays flat however large the document is.
+
+The parser uses python-docx's element classes, so the callbacks receive the
+usual ``Paragraph`` and ``Section`` objects and the styles reuse their
+existing ``apply_formatting`` and ``identify_section`` functions.  Paragraphs
+are indexed like ``element_index.ElementIndex`` does for a loaded document:
+the header, footer and notes parts are small, so they are parsed whole,
+formatted and written out again.
+"""
+import posixpath
+import zipfile
+
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml.ns import qn
+from docx.oxml.parser import element_class_lookup, parse_xml
+from docx.section import Section
+from docx.styles.styles import Styles
+from docx.text.paragraph import Paragraph
+from lxml import etree
+
+from element_index import BODY, STORY_RELS, iter_entries
+from package_writer import copy_member
+from run_coalescing import coalesce_runs
+from style_rules import DocumentStyles
+
+CHUNK_SIZE = 64 * 1024
+# Parts this large may outgrow the 4 GiB zip limit once rewritten
+ZIP64_THRESHOLD = zipfile.ZIP64_LIMIT // 2
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+STYLES_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles'
+EMPTY_STYLES = '<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>'
+
+
+def _rels_name(part_name):
+    directory, filename = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', filename + '.rels')
+
+
+def _relationships(zin, source_name):
+    """Yields (type, part name) for the internal relationships of ``source_name`` ('' for the package)."""
+    try:
+        rels = etree.fromstring(zin.read(_rels_name(source_name)))
+    except KeyError:
+        return
+    for rel in rels:
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target')
+        if target.startswith('/'):
+            yield rel.get('Type'), target[1:]
+        else:
+            yield rel.get('Type'), posixpath.normpath(posixpath.join(posixpath.dirname(source_name), target))
+
+
+def _relationship_target(zin, source_name, rel_type):
+    """The part name targeted by the first ``rel_type`` relationship of ``source_name``."""
+    return next((name for type_, name in _relationships(zin, source_name) if type_ == rel_type), None)
+
+
+class StreamingDocument:
+    """A .docx opened for streaming; use as a context manager."""
+
+    def __init__(self, source, rules=None):
+        self._zip = zipfile.ZipFile(source)
+        self.document_part = _relationship_target(self._zip, '', OFFICE_DOCUMENT_REL) or 'word/document.xml'
+        styles_part = _relationship_target(self._zip, self.document_part, STYLES_REL)
+        styles_xml = self._zip.read(styles_part) if styles_part else EMPTY_STYLES
+        self.styles_element = parse_xml(styles_xml)
+        self.styles = DocumentStyles(Styles(self.styles_element), rules)
+        # Header, footer and notes part names -> story (see element_index)
+        self.story_parts = {name: STORY_RELS[rel_type] for rel_type, name in _relationships(self._zip, self.document_part)
+                            if rel_type in STORY_RELS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def _iter_events(self):
+        """Yields the parser's (event, element) pairs for the main document part."""
+        parser = etree.XMLPullParser(events=('start', 'end'), huge_tree=True)
+        parser.set_element_class_lookup(element_class_lookup)
+        with self._zip.open(self.document_part) as stream:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    def iter_paragraphs(self):
+        """Yields the body paragraphs (like ``doc.paragraphs``), discarding each after use."""
+        body_tag, p_tag = qn('w:body'), qn('w:p')
+        for event, element in self._iter_events():
+            if event != 'end':
+                continue
+            parent = element.getparent()
+            if parent is not None and parent.tag == body_tag:
+                if element.tag == p_tag:
+                    yield Paragraph(element, None)
+                parent.remove(element)
+
+    def find_title(self, max_paragraphs):
+        """Returns the text of the first paragraph with a "title" style (or None), and
+        the first ``max_paragraphs`` paragraphs with text for title detection."""
+        leading = []
+        for paragraph in self.iter_paragraphs():
+            if "title" in self.styles.lower_name(paragraph):
+                return paragraph.text.strip(), leading
+            if len(leading) < max_paragraphs and paragraph.text.strip():
+                leading.append(paragraph)
+        return None, leading
+
+    def rewrite(self, output, format_entry=None, format_section=None):
+        """Writes the document to ``output`` (a path or file-like object).
+
+        The runs of every story are coalesced (see run_coalescing), then
+        ``format_entry(entry)`` is called with an ``IndexedParagraph`` for every
+        paragraph of every story and ``format_section(section, index)`` for every
+        section, in document order.
+        """
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in self._zip.infolist():
+                story = self.story_parts.get(info.filename)
+                if story is not None:
+                    self._rewrite_story(zout, info, story, format_entry)
+                    continue
+                if info.filename != self.document_part:
+                    copy_member(self._zip, info, zout)
+                    continue
+                target = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                target.compress_type = info.compress_type
+                target.external_attr = info.external_attr
+                force_zip64 = info.file_size >= ZIP64_THRESHOLD
+                with zout.open(target, 'w', force_zip64=force_zip64) as dst:
+                    self._rewrite_document(dst, format_entry, format_section)
+        return output
+
+    def _rewrite_story(self, zout, info, story, format_entry):
+        element = parse_xml(self._zip.read(info))
+        coalesce_runs(element)
+        if format_entry is not None:
+            for entry in iter_entries(element, story):
+                format_entry(entry)
+        target = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        target.compress_type = info.compress_type
+        target.external_attr = info.external_attr
+        zout.writestr(target, serialize_part_xml(element))
+
+    def _rewrite_document(self, dst, format_entry, format_section):
+        body_tag, p_tag, sectPr_tag = qn('w:body'), qn('w:p'), qn('w:sectPr')
+        root = None
+        redundant = ()
+        section_index = 0
+
+        dst.write(XML_DECLARATION)
+        for event, element in self._iter_events():
+            parent = element.getparent()
+            if event == 'start':
+                if parent is None:
+                    root = element
+                    redundant = _namespace_declarations(root)
+                    dst.write(_start_tag(element, ()))
+                elif parent is root and element.tag == body_tag:
+                    dst.write(_start_tag(element, redundant))
+                continue
+
+            if parent is None:
+                dst.write(_end_tag(element))
+            elif element.tag == body_tag and parent is root:
+                dst.write(_end_tag(element))
+                root.remove(element)
+            elif parent is root or parent.tag == body_tag and parent.getparent() is root:
+                # A complete top-level element: format it, write it out and let it go
+                coalesce_runs(element)
+                sectPr = element if element.tag == sectPr_tag else None
+                if element.tag == p_tag:
+                    pPr = element.pPr
+                    sectPr = pPr.sectPr if pPr is not None else None
+                if sectPr is not None and format_section is not None:
+                    format_section(Section(sectPr, None), section_index)
+                if sectPr is not None:
+                    section_index += 1
+                if format_entry is not None:
+                    for entry in iter_entries(element, BODY):
+                        format_entry(entry)
+                dst.write(_strip_declarations(
+                    etree.tostring(element, encoding='UTF-8', xml_declaration=False, with_tail=False), redundant))
+                parent.remove(element)
+
+
+def _namespace_declarations(root):
+    """The xmlns attributes of the root element, as serialized."""
+    return tuple(
+        (b' xmlns:%s="%s"' % (prefix.encode(), uri.encode())) if prefix else (b' xmlns="%s"' % uri.encode())
+        for prefix, uri in root.nsmap.items()
+    )
+
+
+def _strip_declarations(data, declarations):
+    """Drops the namespace declarations already made by the root from the first start tag."""
+    end = data.index(b'>')
+    head = data[:end]
+    for declaration in declarations:
+        head = head.replace(declaration, b'', 1)
+    return head + data[end:]
+
+
+def _start_tag(element, declarations):
+    """The start tag of an element (its content may already be partly parsed, so it is left out)."""
+    empty = etree.Element(element.tag, attrib=dict(element.attrib), nsmap=element.nsmap)
+    data = _strip_declarations(etree.tostring(empty, encoding='UTF-8', xml_declaration=False), declarations)
+    return data[:-2] + b'>'  # <tag .../> -> <tag ...>
+
+
+def _end_tag(element):
+    return b'</%s>' % (('%s:%s' % (element.prefix, etree.QName(element).localname)) if element.prefix
+                       else etree.QName(element).localname).encode()
@@ -0,0 +1,135 @@
+"""Logging set-up shared by the web app, the job workers and the batch CLI.
+
+Every record carries the id of the request (or job) it belongs to, taken from
+a context variable, so the lines of one document can be picked out of
+interleaved worker output.  Debug output is sampled per request: either all
+of a request's debug records are kept or none are.  Callers pass their values
+as ``%`` arguments (and paragraph text through ``excerpt``) so nothing is
+formatted unless a record is actually emitted.
+
+Configuration comes from the environment:
+    LOG_LEVEL              minimum level (default INFO)
+    LOG_FORMAT             "text" or "json" (default text)
+    LOG_DEBUG_SAMPLE_RATE  fraction of requests whose debug records are kept (default 1.0)
+"""
+import contextvars
+import json
+import logging
+import os
+import uuid
+import zlib
+from contextlib import contextmanager
+
+_request_id = contextvars.ContextVar('request_id', default='-')
+
+# LogRecord attributes that are not structured fields passed through ``extra``
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    """Sets the id for the current context; returns a token for ``reset_request_id``."""
+    return _request_id.set(request_id or new_request_id())
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+@contextmanager
+def request_context(request_id=None):
+    token = set_request_id(request_id)
+    try:
+        yield _request_id.get()
+    finally:
+        reset_request_id(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds ``request_id`` to every record."""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keeps the debug records of a ``rate`` fraction of requests, chosen by request id."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        if self.rate <= 0:
+            return False
+        bucket = zlib.crc32(getattr(record, 'request_id', _request_id.get()).encode('utf-8')) % 10000
+        return bucket < self.rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with ``extra=`` are included."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+
+
+# Function to configure the root logger once per process
+def configure_logging(level=None, log_format=None, debug_sample_rate=None):
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    log_format = log_format or os.environ.get('LOG_FORMAT', 'text')
+    if debug_sample_rate is None:
+        debug_sample_rate = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(DebugSamplingFilter(debug_sample_rate))
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if getattr(h, '_structured', False)]:
+        root.removeHandler(existing)
+    handler._structured = True
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class excerpt:
+    """Lazily renders the start of a paragraph's (or string's) text for a log message."""
+
+    __slots__ = ('source', 'limit')
+
+    def __init__(self, source, limit=80):
+        self.source = source
+        self.limit = limit
+
+    def __str__(self):
+        text = self.source if isinstance(self.source, str) else self.source.text
+        text = ' '.join(text.split())
+        return text if len(text) <= self.limit else text[:self.limit - 3] + '...'
+
+    __repr__ = __str__
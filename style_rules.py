@@ -0,0 +1,176 @@
+"""Declarative rule tables shared by the formatting styles.
+
+Each style describes how paragraph style names map to section types with a
+list of ``Rule`` entries, and how each section type is formatted with a dict
+of keyword arguments for its ``apply_formatting`` function.  The rules are
+compiled once at import and every distinct style name is classified only
+once, after which classification is a single dict lookup.
+
+``format_document`` applies the rules to the body paragraphs of an
+``ElementIndex`` and gives the paragraphs in tables, text boxes, headers,
+footers and notes the style's journal font, in one pass.
+"""
+from collections import namedtuple
+
+from docx.enum.style import WD_STYLE_TYPE
+from docx.styles import BabelFish
+
+from element_index import BODY
+from run_templates import run_template
+
+_Rule = namedtuple("Rule", "section contains prefixes")
+
+
+def Rule(section, contains=(), prefixes=()):
+    """A section type matched by style name.
+
+    ``contains`` are substrings looked up in the lower-cased style name and
+    ``prefixes`` are compared case-sensitively with the start of the name.
+    """
+    return _Rule(section, tuple(c.lower() for c in contains), tuple(prefixes))
+
+
+class StyleRules:
+    """An ordered rule table; the first matching rule wins."""
+
+    def __init__(self, rules, default="body"):
+        self.rules = tuple(rules)
+        self.default = default
+        self._sections = {}
+
+    def classify(self, style_name):
+        try:
+            return self._sections[style_name]
+        except KeyError:
+            pass
+        lowered = style_name.lower()
+        section = self.default
+        for rule in self.rules:
+            if any(c in lowered for c in rule.contains) or any(style_name.startswith(p) for p in rule.prefixes):
+                section = rule.section
+                break
+        self._sections[style_name] = section
+        return section
+
+
+class DocumentStyles:
+    """Paragraph style names of one document, resolved once when it is opened.
+
+    ``paragraph.style`` searches the styles part on every access (and scans
+    every style to find the default when no ``w:pStyle`` is set).  This maps
+    each ``w:pStyle`` value to its UI style name up front, following the same
+    fallbacks as python-docx, and memoizes the section type of each style id
+    under ``rules``.
+    """
+
+    def __init__(self, styles, rules=None):
+        self.rules = rules
+        self._names = {}
+        self._lower_names = {}
+        self._sections = {}
+        default_name = default_id = None
+        for style in styles.element.style_lst:
+            if style.type != WD_STYLE_TYPE.PARAGRAPH:
+                continue
+            name = style.name_val
+            name = BabelFish.internal2ui(name) if name is not None else ""
+            if style.styleId is not None:
+                self._names.setdefault(style.styleId, name)
+            if style.default:
+                default_name, default_id = name, style.styleId  # the last default in document order wins
+        self.default_name = default_name or ""
+        self.default_id = default_id
+
+    def style_id(self, paragraph):
+        """The id of the style ``paragraph`` is shown in (the default style if unset or unknown)."""
+        style_id = paragraph._p.style
+        return style_id if style_id in self._names else self.default_id
+
+    def name(self, paragraph):
+        """The UI style name of ``paragraph`` (the default style if unset or unknown)."""
+        try:
+            return self._names[paragraph._p.style]
+        except KeyError:
+            return self.default_name
+
+    def lower_name(self, paragraph):
+        style_id = paragraph._p.style
+        try:
+            return self._lower_names[style_id]
+        except KeyError:
+            lowered = self._lower_names[style_id] = self.name(paragraph).lower()
+            return lowered
+
+    def section(self, paragraph):
+        """The section type of ``paragraph`` under this document's rule table."""
+        style_id = paragraph._p.style
+        try:
+            return self._sections[style_id]
+        except KeyError:
+            section = self._sections[style_id] = self.rules.classify(self.name(paragraph))
+            return section
+
+
+# Function to format paragraphs from a rule table
+def format_paragraphs(paragraphs, identify_section, formats, apply_formatting, hooks=None):
+    """Applies ``formats[section]`` to each paragraph with ``apply_formatting``.
+
+    A format may also be a callable taking the paragraph and returning the
+    keyword arguments.  ``hooks`` optionally maps a section type to a function
+    called with the paragraph after it has been formatted.
+    """
+    for paragraph in paragraphs:
+        format_paragraph(paragraph, identify_section, formats, apply_formatting, hooks)
+
+
+def format_paragraph(paragraph, identify_section, formats, apply_formatting, hooks=None, section=None):
+    """Formats one paragraph; see ``format_paragraphs``.  ``section`` skips identifying it again."""
+    if section is None:
+        section = identify_section(paragraph)
+    spec = formats[section]
+    if callable(spec):
+        spec = spec(paragraph)
+    apply_formatting(paragraph, **spec)
+    if hooks and section in hooks:
+        hooks[section](paragraph)
+
+
+# Function to format every paragraph of an ElementIndex
+def format_document(entries, identify_section, formats, apply_formatting, hooks=None, container_font=None,
+                    fragments=None):
+    """Formats body paragraphs like ``format_paragraphs``; see ``format_entry``."""
+    for entry in entries:
+        format_entry(entry, identify_section, formats, apply_formatting, hooks, container_font, fragments)
+
+
+def format_entry(entry, identify_section, formats, apply_formatting, hooks=None, container_font=None,
+                 fragments=None):
+    """Formats one IndexedParagraph.
+
+    Body paragraphs get their section's format.  Paragraphs in any other
+    container keep their paragraph and emphasis formatting and only get
+    ``container_font`` (keyword arguments for ``apply_container_font``), if given.
+    With ``fragments`` (a ``fragment_cache.Fragments``), a paragraph formatted
+    before with the same XML and section is copied from the cache instead.
+    """
+    paragraph = entry.paragraph
+    if entry.container == BODY:
+        section = identify_section(paragraph)
+        label = section
+    elif container_font:
+        label = entry.container
+    else:
+        return
+    key = fragments.key(label, paragraph._p) if fragments is not None else None
+    if key is not None and fragments.splice(key, paragraph._p):
+        return
+    if entry.container == BODY:
+        format_paragraph(paragraph, identify_section, formats, apply_formatting, hooks, section)
+    else:
+        apply_container_font(paragraph, **container_font)
+    if key is not None:
+        fragments.store(key, paragraph._p)
+
+
+def apply_container_font(paragraph, font_name, font_size):
+    run_template(font_name, font_size).apply_to_paragraph(paragraph)
@@ -0,0 +1,34 @@
+import importlib
+import io
+from contextlib import contextmanager
+
+import docx
+import pytest
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    monkeypatch.setenv('JOB_FOLDER', str(tmp_path / 'jobs'))
+    monkeypatch.setenv('RESULT_CACHE_MAX_MB', '0')
+    import app
+    app = importlib.reload(app)
+    app.app.testing = True
+    return app
+
+
+def test_trace_that_fails_to_start_raises_its_own_error(app_module, monkeypatch):
+    @contextmanager
+    def failing_trace(style, profiler=None):
+        raise RuntimeError("profiler already active")
+        yield
+
+    monkeypatch.setattr(app_module, 'trace_document', failing_trace)
+    source = io.BytesIO()
+    docx.Document().save(source)
+    source.seek(0)
+
+    with pytest.raises(RuntimeError, match="profiler already active"):
+        app_module.app.test_client().post('/process', data={
+            'docx_file': (source, 'paper.docx'),
+            'formatting_style': 'style_1',
+        })
@@ -0,0 +1,29 @@
+import io
+
+import docx
+from docx.shared import Pt
+
+import format_style_2
+
+
+def make_document():
+    doc = docx.Document()
+    # A header part that exists before formatting, so the element index sees its paragraph
+    doc.sections[0].header.paragraphs[0].text = "Journal of Examples"
+    doc.add_paragraph("A Study of Examples")
+    doc.add_paragraph("Abstract: " + "Some text. " * 20)
+    return doc
+
+
+def test_header_keeps_its_format():
+    source = io.BytesIO()
+    make_document().save(source)
+    source.seek(0)
+    output = io.BytesIO()
+    format_style_2.format_docx(source, output)
+
+    header = docx.Document(output).sections[0].header
+    runs = [run for paragraph in header.paragraphs for run in paragraph.runs if run.text]
+    assert [run.text for run in runs] == ["SmartCity"]
+    assert runs[0].font.size == Pt(12)
+    assert runs[0].font.bold
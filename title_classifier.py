@@ -0,0 +1,91 @@
+"""Shared BERT title classifier used by the formatting styles.
+
+The model is loaded on first use and then kept for the lifetime of the
+process, so documents that already carry a ``Title`` styled paragraph never
+pay for it.  Call ``preload()`` from the gunicorn master (see
+``gunicorn.conf.py``) to load it once before the workers fork and share the
+weights copy-on-write.
+"""
+import os
+import threading
+
+MODEL_NAME = "bert-base-uncased"
+
+# Titles live near the top, so only the leading paragraphs are classified
+MAX_PARAGRAPHS = int(os.environ.get("TITLE_MAX_PARAGRAPHS", "40"))
+BATCH_SIZE = int(os.environ.get("TITLE_BATCH_SIZE", "8"))
+MAX_TOKENS = int(os.environ.get("TITLE_MAX_TOKENS", "128"))
+
+_lock = threading.Lock()
+_tokenizer = None
+_model = None
+
+
+# Function to load the tokenizer and model once per process
+def get_classifier():
+    global _tokenizer, _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                from transformers import BertTokenizer, BertForSequenceClassification
+
+                tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
+                model = BertForSequenceClassification.from_pretrained(MODEL_NAME, num_labels=2)
+                model.eval()
+                _tokenizer = tokenizer
+                _model = model
+    return _tokenizer, _model
+
+
+# Function to load the model ahead of time (e.g. in the gunicorn master)
+def preload():
+    get_classifier()
+
+
+def is_loaded():
+    return _model is not None
+
+
+# Function to return the first paragraph text BERT labels as a title
+def identify_title(text_data, max_paragraphs=None, batch_size=None, max_tokens=None):
+    """Classifies the leading paragraphs in length-sorted mini-batches.
+
+    Only the first ``max_paragraphs`` texts are considered, each truncated to
+    ``max_tokens`` tokens.  Batches are padded to their own longest paragraph
+    and classification stops as soon as the earliest title in document order
+    is known.
+    """
+    max_paragraphs = MAX_PARAGRAPHS if max_paragraphs is None else max_paragraphs
+    batch_size = BATCH_SIZE if batch_size is None else batch_size
+    max_tokens = MAX_TOKENS if max_tokens is None else max_tokens
+
+    text_data = text_data[:max_paragraphs]
+    if not text_data:
+        return None
+
+    import torch
+
+    tokenizer, model = get_classifier()
+    encodings = tokenizer(text_data, truncation=True, max_length=max_tokens)
+    features = [{key: encodings[key][i] for key in encodings} for i in range(len(text_data))]
+
+    # Shortest paragraphs first, so each batch is padded as little as possible
+    order = sorted(range(len(text_data)), key=lambda i: (len(features[i]['input_ids']), i))
+    first_title = None
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer.pad([features[i] for i in batch], return_tensors="pt")
+        with torch.no_grad():
+            outputs = model(**inputs).logits
+        predicted_label = torch.argmax(outputs, dim=1).tolist()
+
+        # Assume the first predicted "title" in document order is correct
+        for i, label in zip(batch, predicted_label):
+            if label == 1 and (first_title is None or i < first_title):
+                first_title = i
+
+        remaining = order[start + batch_size:]
+        if first_title is not None and (not remaining or first_title < min(remaining)):
+            break
+
+    return text_data[first_title] if first_title is not None else None  # None when no title detected
@@ -0,0 +1,167 @@
+"""Title detection from paragraph layout, ahead of the BERT classifier.
+
+Titles are set apart by their layout: they sit near the top, are short,
+larger than the text around them, usually bold or centred, and don't end
+with a full stop.  ``score_title`` reads these features for the leading
+paragraphs of a document (following the paragraph style chain for sizes,
+emphasis and alignment that are not set directly) into a NumPy matrix and
+scores every paragraph with a fixed logistic model.
+
+The confidence of the best paragraph is lowered by any runner-up that also
+looks like a title, so a document with two equally plausible candidates (or
+none) scores low.  ``identify_title`` only returns a title when the
+confidence reaches ``THRESHOLD`` (TITLE_LAYOUT_THRESHOLD in the environment);
+otherwise the caller falls back to ``title_classifier.identify_title``.
+"""
+import os
+import re
+from itertools import islice
+
+import numpy as np
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml.ns import qn
+
+import title_classifier
+
+THRESHOLD = float(os.environ.get("TITLE_LAYOUT_THRESHOLD", "0.9"))
+
+# Columns of the feature matrix and the weight of each in the title logit
+FEATURES = (
+    "first",         # the first non-empty paragraph
+    "near_top",      # decays with the position among non-empty paragraphs
+    "size_ratio",    # font size relative to the median of the leading paragraphs, minus one
+    "largest",       # the largest font size, above the median
+    "bold",          # every run with text is bold
+    "centered",
+    "title_length",  # between MIN_WORDS and MAX_WORDS words
+    "full_stop",     # ends with a full stop
+    "metadata",      # e-mail addresses, links, DOIs, headings such as "Abstract"
+)
+WEIGHTS = np.array([0.5, 1.5, 2.5, 2.0, 1.0, 1.0, 1.0, -2.0, -3.0])
+BIAS = -4.0
+
+MIN_WORDS = 2
+MAX_WORDS = 25
+# Font size when neither the paragraph, its style nor the document defaults set one (in points)
+DEFAULT_FONT_SIZE = 10.0
+METADATA = re.compile(r"@|https?://|www\.|\bdoi\b|^(paper ?type|article ?type|abstract|keywords?|received|copyright|"
+                      r"correspondence)\b", re.IGNORECASE)
+
+_T = qn("w:t")
+_SZ = qn("w:sz")
+_B = qn("w:b")
+
+
+class _StyleLayout:
+    """Font size, bold and centring of each paragraph style, following ``w:basedOn``."""
+
+    def __init__(self, styles_element):
+        self._styles = {style.styleId: style for style in styles_element.style_lst}
+        self.default_id = None
+        for style in styles_element.style_lst:
+            if style.type == WD_STYLE_TYPE.PARAGRAPH and style.default:
+                self.default_id = style.styleId  # the last default in document order wins
+        sz = styles_element.xpath("./w:docDefaults/w:rPrDefault/w:rPr/w:sz")
+        self.default_size = sz[0].val.pt if sz and sz[0].val is not None else DEFAULT_FONT_SIZE
+        self._layouts = {}
+
+    def layout(self, style_id):
+        """(font size in points, bold, centred) of paragraphs in the style ``style_id``."""
+        if style_id not in self._styles:
+            style_id = self.default_id
+        try:
+            return self._layouts[style_id]
+        except KeyError:
+            pass
+        size = bold = alignment = None
+        seen = set()
+        style = self._styles.get(style_id)
+        while style is not None and style.styleId not in seen and None in (size, bold, alignment):
+            seen.add(style.styleId)
+            rPr, pPr = style.rPr, style.pPr
+            if size is None and rPr is not None and rPr.sz_val is not None:
+                size = rPr.sz_val.pt
+            if bold is None and rPr is not None and rPr.b is not None:
+                bold = rPr.b.val
+            if alignment is None and pPr is not None:
+                alignment = pPr.jc_val
+            style = self._styles.get(style.basedOn_val)
+        layout = self._layouts[style_id] = (size or self.default_size, bool(bold),
+                                            alignment == WD_PARAGRAPH_ALIGNMENT.CENTER)
+        return layout
+
+
+def _paragraph_layout(p, style_layout):
+    """(font size, bold, centred) of paragraph element ``p``; the size is that of its largest text run."""
+    style_size, style_bold, centered = style_layout.layout(p.style)
+    if p.pPr is not None and p.pPr.jc_val is not None:
+        centered = p.pPr.jc_val == WD_PARAGRAPH_ALIGNMENT.CENTER
+    size = None
+    bold = True
+    for r in p.r_lst:
+        if not any(t.text and not t.text.isspace() for t in r.iter(_T)):
+            continue
+        rPr = r.rPr
+        sz = rPr.find(_SZ) if rPr is not None else None
+        b = rPr.find(_B) if rPr is not None else None
+        run_size = sz.val.pt if sz is not None and sz.val is not None else style_size
+        size = run_size if size is None else max(size, run_size)
+        bold = bold and (b.val if b is not None else style_bold)
+    return size if size is not None else style_size, bold, centered
+
+
+def feature_matrix(paragraphs, styles_element):
+    """The texts of ``paragraphs`` and their FEATURES, one row per paragraph."""
+    style_layout = _StyleLayout(styles_element)
+    texts = []
+    layouts = []
+    for paragraph in paragraphs:
+        texts.append(paragraph.text.strip())
+        layouts.append(_paragraph_layout(paragraph._p, style_layout))
+    matrix = np.zeros((len(texts), len(FEATURES)))
+    if not texts:
+        return texts, matrix
+    sizes = np.array([layout[0] for layout in layouts])
+    median = np.median(sizes)
+    words = np.array([len(text.split()) for text in texts])
+    matrix[0, 0] = 1.0
+    matrix[:, 1] = np.exp(-np.arange(len(texts)) / 3.0)
+    matrix[:, 2] = np.clip(sizes / median - 1.0, -1.0, 2.0)
+    matrix[:, 3] = (sizes == sizes.max()) & (sizes > median)
+    matrix[:, 4] = [layout[1] for layout in layouts]
+    matrix[:, 5] = [layout[2] for layout in layouts]
+    matrix[:, 6] = (words >= MIN_WORDS) & (words <= MAX_WORDS)
+    matrix[:, 7] = [text.endswith(".") for text in texts]
+    matrix[:, 8] = [METADATA.search(text) is not None for text in texts]
+    return texts, matrix
+
+
+def leading_paragraphs(paragraphs, max_paragraphs=None):
+    """The first ``max_paragraphs`` paragraphs with text (as classified by BERT)."""
+    max_paragraphs = title_classifier.MAX_PARAGRAPHS if max_paragraphs is None else max_paragraphs
+    return list(islice((paragraph for paragraph in paragraphs if paragraph.text.strip()), max_paragraphs))
+
+
+# Function to score the leading paragraphs of a document as its title
+def score_title(paragraphs, styles_element):
+    """Returns (text, confidence) of the paragraph that looks most like a title, or (None, 0.0).
+
+    ``paragraphs`` are the leading paragraphs with text (see
+    ``leading_paragraphs``) and ``styles_element`` is the document's ``w:styles``.
+    """
+    texts, matrix = feature_matrix(paragraphs, styles_element)
+    if not texts:
+        return None, 0.0
+    logits = matrix @ WEIGHTS + BIAS
+    best = int(np.argmax(logits))  # the earliest of equal scores
+    runner_up = np.max(np.delete(logits, best), initial=-np.inf)
+    margin = logits[best] - max(runner_up, 0.0)
+    return texts[best], float(1.0 / (1.0 + np.exp(-margin)))
+
+
+def identify_title(paragraphs, styles_element, threshold=None):
+    """The title found by ``score_title``, or None when its confidence is below ``threshold``."""
+    threshold = THRESHOLD if threshold is None else threshold
+    title, confidence = score_title(paragraphs, styles_element)
+    return title if confidence >= threshold else None
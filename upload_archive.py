@@ -0,0 +1,64 @@
+"""Opt-in archival of uploaded documents.
+
+Uploads are formatted straight from memory; when archiving is enabled a copy
+of each upload is written under a unique name and files older than the
+retention period are removed.
+"""
+import os
+import re
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+# Archived files are named "<unix time>-<hex id>-<original name>"
+ARCHIVE_NAME = re.compile(r'^(\d+)-[0-9a-f]{32}-')
+
+# Minimum number of seconds between two cleanup sweeps of the archive folder
+CLEANUP_INTERVAL = 60
+
+_last_cleanup = 0.0
+
+
+# Function to save a copy of an upload under a unique name
+def archive_upload(data, filename, folder):
+    os.makedirs(folder, exist_ok=True)
+    name = "%d-%s-%s" % (time.time(), uuid.uuid4().hex, secure_filename(filename) or "upload.docx")
+    path = os.path.join(folder, name)
+    tmp_path = path + ".part"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+# Function to delete archived uploads older than the retention period
+def cleanup_uploads(folder, retention_seconds, now=None):
+    now = time.time() if now is None else now
+    removed = 0
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        match = ARCHIVE_NAME.match(name)
+        # Leave files that were not written by archive_upload alone
+        if not match or name.endswith(".part"):
+            continue
+        if now - int(match.group(1)) > retention_seconds:
+            try:
+                os.remove(os.path.join(folder, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+# Function to run cleanup_uploads at most once per CLEANUP_INTERVAL
+def maybe_cleanup_uploads(folder, retention_seconds):
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < CLEANUP_INTERVAL:
+        return 0
+    _last_cleanup = now
+    return cleanup_uploads(folder, retention_seconds, now)